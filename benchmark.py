@@ -0,0 +1,211 @@
+# Copyright 2020 The Feverbase Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Offline benchmarks for the crawler.
+
+  python benchmark.py parse clinicaltrialsgov path/to/saved/pages
+  python benchmark.py record crawl.jsonl.gz  # needs network
+  python benchmark.py crawl crawl.jsonl.gz  # doesn't
+
+`parse` only loads the faucets, so it runs without Mongo. The crawl modes
+import fetch, which connects to it.
+"""
+
+import os
+import sys
+import time
+import argparse
+
+from crawler import soup, archive, metrics, checkpoint
+
+sys.path.append("./fetch")
+from faucets import clinicaltrialsgov, eu, isrctn
+
+SOURCES = [faucet.SOURCE for faucet in [clinicaltrialsgov, eu, isrctn]]
+# the function each faucet parses its detail pages with
+PAGE_PARSERS = {
+    "clinicaltrialsgov": clinicaltrialsgov.parse_record,
+    "eu": eu.parse_protocol,
+    "isrctn": isrctn.parse_details,
+}
+# (parser, restrict) combinations compared by `parse`, the first one being
+# the reference the others' results must match
+BACKENDS = [
+    ("html.parser", False),
+    ("lxml", False),
+    ("lxml", True),
+]
+
+
+def load_pages(directory):
+  pages = {}
+  for name in sorted(os.listdir(directory)):
+    path = os.path.join(directory, name)
+    if os.path.isfile(path):
+      with open(path, "rb") as f:
+        pages[name] = f.read()
+  return pages
+
+
+def parse_throughput(parse, pages, repeat=3):
+  """
+  Parse every page `repeat` times with each of BACKENDS.
+
+  Returns one dict per backend with its pages and megabytes per second and
+  the names of the pages it parsed differently from the first backend.
+  soup.PARSER and soup.RESTRICT are put back afterwards.
+  """
+  size = sum(len(content) for content in pages.values())
+  reference = None
+  results = []
+  settings = soup.PARSER, soup.RESTRICT
+  try:
+    for parser, restrict in BACKENDS:
+      soup.PARSER, soup.RESTRICT = parser, restrict
+      parsed = {name: parse(content) for name, content in pages.items()}
+      start = time.perf_counter()
+      for _ in range(repeat):
+        for content in pages.values():
+          parse(content)
+      seconds = time.perf_counter() - start
+      if reference is None:
+        reference = parsed
+
+      results.append({
+          "parser": parser,
+          "restrict": restrict,
+          "pages_per_second": round(repeat * len(pages) / seconds, 1),
+          "mb_per_second": round(repeat * size / seconds / 1e6, 2),
+          "mismatches": [n for n in pages if parsed[n] != reference[n]],
+      })
+  finally:
+    soup.PARSER, soup.RESTRICT = settings
+  return results
+
+
+def crawl_throughput(sources=None):
+  """
+  Crawl every faucet in fetch.DRIPPING_FAUCETS (or just `sources`) in full,
+  one after the other, and translate the records without writing them
+  anywhere.
+
+  Returns {source: stats} with the records per second, milliseconds spent
+  parsing each detail page and translating each record, and the number of
+  failed jobs and records that could not be translated.
+  """
+  import fetch
+  from fetch import scheduler
+
+  results = {}
+  for source, faucet in fetch.DRIPPING_FAUCETS.items():
+    if sources and source not in sources:
+      continue
+    metrics.reset()
+    jobs = [
+        scheduler.CrawlJob(source, faucet, query)
+        for query in fetch.get_queries(faucet)
+    ]
+    existing = set()
+    since = getattr(faucet, "START_DATE", None)
+    count = 0
+    errors = 0
+    failed_records = 0
+    start = time.perf_counter()
+    for job, item in scheduler.stream(
+        jobs, lambda job: job.faucet.find(job.query, existing, since)):
+      if isinstance(item, scheduler.Done):
+        errors += bool(item.error)
+        continue
+      if isinstance(item, checkpoint.PageDone):
+        continue
+      try:
+        with metrics.timer("fetch_translate_seconds", source=source):
+          fetch.translate(item)
+      except Exception:
+        failed_records += 1
+      count += 1
+    seconds = time.perf_counter() - start
+
+    report = metrics.get_report()
+    histograms = {h["name"]: h for h in report["histograms"]}
+    requests = sum(c["value"]
+                   for c in report["counters"]
+                   if c["name"] == "fetch_requests_total")
+
+    def get_ms(name):
+      histogram = histograms.get(name)
+      if not histogram or not histogram["count"]:
+        return None
+      return round(1000 * histogram["sum"] / histogram["count"], 2)
+
+    results[source] = {
+        "records": count,
+        "seconds": round(seconds, 2),
+        "records_per_second": round(count / seconds, 1),
+        "requests": requests,
+        "parse_ms_per_page": get_ms("fetch_parse_seconds"),
+        "translate_ms_per_record": get_ms("fetch_translate_seconds"),
+        "failed_jobs": errors,
+        "failed_records": failed_records,
+    }
+  return results
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  commands = parser.add_subparsers(dest="command", required=True)
+
+  parse = commands.add_parser(
+      "parse", help="compare the HTML backends on saved detail pages")
+  parse.add_argument("faucet", choices=sorted(PAGE_PARSERS))
+  parse.add_argument("directory",
+                     help="directory of saved pages, one page per file")
+  parse.add_argument("--repeat", type=int, default=3)
+  for name, description in [
+      ("record", "crawl the live registries, saving every response"),
+      ("crawl", "crawl from a recorded archive and report throughput"),
+  ]:
+    command = commands.add_parser(name, help=description)
+    command.add_argument("archive", help="gzipped archive of responses")
+    command.add_argument("--source",
+                         dest="sources",
+                         action="append",
+                         choices=sorted(SOURCES),
+                         help="only crawl this source (repeatable)")
+  args = parser.parse_args()
+
+  if args.command == "parse":
+    pages = load_pages(args.directory)
+    print(f"{len(pages)} pages, {sum(map(len, pages.values()))} bytes")
+    for result in parse_throughput(PAGE_PARSERS[args.faucet], pages,
+                                   args.repeat):
+      print(
+          f"{result['parser']:<12} restrict={str(result['restrict']):<5} {result['pages_per_second']:>8} pages/s {result['mb_per_second']:>6} MB/s {len(result['mismatches'])} mismatches"
+      )
+      for name in result["mismatches"]:
+        print(f"  differs: {name}")
+
+  if args.command in ["record", "crawl"]:
+    if args.command == "record":
+      archive.record(args.archive)
+    else:
+      archive.replay(args.archive)
+    try:
+      results = crawl_throughput(args.sources)
+    finally:
+      archive.stop()
+    for source, result in results.items():
+      print(
+          f"{source:<26} {result['records']:>6} records in {result['seconds']:>7}s {result['records_per_second']:>7} records/s {result['requests']:>6} requests, parse {result['parse_ms_per_page']} ms/page, translate {result['translate_ms_per_record']} ms/record, {result['failed_jobs']} failed jobs, {result['failed_records']} failed records"
+      )
@@ -0,0 +1,6 @@
+"""
+What the faucets are built from: the shared HTTP client with its cache,
+archive and metrics, page parsing, and crawl checkpoints. Kept out of the
+fetch package so that faucets and utils can use it without loading every
+faucet, search and fetch's logging setup.
+"""
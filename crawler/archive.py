@@ -0,0 +1,151 @@
+# Copyright 2020 The Feverbase Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import re
+import gzip
+import json
+import base64
+import logging
+import threading
+from collections import defaultdict, deque
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+# query parameters whose value depends on the day a crawl runs rather than
+# on what it asks for, left out when matching requests to the archive
+VOLATILE_PARAMS = {"rcv_d"}
+# dates in the rest of the query (EU dateFrom, ISRCTN dateAssigned, the
+# clinicaltrials.gov StudyFirstSubmitDate range) come from the watermarks, so
+# they are matched as any date
+DATE = re.compile(r"\b(\d{4}-\d{2}-\d{2}|\d{2}/\d{2}/\d{4})\b")
+# query parameters holding credentials (the Maps API key), which are never
+# written to the archive nor needed to match a request
+SECRET_PARAMS = {"key"}
+# the archive stores decoded bodies, so these no longer apply
+DROPPED_HEADERS = {"content-encoding", "content-length", "transfer-encoding"}
+
+logger = logging.getLogger(__name__)
+
+# None, "record" or "replay"
+mode = None
+lock = threading.Lock()
+archive_file = None
+# {key: deque of entries}, served in the order they were recorded
+entries = defaultdict(deque)
+
+
+class NotArchived(requests.ConnectionError):
+  """
+  Raised when replaying a request the archive has no response for, like a
+  connection error would be without network.
+  """
+  pass
+
+
+def get_key(method, url, params=None):
+  """
+  Return the key a request is archived under: its url with the query sorted,
+  without VOLATILE_PARAMS and SECRET_PARAMS, and with its dates blanked out.
+  """
+  url = requests.Request(method, url, params=params).prepare().url
+  parts = urlsplit(url)
+  query = sorted((DATE.sub("DATE", name), DATE.sub("DATE", value))
+                 for name, value in parse_qsl(parts.query, keep_blank_values=True)
+                 if name not in VOLATILE_PARAMS | SECRET_PARAMS)
+  return f"{method} {urlunsplit(parts._replace(query=urlencode(query)))}"
+
+
+def record(path):
+  """
+  Append every response the client gets from now on to the gzipped JSON
+  lines archive at `path`.
+  """
+  global mode, archive_file
+  stop()
+  archive_file = gzip.open(path, "at")
+  mode = "record"
+  logger.warn(f"Recording HTTP responses to {path}")
+
+
+def replay(path):
+  """
+  Serve every request the client makes from now on from the archive at
+  `path`, without touching the network.
+  """
+  global mode
+  stop()
+  with gzip.open(path, "rt") as f:
+    for line in f:
+      entry = json.loads(line)
+      entries[entry["key"]].append(entry)
+  mode = "replay"
+  logger.warn(f"Replaying {len(entries)} archived urls from {path}")
+
+
+def stop():
+  global mode, archive_file
+  with lock:
+    if archive_file:
+      archive_file.close()
+    archive_file = None
+    entries.clear()
+    mode = None
+
+
+def save(method, url, response, params=None, **kwargs):
+  """
+  Add `response` to the archive being recorded. Its body is read right away,
+  so a streamed response is then served from memory.
+  """
+  content = response.content
+  response.raw = io.BytesIO(content)
+  entry = {
+      "key": get_key(method, url, params),
+      "status": response.status_code,
+      "headers": {
+          k: v
+          for k, v in response.headers.items()
+          if k.lower() not in DROPPED_HEADERS
+      },
+      "body": base64.b64encode(content).decode(),
+  }
+  with lock:
+    archive_file.write(json.dumps(entry) + "\n")
+
+
+def load(method, url, params=None, **kwargs):
+  """
+  Return the archived response to a request. A url requested more times
+  than it was recorded gets its last response again.
+  """
+  key = get_key(method, url, params)
+  with lock:
+    recorded = entries.get(key)
+    if not recorded:
+      raise NotArchived(f"No archived response for {key}")
+    entry = recorded.popleft() if len(recorded) > 1 else recorded[0]
+
+  content = base64.b64decode(entry["body"])
+  response = requests.Response()
+  response.status_code = entry["status"]
+  response.headers = CaseInsensitiveDict(entry["headers"])
+  response.encoding = requests.utils.get_encoding_from_headers(
+      response.headers)
+  response._content = content
+  response.raw = io.BytesIO(content)
+  response.url = url
+  return response
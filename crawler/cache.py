@@ -0,0 +1,256 @@
+# Copyright 2020 The Feverbase Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import logging
+
+from . import metrics, soup
+
+CACHE_DIR = os.environ.get("FETCH_CACHE_DIR", "cache/http")
+# total size of cached bodies before the least recently used are evicted
+MAX_SIZE = int(os.environ.get("FETCH_CACHE_MAX_SIZE", 2 * 1024**3))
+
+logger = logging.getLogger(__name__)
+
+lock = threading.Lock()
+connection = None
+
+
+def get_connection():
+  global connection
+  if connection is None:
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    connection = sqlite3.connect(os.path.join(CACHE_DIR, "index.sqlite"),
+                                 check_same_thread=False)
+    connection.execute("""
+      CREATE TABLE IF NOT EXISTS entries (
+        url TEXT PRIMARY KEY,
+        etag TEXT,
+        last_modified TEXT,
+        digest TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        accessed REAL NOT NULL
+      )""")
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS entries_digest ON entries (digest)")
+    # one row holding the size of all cached bodies, kept up to date by
+    # store and release so it isn't summed up again on every store
+    connection.execute("""
+      CREATE TABLE IF NOT EXISTS total (
+        id INTEGER PRIMARY KEY CHECK (id = 0),
+        size INTEGER NOT NULL
+      )""")
+    if not connection.execute("SELECT 1 FROM total").fetchone():
+      connection.execute("""
+        INSERT OR IGNORE INTO total
+        SELECT 0, COALESCE(SUM(size), 0)
+        FROM (SELECT DISTINCT digest, size FROM entries)""")
+    connection.commit()
+  return connection
+
+
+def get_blob_path(digest, suffix=""):
+  return os.path.join(CACHE_DIR, digest[:2], digest + suffix)
+
+
+def lookup(url):
+  """
+  Return the cached entry for `url` as a dict, or None.
+  """
+  with lock:
+    row = get_connection().execute(
+        "SELECT etag, last_modified, digest FROM entries WHERE url = ?",
+        (url,)).fetchone()
+  if row and os.path.exists(get_blob_path(row[2])):
+    return {"etag": row[0], "last_modified": row[1], "digest": row[2]}
+
+
+def conditional_headers(entry):
+  headers = {}
+  if entry.get("etag"):
+    headers["If-None-Match"] = entry["etag"]
+  if entry.get("last_modified"):
+    headers["If-Modified-Since"] = entry["last_modified"]
+  return headers
+
+
+def revalidated(url, entry, response):
+  """
+  Turn a 304 `response` into a 200 carrying the cached body, or return None
+  if the body was evicted since `entry` was looked up.
+  """
+  try:
+    with open(get_blob_path(entry["digest"]), "rb") as f:
+      response._content = f.read()
+  except FileNotFoundError:
+    return None
+  response.status_code = 200
+  response.from_cache = True
+  response.cache_digest = entry["digest"]
+  with lock:
+    get_connection().execute("UPDATE entries SET accessed = ? WHERE url = ?",
+                             (time.time(), url))
+    get_connection().commit()
+  return response
+
+
+def store(url, response):
+  """
+  Save a 200 `response` if the server sent validators we can revalidate with.
+  """
+  etag = response.headers.get("ETag")
+  last_modified = response.headers.get("Last-Modified")
+  if not etag and not last_modified:
+    return
+
+  content = response.content
+  digest = hashlib.sha256(content).hexdigest()
+  path = get_blob_path(digest)
+  if not os.path.exists(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write then rename so a crash never leaves a truncated body behind
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+      f.write(content)
+    os.replace(tmp_path, path)
+  response.cache_digest = digest
+
+  with lock:
+    db = get_connection()
+    previous = db.execute("SELECT digest, size FROM entries WHERE url = ?",
+                          (url,)).fetchone()
+    if not is_referenced(db, digest):
+      add_to_total(db, len(content))
+    db.execute(
+        "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+        (url, etag, last_modified, digest, len(content), time.time()),
+    )
+    # the page changed, so nothing may use its old body anymore
+    if previous and previous[0] != digest:
+      release(db, *previous)
+    db.commit()
+    if get_total(db) > MAX_SIZE:
+      evict(db)
+
+
+def is_referenced(db, digest):
+  # bodies are shared by every url with the same content
+  return db.execute("SELECT 1 FROM entries WHERE digest = ? LIMIT 1",
+                    (digest,)).fetchone() is not None
+
+
+def get_total(db):
+  return db.execute("SELECT size FROM total").fetchone()[0]
+
+
+def add_to_total(db, size):
+  db.execute("UPDATE total SET size = size + ?", (size,))
+
+
+def release(db, digest, size):
+  """
+  Delete the body `digest` and the parse results stored with it, unless an
+  entry still uses it. Must be called holding `lock`.
+  """
+  if is_referenced(db, digest):
+    return
+  add_to_total(db, -size)
+  directory = os.path.dirname(get_blob_path(digest))
+  for name in os.listdir(directory) if os.path.isdir(directory) else []:
+    if name.startswith(digest):
+      os.remove(os.path.join(directory, name))
+
+
+def evict(db):
+  """
+  Drop least recently used entries until the cached bodies fit in MAX_SIZE.
+  Must be called holding `lock`.
+  """
+  evicted = 0
+  while get_total(db) > MAX_SIZE:
+    rows = db.execute(
+        "SELECT url, digest, size FROM entries ORDER BY accessed LIMIT 100"
+    ).fetchall()
+    if not rows:
+      break
+    for url, digest, size in rows:
+      if get_total(db) <= MAX_SIZE:
+        break
+      db.execute("DELETE FROM entries WHERE url = ?", (url,))
+      evicted += 1
+      release(db, digest, size)
+  db.commit()
+  logger.info(f"Evicted {evicted} cached pages")
+
+
+def get_parse_key(parse):
+  # changes whenever the body of `parse` or the tree builder it parses with
+  # does, so stale results are ignored
+  code = parse.__code__
+  settings = (code.co_consts, soup.PARSER, soup.RESTRICT)
+  fingerprint = hashlib.sha1(code.co_code + repr(settings).encode())
+  return f"{parse.__module__}.{parse.__name__}.{fingerprint.hexdigest()[:12]}"
+
+
+def parsed(response, parse):
+  """
+  Return `parse(response.content)`. Cached bodies are content-addressed, so
+  if the same body was parsed before (typically after a 304) the stored
+  result is returned without parsing again.
+  """
+  result = load_parsed(response, parse)
+  if result is not None:
+    return result
+
+  faucet = parse.__module__.split(".")[-1]
+  with metrics.timer("fetch_parse_seconds", faucet=faucet):
+    result = parse(response.content)
+  save_parsed(response, parse, result)
+  return result
+
+
+def get_parsed_path(response, parse):
+  digest = getattr(response, "cache_digest", None)
+  if digest:
+    return get_blob_path(digest, f".{get_parse_key(parse)}.json")
+
+
+def load_parsed(response, parse):
+  """
+  Return the stored result of `parse` for the response's body, or None.
+  """
+  path = get_parsed_path(response, parse)
+  if path and os.path.exists(path):
+    metrics.inc("fetch_parse_cached_total",
+                faucet=parse.__module__.split(".")[-1])
+    with open(path) as f:
+      return json.load(f)
+
+
+def save_parsed(response, parse, result):
+  path = get_parsed_path(response, parse)
+  if not path:
+    return
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  tmp_path = f"{path}.{threading.get_ident()}.tmp"
+  with open(tmp_path, "w") as f:
+    json.dump(result, f)
+  os.replace(tmp_path, path)
@@ -0,0 +1,99 @@
+# Copyright 2020 The Feverbase Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+# yielded by a faucet's find after the last record of a listing page, so an
+# interrupted crawl can resume with the page after it (see Tracker.resume)
+PageDone = namedtuple("PageDone", ["page"])
+
+
+class Tracker:
+  """
+  Keeps db.Checkpoints of the crawl jobs of a run. Progress reported with
+  `record`, `page_done` and `job_done` is only written by `flush`, which the
+  caller runs after saving every record it has seen so far.
+  """
+
+  def __init__(self, jobs, full, started):
+    # imported here, so faucets can import PageDone without a Mongo connection
+    from utils import db
+    self.full = full
+    self.started = started
+    self.checkpoints = {}
+    self.pending = {}
+
+    keys = {(job.source, job.query): job for job in jobs}
+    for checkpoint in db.Checkpoint.objects():
+      job = keys.get((checkpoint.source, checkpoint.query))
+      # left by a different kind of run, start over
+      if not job or checkpoint.full != full:
+        checkpoint.delete()
+        continue
+      self.checkpoints[job] = checkpoint
+      # the watermark has to cover the crawl that was interrupted
+      self.started = min(self.started, checkpoint.started)
+      logger.warn(
+          f"[{job.source}, '{job.query}'] Resuming with {len(checkpoint.urls)} trials done{' (finished)' if checkpoint.done else ''}"
+      )
+
+  def is_done(self, job):
+    checkpoint = self.checkpoints.get(job)
+    return bool(checkpoint and checkpoint.done)
+
+  def get_existing(self):
+    """
+    Return the urls the resumed jobs already saved.
+    """
+    return {
+        url for checkpoint in self.checkpoints.values()
+        for url in checkpoint.urls
+    }
+
+  def resume(self, job):
+    """
+    Return the extra find arguments that skip what `job` already did.
+    """
+    checkpoint = self.checkpoints.get(job)
+    if checkpoint and checkpoint.page is not None:
+      return {"start_page": checkpoint.page + 1}
+    return {}
+
+  def get_pending(self, job):
+    if job not in self.pending:
+      self.pending[job] = {"urls": set(), "fields": {}}
+    return self.pending[job]
+
+  def record(self, job, url):
+    self.get_pending(job)["urls"].add(url)
+
+  def page_done(self, job, page):
+    self.get_pending(job)["fields"]["page"] = page
+
+  def job_done(self, job):
+    self.get_pending(job)["fields"]["done"] = True
+
+  def flush(self):
+    from utils import db
+    for job, progress in self.pending.items():
+      db.save_checkpoint(job.source, job.query, self.full, self.started,
+                         progress["urls"], **progress["fields"])
+    self.pending = {}
+
+  def clear(self, source):
+    from utils import db
+    db.clear_checkpoints(source)
@@ -0,0 +1,202 @@
+# Copyright 2020 The Feverbase Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import random
+import threading
+import logging
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import cache, metrics, archive
+
+# (connect, read) in seconds, used unless a caller passes its own
+TIMEOUT = (10, 30)
+RETRIES = 4
+BACKOFF = 1  # seconds, doubled after every failed attempt
+MAX_BACKOFF = 60  # seconds
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+# requests per second allowed against a host without its own rate limit
+DEFAULT_RATE_LIMIT = 10
+# keep-alive connections kept open per host
+POOL_SIZE = 16
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+  """
+  Allows `rate` requests per second on average, with bursts of up to
+  `capacity` requests. Safe to share between threads.
+  """
+
+  def __init__(self, rate, capacity=None):
+    self.rate = rate
+    self.capacity = capacity or max(1, rate)
+    self.tokens = self.capacity
+    self.updated = time.monotonic()
+    self.lock = threading.Lock()
+
+  def acquire(self):
+    """
+    Block until a token is available, then take it.
+    """
+    while True:
+      with self.lock:
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+          self.tokens -= 1
+          return
+        wait = (1 - self.tokens) / self.rate
+      time.sleep(wait)
+
+
+session = requests.Session()
+adapter = HTTPAdapter(pool_maxsize=POOL_SIZE)
+session.mount("http://", adapter)
+session.mount("https://", adapter)
+
+buckets = {}
+buckets_lock = threading.Lock()
+
+
+def get_host(url):
+  # accept either a full url or a bare host name
+  return urlparse(url).netloc or url
+
+
+def set_rate_limit(url, rate, capacity=None):
+  """
+  Limit requests to the host of `url` to `rate` per second.
+  """
+  with buckets_lock:
+    buckets[get_host(url)] = TokenBucket(rate, capacity)
+
+
+def get_bucket(url):
+  host = get_host(url)
+  with buckets_lock:
+    if host not in buckets:
+      buckets[host] = TokenBucket(DEFAULT_RATE_LIMIT)
+    return buckets[host]
+
+
+def get_backoff(attempt, response=None):
+  # honor the server's Retry-After (in seconds) if it sent one
+  if response is not None:
+    try:
+      return min(MAX_BACKOFF, float(response.headers["Retry-After"]))
+    except (KeyError, ValueError):
+      pass
+  # full jitter so parallel workers don't retry in lockstep
+  return random.uniform(0, min(MAX_BACKOFF, BACKOFF * 2**attempt))
+
+
+def request(method, url, use_cache=False, **kwargs):
+  """
+  Send a request through the shared session, waiting for the host's rate
+  limit first. Connection errors, timeouts and RETRY_STATUS_CODES are retried
+  with jittered exponential backoff; after RETRIES the last response is
+  returned (or the last error raised).
+
+  With `use_cache`, a GET for a url in the on-disk cache is sent as a
+  conditional request, and a 304 comes back as a 200 with the cached body
+  and `response.from_cache` set.
+
+  While an archive is recorded or replayed (see crawler.archive) the cache is
+  not used, and replayed requests skip the rate limit and retries.
+  """
+  kwargs.setdefault("timeout", TIMEOUT)
+  if archive.mode == "replay":
+    return replay(method, url, **kwargs)
+  if archive.mode == "record":
+    # archived responses have to stand on their own, not be 304s
+    use_cache = False
+  bucket = get_bucket(url)
+
+  entry = None
+  headers = kwargs.get("headers", {})
+  if use_cache and method == "GET":
+    entry = cache.lookup(url)
+    if entry:
+      kwargs["headers"] = {**cache.conditional_headers(entry), **headers}
+
+  response = send(method, url, bucket, **kwargs)
+  response.from_cache = False
+  if entry and response.status_code == 304:
+    revalidated = cache.revalidated(url, entry, response)
+    if revalidated:
+      return revalidated
+    # evicted after the lookup, so the body has to be sent again
+    response = send(method, url, bucket, **{**kwargs, "headers": headers})
+    response.from_cache = False
+  if use_cache and method == "GET" and response.status_code == 200:
+    cache.store(url, response)
+  if archive.mode == "record":
+    archive.save(method, url, response, **kwargs)
+  return response
+
+
+def replay(method, url, **kwargs):
+  start = time.perf_counter()
+  response = archive.load(method, url, **kwargs)
+  record(get_host(url), response, time.perf_counter() - start)
+  response.from_cache = False
+  return response
+
+
+def send(method, url, bucket, **kwargs):
+  host = get_host(url)
+  for attempt in range(RETRIES + 1):
+    bucket.acquire()
+    start = time.perf_counter()
+    try:
+      response = session.request(method, url, **kwargs)
+    except (requests.ConnectionError, requests.Timeout) as e:
+      metrics.inc("fetch_requests_total", host=host, status=type(e).__name__)
+      if attempt == RETRIES:
+        raise
+      delay = get_backoff(attempt)
+      logger.info(f"[URL: {url}] {e}, retrying in {round(delay, 2)}s...")
+    else:
+      record(host, response, time.perf_counter() - start, kwargs.get("stream"))
+      if response.status_code not in RETRY_STATUS_CODES or attempt == RETRIES:
+        return response
+      delay = get_backoff(attempt, response)
+      # hand a streamed response's connection back to the pool
+      response.close()
+      logger.info(
+          f"[URL: {url}] Got {response.status_code}, retrying in {round(delay, 2)}s..."
+      )
+    time.sleep(delay)
+
+
+def record(host, response, seconds, stream=False):
+  metrics.inc("fetch_requests_total", host=host, status=response.status_code)
+  metrics.observe("fetch_request_seconds", seconds, host=host)
+  # don't read a streamed body here, its length is all there is to go on
+  if stream:
+    size = int(response.headers.get("Content-Length", 0))
+  else:
+    size = len(response.content)
+  metrics.inc("fetch_response_bytes_total", size, host=host)
+
+
+def get(url, use_cache=False, **kwargs):
+  return request("GET", url, use_cache=use_cache, **kwargs)
@@ -0,0 +1,195 @@
+# Copyright 2020 The Feverbase Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import time
+import logging
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import datetime
+
+# run reports are written here as metrics.json and metrics.prom (replaced by
+# every run) and appended to metrics.jsonl
+METRICS_DIR = os.environ.get("FETCH_METRICS_DIR", "logs")
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram:
+
+  def __init__(self):
+    self.counts = [0] * (len(BUCKETS) + 1)
+    self.count = 0
+    self.sum = 0
+
+  def observe(self, value):
+    self.counts[bisect_left(BUCKETS, value)] += 1
+    self.count += 1
+    self.sum += value
+
+  def get_buckets(self):
+    """
+    Return the cumulative count per upper bound, Prometheus style.
+    """
+    buckets = {}
+    total = 0
+    for bound, count in zip([*BUCKETS, "+Inf"], self.counts):
+      total += count
+      buckets[str(bound)] = total
+    return buckets
+
+
+# {(name, labels): value}, labels being a sorted tuple of (label, value)
+counters = {}
+gauges = {}
+histograms = {}
+lock = threading.Lock()
+started = datetime.now()
+
+
+def get_key(name, labels):
+  return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name, value=1, **labels):
+  key = get_key(name, labels)
+  with lock:
+    counters[key] = counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+  with lock:
+    gauges[get_key(name, labels)] = value
+
+
+def observe(name, seconds, **labels):
+  key = get_key(name, labels)
+  with lock:
+    if key not in histograms:
+      histograms[key] = Histogram()
+    histograms[key].observe(seconds)
+
+
+@contextmanager
+def timer(name, **labels):
+  """
+  Observe how long the block takes in histogram `name`, even if it raises.
+  """
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    observe(name, time.perf_counter() - start, **labels)
+
+
+def reset():
+  global started
+  with lock:
+    counters.clear()
+    gauges.clear()
+    histograms.clear()
+    started = datetime.now()
+
+
+def get_report():
+  """
+  Return every metric recorded since the last reset as a JSON-able dict.
+  """
+  with lock:
+    return {
+        "started":
+        started.isoformat(),
+        "counters": [{
+            "name": name,
+            "labels": dict(labels),
+            "value": value
+        } for (name, labels), value in sorted(counters.items())],
+        "gauges": [{
+            "name": name,
+            "labels": dict(labels),
+            "value": value
+        } for (name, labels), value in sorted(gauges.items())],
+        "histograms": [{
+            "name": name,
+            "labels": dict(labels),
+            "count": histogram.count,
+            "sum": histogram.sum,
+            "buckets": histogram.get_buckets(),
+        } for (name, labels), histogram in sorted(histograms.items())],
+    }
+
+
+def format_labels(labels, **extra):
+  labels = {**labels, **extra}
+  if not labels:
+    return ""
+  pairs = ",".join(f'{k}={json.dumps(str(v))}' for k, v in labels.items())
+  return f"{{{pairs}}}"
+
+
+def to_prometheus(report):
+  """
+  Return a get_report() dict in the Prometheus text exposition format.
+  """
+  lines = []
+  typed = set()
+
+  def declare(name, kind):
+    if name not in typed:
+      typed.add(name)
+      lines.append(f"# TYPE {name} {kind}")
+
+  for metric in report["counters"]:
+    declare(metric["name"], "counter")
+    lines.append(
+        f"{metric['name']}{format_labels(metric['labels'])} {metric['value']}")
+  for metric in report["gauges"]:
+    declare(metric["name"], "gauge")
+    lines.append(
+        f"{metric['name']}{format_labels(metric['labels'])} {metric['value']}")
+  for metric in report["histograms"]:
+    name = metric["name"]
+    declare(name, "histogram")
+    for bound, count in metric["buckets"].items():
+      lines.append(
+          f"{name}_bucket{format_labels(metric['labels'], le=bound)} {count}")
+    lines.append(f"{name}_sum{format_labels(metric['labels'])} {metric['sum']}")
+    lines.append(
+        f"{name}_count{format_labels(metric['labels'])} {metric['count']}")
+  return "\n".join(lines) + "\n"
+
+
+def write_report(directory=None):
+  """
+  Write the run's metrics to `directory` (METRICS_DIR by default) and return
+  the report.
+  """
+  directory = directory or METRICS_DIR
+  set_gauge("fetch_run_seconds",
+            round((datetime.now() - started).total_seconds(), 2))
+  report = get_report()
+
+  os.makedirs(directory, exist_ok=True)
+  with open(os.path.join(directory, "metrics.json"), "w") as f:
+    json.dump(report, f, indent=2)
+  with open(os.path.join(directory, "metrics.prom"), "w") as f:
+    f.write(to_prometheus(report))
+  with open(os.path.join(directory, "metrics.jsonl"), "a") as f:
+    f.write(json.dumps(report) + "\n")
+  logger.warn(f"Wrote run metrics to {directory}")
+  return report
@@ -0,0 +1,136 @@
+# Copyright 2020 The Feverbase Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Runs the faucets' page parsers in worker processes, so parsing uses more
+than one core and doesn't hold the GIL the download threads need.
+"""
+
+import os
+import time
+import threading
+import multiprocessing
+from concurrent.futures import (Future, ProcessPoolExecutor, wait,
+                                FIRST_COMPLETED)
+
+from . import cache, metrics
+
+# worker processes parsing pages, 0 parses in the calling thread instead. One
+# core is left to the downloads, so single core machines don't use any.
+PROCESSES = int(
+    os.environ.get("FETCH_PARSE_PROCESSES",
+                   min(4, (os.cpu_count() or 1) - 1)))
+# parses parse_each has submitted but not handed back yet; while that many
+# are pending it stops pulling downloads, which holds up the downloads too
+MAX_PENDING = 2 * max(PROCESSES, 1)
+
+lock = threading.Lock()
+executor = None
+
+
+def get_executor():
+  global executor
+  with lock:
+    if executor is None:
+      # the crawl is threaded by the time the pool starts, which forking
+      # doesn't mix well with
+      executor = ProcessPoolExecutor(
+          max_workers=PROCESSES,
+          mp_context=multiprocessing.get_context("spawn"))
+    return executor
+
+
+def shutdown():
+  global executor
+  with lock:
+    if executor is not None:
+      executor.shutdown()
+    executor = None
+
+
+def timed_parse(parse, content):
+  start = time.perf_counter()
+  result = parse(content)
+  return result, time.perf_counter() - start
+
+
+def submit(parse, response):
+  """
+  Start `parse(response.content)` in a worker, returning a Future of
+  (result, seconds spent parsing).
+  """
+  if PROCESSES:
+    return get_executor().submit(timed_parse, parse, response.content)
+  future = Future()
+  try:
+    future.set_result(timed_parse(parse, response.content))
+  except Exception as e:
+    future.set_exception(e)
+  return future
+
+
+def finish(response, parse, future):
+  result, seconds = future.result()
+  metrics.observe("fetch_parse_seconds",
+                  seconds,
+                  faucet=parse.__module__.split(".")[-1])
+  cache.save_parsed(response, parse, result)
+  return result
+
+
+def parsed(response, parse):
+  """
+  Like cache.parsed, but parse in a worker process.
+  """
+  result = cache.load_parsed(response, parse)
+  if result is not None:
+    return result
+  return finish(response, parse, submit(parse, response))
+
+
+def parse_each(pages, parse, max_pending=MAX_PENDING):
+  """
+  Parse the responses of the (key, response) pairs `pages` yields in the
+  worker processes, yielding (key, result) in the order the parses finish.
+
+  `pages` is only advanced while fewer than `max_pending` parses are
+  pending. A response that is an exception, or whose parse raised, is
+  yielded with the exception as its result, and one that isn't a 200 with
+  None.
+  """
+  pending = {}
+
+  def collect(timeout):
+    done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+    for future in done:
+      key, response = pending.pop(future)
+      try:
+        yield key, finish(response, parse, future)
+      except Exception as e:
+        yield key, e
+
+  for key, response in pages:
+    if isinstance(response, Exception):
+      yield key, response
+    elif response.status_code != 200:
+      yield key, None
+    else:
+      result = cache.load_parsed(response, parse)
+      if result is not None:
+        yield key, result
+      else:
+        pending[submit(parse, response)] = (key, response)
+    yield from collect(None if len(pending) >= max_pending else 0)
+
+  while pending:
+    yield from collect(None)
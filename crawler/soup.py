@@ -0,0 +1,38 @@
+# Copyright 2020 The Feverbase Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import importlib.util
+
+from bs4 import BeautifulSoup
+
+DEFAULT_PARSER = "lxml" if importlib.util.find_spec("lxml") else "html.parser"
+
+# tree builder used for every page the faucets parse, e.g. "lxml" or
+# "html.parser"
+PARSER = os.environ.get("FETCH_HTML_PARSER", DEFAULT_PARSER)
+# set FETCH_HTML_RESTRICT=0 to always build the whole tree, ignoring `only`
+RESTRICT = os.environ.get("FETCH_HTML_RESTRICT", "1") != "0"
+
+
+def make_soup(content, only=None):
+  """
+  Parse an HTML page with PARSER. If `only` (a bs4.SoupStrainer) is given,
+  just the tags it matches and their contents are built, so it must match
+  every tag the caller reads along with their parents up to the ones it
+  navigates between.
+  """
+  if only is not None and RESTRICT:
+    return BeautifulSoup(content, PARSER, parse_only=only)
+  return BeautifulSoup(content, PARSER)
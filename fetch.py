@@ -12,7 +12,56 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import argparse
+
 import fetch
+from fetch import workqueue
+from crawler import archive, metrics
 
 if __name__ == "__main__":
-  fetch.run()
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      "--full",
+      dest="full",
+      action="store_true",
+      help="ignore the saved watermarks and crawl every source's full history",
+  )
+  parser.add_argument(
+      "--record",
+      metavar="ARCHIVE",
+      help="save every registry response to this gzipped archive",
+  )
+  parser.add_argument(
+      "--replay",
+      metavar="ARCHIVE",
+      help="serve every registry request from this archive, offline",
+  )
+  parser.add_argument(
+      "--enqueue",
+      action="store_true",
+      help="queue a run for --worker processes instead of crawling",
+  )
+  parser.add_argument(
+      "--worker",
+      action="store_true",
+      help="process queued work until none is left",
+  )
+  args = parser.parse_args()
+
+  if args.record:
+    archive.record(args.record)
+  elif args.replay:
+    archive.replay(args.replay)
+  try:
+    if args.enqueue:
+      workqueue.start_run(full=args.full)
+    if args.worker:
+      metrics.reset()
+      try:
+        workqueue.Worker().run()
+      finally:
+        metrics.write_report()
+    if not args.enqueue and not args.worker:
+      fetch.run(full=args.full)
+  finally:
+    archive.stop()
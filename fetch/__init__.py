@@ -16,6 +16,7 @@ import sys
 import time
 import logging
 import os
+from datetime import datetime, timedelta
 
 sys.path.append("./fetch")
 # from faucets import chictr
@@ -23,10 +24,13 @@ from faucets import clinicaltrialsgov
 from faucets import eu
 from faucets import isrctn
 from . import utils
+from . import scheduler
+from . import ingest
+from . import filters
 
 sys.path.append("../")
-from utils import db, ms, location
-from utils.config import FILTER_OPTION_KEYS
+from crawler import checkpoint, metrics, parsing
+from utils import db
 
 from search import mongo_to_meili
 
@@ -47,6 +51,11 @@ logging.getLogger().addHandler(stdout_handler)
 logger = logging.getLogger(__name__)
 
 TERMS = utils.get_query_terms()
+# incremental runs re-request this much before each source's watermark, to
+# catch trials the registries publish a little after registering them
+WATERMARK_OVERLAP = timedelta(days=7)
+# translated records written to Mongo at once
+BATCH_SIZE = 500
 DRIPPING_FAUCETS = {
     clinicaltrialsgov.SOURCE: clinicaltrialsgov,
     eu.SOURCE: eu,
@@ -54,37 +63,153 @@ DRIPPING_FAUCETS = {
 }
 
 
-def run():
-  data = {}
-  existing = set()
-  for query in TERMS:
-    for source, faucet in DRIPPING_FAUCETS.items():
-      try:
-        logger.warn(f"----- Crawling {source} -----")
-        start = time.time()
+def run(full=False):
+  """
+  Crawl every faucet and load the results into Mongo and Meilisearch. Unless
+  `full` is set, each source is only asked for trials newer than its
+  watermark (minus WATERMARK_OVERLAP).
 
-        docs = faucet.find(query, existing)
-        data.update(docs)
+  Records are translated and written to Mongo in batches of BATCH_SIZE as the
+  faucets yield them, so nothing is held for the whole run. Articles whose
+  content hash did not change are not written again.
 
-        delta = time.time() - start
-        average = 0
-        if len(docs):
-          average = delta / len(docs)
+  Progress is checkpointed after every batch, so a run that is interrupted
+  is resumed by the next one with the same `full`: finished jobs are not run
+  again, and trials and listing pages already saved are skipped.
 
-        logger.warn(
-            f"----- Got {len(docs)} in {round(delta, 2)} seconds ({round(average, 2)}s average) -----"
-        )
-      except Exception as e:
-        logger.error(e)
+  Returns the run's ingest.ChangeSet. A `full` run also removes the articles
+  that sources crawled without errors no longer list.
 
-  articles = list(map(translate, data.values()))
-  # TODO (ethanzh) get maps API key
-  #articles_with_location = location.add_location_data(articles)
+  The run's metrics are written to metrics.METRICS_DIR, even if it fails,
+  and the parse worker processes are stopped.
+  """
+  metrics.reset()
+  try:
+    return crawl(full)
+  finally:
+    parsing.shutdown()
+    metrics.write_report()
 
-  db.create(db.Article, articles)
 
-  preload_filter_options()
-  mongo_to_meili()
+def crawl(full):
+  """
+  See `run`.
+  """
+  changes = ingest.ChangeSet()
+  since = get_since(full)
+
+  jobs = [
+      scheduler.CrawlJob(source, faucet, query)
+      for source, faucet in DRIPPING_FAUCETS.items()
+      for query in get_queries(faucet)
+  ]
+
+  progress = checkpoint.Tracker(jobs, full, datetime.now())
+  started = progress.started
+  existing = progress.get_existing()
+  jobs = [job for job in jobs if not progress.is_done(job)]
+
+  logger.warn(f"----- Crawling {len(jobs)} jobs -----")
+  start = time.time()
+  failed_sources = set()
+  counts = {job: 0 for job in jobs}
+  batch = []
+  records = scheduler.stream(
+      jobs, lambda job: job.faucet.find(job.query, existing, since[
+          job.source], **progress.resume(job)))
+  for job, record in records:
+    if isinstance(record, checkpoint.PageDone):
+      progress.page_done(job, record.page)
+      continue
+
+    if isinstance(record, scheduler.Done):
+      metrics.observe("fetch_job_seconds", record.seconds, source=job.source)
+      if record.error:
+        logger.error(f"[{job.source}, '{job.query}'] {record.error}")
+        metrics.inc("fetch_job_errors_total", source=job.source)
+        failed_sources.add(job.source)
+        continue
+
+      progress.job_done(job)
+
+      count = counts[job]
+      average = 0
+      if count:
+        average = record.seconds / count
+
+      logger.warn(
+          f"----- Got {count} from {job.source} for '{job.query}' in {round(record.seconds, 2)} seconds ({round(average, 2)}s average) -----"
+      )
+      continue
+
+    counts[job] += 1
+    metrics.inc("fetch_records_total", source=job.source)
+    progress.record(job, record.get("url"))
+    with metrics.timer("fetch_translate_seconds", source=job.source):
+      batch.append(translate(record))
+    if len(batch) >= BATCH_SIZE:
+      with metrics.timer("fetch_stage_seconds", stage="save"):
+        ingest.save(batch, changes)
+      progress.flush()
+      batch = []
+  with metrics.timer("fetch_stage_seconds", stage="save"):
+    ingest.save(batch, changes)
+  progress.flush()
+
+  logger.warn(
+      f"----- Crawled {sum(counts.values())} in {round(time.time() - start, 2)} seconds -----"
+  )
+
+  # only move a source's watermark once all of its jobs made it into Mongo
+  for source in DRIPPING_FAUCETS:
+    if source not in failed_sources:
+      db.set_watermark(source, started)
+      if full:
+        with metrics.timer("fetch_stage_seconds", stage="remove_stale"):
+          ingest.remove_stale(source, existing, changes)
+      progress.clear(source)
+  logger.warn(f"----- {changes} -----")
+  for change in ["added", "changed", "removed"]:
+    metrics.set_gauge("fetch_articles", len(getattr(changes, change)),
+                      change=change)
+  metrics.set_gauge("fetch_articles", changes.unchanged, change="unchanged")
+
+  # a full run rebuilds the filter options from every article, an incremental
+  # one only looks at the articles it touched (which for a resumed run
+  # leaves out those the interrupted one saved)
+  with metrics.timer("fetch_stage_seconds", stage="filter_options"):
+    filters.preload_filter_options(None if full or progress.checkpoints else
+                                   changes)
+  with metrics.timer("fetch_stage_seconds", stage="index"):
+    mongo_to_meili()
+  return changes
+
+
+def get_since(full):
+  """
+  Return {source: datetime} to ask each source for trials since: its
+  START_DATE, or unless `full` its watermark minus WATERMARK_OVERLAP.
+  """
+  since = {}
+  for source, faucet in DRIPPING_FAUCETS.items():
+    since[source] = getattr(faucet, "START_DATE", None)
+    watermark = None if full else db.get_watermark(source)
+    if watermark:
+      since[source] = max(since[source] or watermark,
+                          watermark - WATERMARK_OVERLAP)
+      logger.warn(f"----- Crawling {source} since {since[source]} -----")
+  return since
+
+
+def get_queries(faucet):
+  """
+  Return the queries to crawl `faucet` with: a single one matching any of
+  TERMS if the faucet sets SUPPORTS_OR_QUERY, else one per term (the shared
+  `existing` set still keeps a trial from being fetched twice).
+  """
+  if getattr(faucet, "SUPPORTS_OR_QUERY", False):
+    return [utils.get_or_query(TERMS)]
+  return TERMS
 
 
 def translate(info):
@@ -94,26 +219,3 @@ def translate(info):
     return faucet.translate(info)
   return info
 
-
-def preload_filter_options():
-  """
-  Aggregate all Articles' existing values for given FILTER_OPTION_KEYS and save them to the FilterOption collection in Mongo, replacing those that already exist.
-  """
-  filter_options = {key: set() for key in FILTER_OPTION_KEYS}
-  # keep track of set of casefolded values to preserve case of the common values
-  existing_filter_options = {key: set() for key in FILTER_OPTION_KEYS}
-
-  for article in db.Article.objects().only(*FILTER_OPTION_KEYS):
-    for key, s in filter_options.items():
-      value = str(eval(f"article.{key}") or "")
-      if value and value.casefold() not in existing_filter_options[key]:
-        s.add(value)
-        existing_filter_options[key].add(value.casefold())
-
-  filter_option_data = []
-  for key, values in filter_options.items():
-    for value in values:
-      filter_option_data.append({"key": key, "value": value})
-  # clear collection before adding new values
-  db.FilterOption.objects.delete()
-  db.create(db.FilterOption, filter_option_data)
@@ -12,44 +12,53 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from bs4 import BeautifulSoup
+from bs4 import SoupStrainer
 import re
-import requests
 import utils
 import logging
 
+from crawler import client, soup, checkpoint
+
 SOURCE = "chictr.org.cn"
 FILENAME = "chictr.json"
 BASE_URL = "http://www.chictr.org.cn/"
 QUERY_URL = "{BASE_URL}/searchprojen.aspx?officialname=&subjectid=&secondaryid=&applier=&studyleader=&ethicalcommitteesanction=&sponsor=&studyailment=&studyailmentcode=&studytype=0&studystage=0&studydesign=0&minstudyexecutetime=&maxstudyexecutetime=&recruitmentstatus=0&gender=0&agreetosign=&secsponsor=&regno=&regstatus=0&country=&province=&city=&institution=&institutionlevel=&measure=&intercode=&sourceofspends=&createyear=0&isuploadrf=&whetherpublic=&btngo=btn&verifycode=&title={query}"
 PAGINATE_QUERY = "&page={page_num}"
+# crawled once per search term, see fetch.get_queries
+SUPPORTS_OR_QUERY = False
+# parts of the search pages find reads
+RESULT_COUNT = SoupStrainer("label")
+RESULT_TABLES = SoupStrainer("table", attrs={"class": "table_list"})
 
 logger = logging.getLogger(__name__)
 
 
-def find(query, existing):
-  data = {}
+def find(query, existing, since=None, start_page=1):
+  """
+  Yield every trial matching `query`, and a checkpoint.PageDone after each
+  results page, starting with `start_page`. The search form has no
+  registration date filter, so `since` is ignored.
+  """
   count = 0
   url = QUERY_URL.format(BASE_URL=BASE_URL, query=query)
 
-  page = requests.get(url)
+  page = client.get(url)
 
   if page.status_code == 200:
-    soup = BeautifulSoup(page.content, 'html.parser')
-
-    results_number = soup.findAll("label")
+    results_number = soup.make_soup(page.content,
+                                    only=RESULT_COUNT).findAll("label")
     num_pages = 0 if len(results_number) == 0 else int(
         re.findall('[0-9]+', str(results_number[0]))[1])
 
-    for page_num in range(1, num_pages + 1):
+    for page_num in range(start_page, num_pages + 1):
       url = QUERY_URL.format(
           BASE_URL=BASE_URL,
           query=query) + PAGINATE_QUERY.format(page_num=page_num)
       try:
-        page = requests.get(url)
+        page = client.get(url)
         if page.status_code == 200:
-          soup = BeautifulSoup(page.content, 'html.parser')
-          records = soup.findAll("table", {"class": "table_list"})
+          records = soup.make_soup(page.content, only=RESULT_TABLES).findAll(
+              "table", {"class": "table_list"})
           for result in records:
             trials = result.find_all('tr', {'class': ''})
             for trial in trials:
@@ -79,7 +88,7 @@ def find(query, existing):
                     'timestamp': date
                 }
 
-                data[url] = info
+                yield info
                 count += 1
               except Exception as e:
                 logger.error(f"[URL: {url}] {e}")
@@ -87,13 +96,12 @@ def find(query, existing):
             logger.info(
                 f'Page {page_num} out of {num_pages} fetched {len(trials)} results for {query}'
             )
+          yield checkpoint.PageDone(page_num)
       except Exception as e:
         logger.error(f"[Page: {page_num}, URL: {url}] {e}")
 
   logger.info(f"Fetched {count} results for {query}")
 
-  return data
-
 
 def translate(info):
   return info
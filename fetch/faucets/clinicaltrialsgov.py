@@ -14,32 +14,70 @@
 
 import feedparser
 import os
+import json
 import utils
-import requests
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from dateutil import parser
 from datetime import datetime, timezone
-from bs4 import BeautifulSoup
+from bs4 import SoupStrainer
 import re
 import sys
 import logging
+from functools import partial
+
+from crawler import client, soup, parsing
 
 SOURCE = "clinicaltrials.gov"
 FILENAME = "clinicaltrialsgov.json"
-POSTED_WITHIN_DAYS = (datetime.now() -
-                      datetime(2019, 12, 1)).days  # posted December 1, 2019
+BASE_URL = "https://clinicaltrials.gov"
+START_DATE = datetime(2019, 12, 1)
 STATUS_INDICATORS = ["|", "/", "-", "\\"]
 
+# both the RSS feed's cond= and the API's expr= accept "a OR b"
+SUPPORTS_OR_QUERY = True
+
+# detail pages requested at once
+MAX_IN_FLIGHT = 8
+# the labelled rows are all parse_record reads of a record page
+RECORD_ROWS = SoupStrainer("tr")
+# "scrape" reads the RSS feed and one record page per trial, "records" reads
+# whole study records from the full_studies API, STUDIES_PAGE_SIZE at a time
+MODE = os.environ.get("FETCH_CTGOV_MODE", "scrape")
+STUDIES_PAGE_SIZE = 100  # the most the API returns per request
+# find is list_details followed by fetch_details, so the work queue can
+# spread a listing's detail pages over its workers
+SPLITS_DETAILS = MODE == "scrape"
+
 logger = logging.getLogger(__name__)
 
 
-def find(term, existing):
-  data = {}
+def get_scrape_url(trial_id):
+  return f"{BASE_URL}/ct2/show/record/{trial_id}"
+
+
+def find(term, existing, since=START_DATE, max_in_flight=MAX_IN_FLIGHT):
+  """
+  Yield the info of every trial matching `term` received since `since`.
+  """
+  if MODE == "records":
+    yield from find_records(term, existing, since)
+    return
+
+  infos = list_details(term, existing, since)
+  yield from fetch_details(infos, max_in_flight=max_in_flight)
+
 
-  logger.info(f"Fetching data for last {POSTED_WITHIN_DAYS} days...")
+def list_details(term, existing, since=START_DATE):
+  """
+  Return the info of every trial matching `term` received since `since`,
+  before its record page is read.
+  """
+  # first received within this many days, counting today
+  received_within_days = (datetime.now() - since).days + 1
+  logger.info(f"Fetching data for last {received_within_days} days...")
 
-  url = f"https://clinicaltrials.gov/ct2/results/rss.xml?rcv_d={POSTED_WITHIN_DAYS}&cond={term}&count=10000"
-  get_scrape_url = (
-      lambda trialID: f"https://clinicaltrials.gov/ct2/show/record/{trialID}")
+  url = f"{BASE_URL}/ct2/results/rss.xml?rcv_d={received_within_days}&cond={term}&count=10000"
 
   # feed keys:
   # feed
@@ -51,11 +89,11 @@ def find(term, existing):
   # encoding
   # version
   # namespaces
-  feed = feedparser.parse(url)
-  total = len(feed["entries"])
-  logger.info(f"Fetched {total} results for {term}. Parsing...")
+  feed = feedparser.parse(client.get(url).content)
+  logger.info(f"Fetched {len(feed['entries'])} results for {term}. Parsing...")
 
-  for idx, entry in enumerate(feed["entries"]):
+  infos = []
+  for entry in feed["entries"]:
     identifier = entry["id"]
 
     url = entry["link"]
@@ -66,58 +104,267 @@ def find(term, existing):
       continue
     existing.add(url)
 
-    scrape_url = get_scrape_url(identifier)
+    infos.append({
+        "_source": SOURCE,
+        "_id": identifier,
+        "url": url,
+        "scrape_url": get_scrape_url(identifier),
+    })
+
+  return infos
+
+
+def fetch_details(infos, max_in_flight=MAX_IN_FLIGHT):
+  """
+  Yield every info of `list_details` with its record page's fields added.
+  Trials whose page can't be fetched or parsed are logged and left out.
+  """
+  count = 0
+  total = len(infos)
+  # downloads keep going while earlier pages are parsed in other processes
+  pages = scrape_pages(infos, max_in_flight=max_in_flight)
+  records = parsing.parse_each(pages, parse_record)
+  for idx, (info, record) in enumerate(records):
     try:
-      scrape_page = requests.get(scrape_url)
-      if scrape_page.status_code != 200:
+      if isinstance(record, Exception):
+        raise record
+      if record is None:
         continue
 
-      soup = BeautifulSoup(scrape_page.content, "html.parser")
-      info = {
-          "_source": SOURCE,
-          "_id": identifier,
-          "url": url,
-          "scrape_url": scrape_url,
-      }
-      for th in soup.find_all("th", attrs={"class": "tr-rowHeader"}):
-        label = th.get_text()
-        if not label:
-          continue
-
-        # remove ICMJE
-        key = label.replace("ICMJE", "")
-        # remove asterisks
-        key = key.replace("*", "")
-        # remove parentheticals
-        key = re.sub(r"\(.*\)", "", key)
-        # remove multi-whitespace
-        key = re.sub("\s\s+", " ", key)
-        # strip
-        key = key.strip()
-
-        td = th.find_next_sibling()
-
-        value = td.get_text().strip()
-        # if "Not Provided", set empty string (None causes errors, empty string is fine)
-        if value == "Not Provided":
-          value = ""
-
-        info[key] = value
-
-      data[url] = info
+      info.update(record)
+      yield info
+      count += 1
       sys.stdout.write(
           f"  {STATUS_INDICATORS[idx % len(STATUS_INDICATORS)]} Parsed {idx + 1} of {total}. {total - idx - 1} left \r"
       )
       sys.stdout.flush()
     except Exception as e:
-      logger.error(f"[ID: {identifier}, URL: {url}] {e}")
+      logger.error(f"[ID: {info['_id']}, URL: {info['url']}] {e}")
       continue
 
   sys.stdout.write("                               \r")
   sys.stdout.flush()
-  logger.info(f"Parsed {len(data)} results")
+  logger.info(f"Parsed {count} results")
+
+
+def find_records(term, existing, since=START_DATE, directory=None):
+  """
+  Yield the info of every trial matching `term` received since `since`,
+  built from the API's study records instead of the record pages. With a
+  `directory`, the saved full_studies responses in it are read instead and
+  `term` and `since` are ignored.
+  """
+  count = 0
+  if directory:
+    pages = read_study_pages(directory)
+  else:
+    pages = get_study_pages(term, since)
+
+  for page in pages:
+    for study in page["FullStudiesResponse"].get("FullStudies", []):
+      try:
+        info = parse_study(study["Study"])
+      except Exception as e:
+        logger.error(f"[Rank: {study.get('Rank')}] {e}")
+        continue
+
+      # skip duplicates
+      if info["url"] in existing:
+        continue
+      existing.add(info["url"])
+
+      yield info
+      count += 1
+
+  logger.info(f"Parsed {count} study records for {term}")
+
+
+def get_study_pages(term, since=START_DATE):
+  """
+  Yield every full_studies response for `term` first submitted since
+  `since`.
+  """
+  expr = f"AREA[ConditionSearch]({term}) AND AREA[StudyFirstSubmitDate]RANGE[{since.strftime('%m/%d/%Y')}, MAX]"
+  min_rank = 1
+  while True:
+    response = client.get(
+        f"{BASE_URL}/api/query/full_studies",
+        params={
+            "expr": expr,
+            "min_rnk": min_rank,
+            "max_rnk": min_rank + STUDIES_PAGE_SIZE - 1,
+            "fmt": "json",
+        },
+    )
+    response.raise_for_status()
+    page = response.json()
+    yield page
+
+    found = page["FullStudiesResponse"]["NStudiesFound"]
+    min_rank += STUDIES_PAGE_SIZE
+    logger.info(
+        f"Fetched {min(min_rank - 1, found)} of {found} study records for {term}"
+    )
+    if min_rank > found:
+      return
+
+
+def read_study_pages(directory):
+  """
+  Yield the full_studies responses saved as .json files in `directory`.
+  """
+  for name in sorted(os.listdir(directory)):
+    if name.endswith(".json"):
+      with open(os.path.join(directory, name)) as f:
+        yield json.load(f)
+
+
+def parse_study(study):
+  """
+  Return a study record's fields under the labels parse_record reads off
+  its record page, so translate handles both the same way.
+  """
+  protocol = study["ProtocolSection"]
+  identification = protocol["IdentificationModule"]
+  status = protocol.get("StatusModule", {})
+  sponsors = protocol.get("SponsorCollaboratorsModule", {})
+  description = protocol.get("DescriptionModule", {})
+  conditions = protocol.get("ConditionsModule", {})
+  interventions = protocol.get("ArmsInterventionsModule", {})
+  eligibility = protocol.get("EligibilityModule", {})
+  design = protocol.get("DesignModule", {})
+  locations = protocol.get("ContactsLocationsModule", {})
+
+  trial_id = identification["NCTId"]
+  info = {
+      "_source": SOURCE,
+      "_id": trial_id,
+      "url": f"{BASE_URL}/ct2/show/{trial_id}",
+      "Brief Title": identification.get("BriefTitle", ""),
+      "Recruitment Status": status.get("OverallStatus", ""),
+      "First Submitted Date": status.get("StudyFirstSubmitDate", ""),
+      "Sex/Gender": eligibility.get("Gender", ""),
+      "Brief Summary": description.get("BriefSummary", ""),
+  }
+  if identification.get("OfficialTitle"):
+    info["Official Title"] = identification["OfficialTitle"]
+  first_posted = status.get("StudyFirstPostDateStruct", {})
+  if first_posted.get("StudyFirstPostDate"):
+    info["First Posted Date"] = first_posted["StudyFirstPostDate"]
+  if description.get("DetailedDescription"):
+    info["Detailed Description"] = description["DetailedDescription"]
+
+  # one per line, like on the record page
+  info["Condition"] = "\n".join(
+      conditions.get("ConditionList", {}).get("Condition", []))
+  info["Intervention"] = "\n".join(
+      f"{i.get('InterventionType')}: {i.get('InterventionName')}"
+      for i in interventions.get("InterventionList", {}).get(
+          "Intervention", []))
+  countries = [
+      location.get("LocationCountry")
+      for location in locations.get("LocationList", {}).get("Location", [])
+  ]
+  info["Listed Location Countries"] = "\n".join(
+      sorted(set(filter(None, countries))))
+
+  lead_sponsor = sponsors.get("LeadSponsor", {}).get("LeadSponsorName", "")
+  info["Study Sponsor"] = lead_sponsor
+  responsible = sponsors.get("ResponsibleParty", {})
+  info["Responsible Party"] = responsible.get(
+      "ResponsiblePartyInvestigatorFullName", lead_sponsor)
+
+  enrollment = design.get("EnrollmentInfo", {})
+  # the record page only labels anticipated enrollment as "Estimated"
+  if enrollment.get("EnrollmentType") == "Anticipated":
+    info["Estimated Enrollment"] = enrollment.get("EnrollmentCount", "")
+  elif enrollment.get("EnrollmentCount"):
+    info["Actual Enrollment"] = enrollment["EnrollmentCount"]
+
+  return info
+
+
+def scrape_pages(infos, max_in_flight=MAX_IN_FLIGHT):
+  """
+  Fetch the `scrape_url` of every info with at most `max_in_flight` requests
+  open at once, yielding (info, response) in the order they finish. If a page
+  still fails after all retries, the exception is yielded in its place.
+  """
+  if not infos:
+    return
+
+  loop = asyncio.new_event_loop()
+  asyncio.set_event_loop(loop)
+  semaphore = asyncio.Semaphore(max_in_flight)
+  executor = ThreadPoolExecutor(max_workers=max_in_flight)
+
+  async def scrape(info):
+    try:
+      return info, await fetch_page(info["scrape_url"], semaphore, executor)
+    except Exception as e:
+      return info, e
+
+  pending = {loop.create_task(scrape(info)) for info in infos}
+  try:
+    while pending:
+      done, pending = loop.run_until_complete(
+          asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED))
+      for task in done:
+        yield task.result()
+  finally:
+    # only left over if the caller stopped iterating early
+    for task in pending:
+      task.cancel()
+    if pending:
+      loop.run_until_complete(asyncio.wait(pending))
+    executor.shutdown(wait=False)
+    asyncio.set_event_loop(None)
+    loop.close()
+
+
+async def fetch_page(url, semaphore, executor):
+  """
+  GET `url` through the shared client from a worker thread, holding one of
+  the in-flight slots while the request (and any of its retries) runs.
+  """
+  loop = asyncio.get_event_loop()
+  async with semaphore:
+    return await loop.run_in_executor(executor,
+                                      partial(client.get, url, use_cache=True))
+
+
+def parse_record(content):
+  """
+  Return every labelled row of a trial's record page as {label: value}.
+  """
+  info = {}
+  page = soup.make_soup(content, only=RECORD_ROWS)
+  for th in page.find_all("th", attrs={"class": "tr-rowHeader"}):
+    label = th.get_text()
+    if not label:
+      continue
+
+    # remove ICMJE
+    key = label.replace("ICMJE", "")
+    # remove asterisks
+    key = key.replace("*", "")
+    # remove parentheticals
+    key = re.sub(r"\(.*\)", "", key)
+    # remove multi-whitespace
+    key = re.sub("\s\s+", " ", key)
+    # strip
+    key = key.strip()
+
+    td = th.find_next_sibling()
+
+    value = td.get_text().strip()
+    # if "Not Provided", set empty string (None causes errors, empty string is fine)
+    if value == "Not Provided":
+      value = ""
+
+    info[key] = value
 
-  return data
+  return info
 
 
 def translate(info):
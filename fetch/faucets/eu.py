@@ -12,35 +12,99 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from bs4 import BeautifulSoup
+from bs4 import SoupStrainer
 import requests
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 import utils
 import re
-import time
 import logging
 import os
+from datetime import datetime
+
+from crawler import client, soup, parsing, checkpoint
 
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
 SOURCE = "clinicaltrialsregister.eu"
 FILENAME = "eu.json"
 BASE_URL = "https://www.clinicaltrialsregister.eu"
-QUERY_URL = "{BASE_URL}/ctr-search/search?query={query}&dateFrom=2019-12-01"
+QUERY_URL = "{BASE_URL}/ctr-search/search?query={query}&dateFrom={date_from}"
 PAGINATE_QUERY = "&page={page_num}"
+START_DATE = datetime(2019, 12, 1)
+# the register's search accepts "a OR b"
+SUPPORTS_OR_QUERY = True
+# requests per second against the register, listing and detail pages alike
+RATE_LIMIT = 2
+
+# subject counts on a protocol page, from the whole trial to one country
+SAMPLE_SIZE_LABELS = [
+    "In the whole clinical trial",
+    "In the EEA",
+    "In the member state",
+]
+# the country codes that end the links to each country's copy of a protocol
+COUNTRY_NAMES = {
+    "AT": "Austria",
+    "BE": "Belgium",
+    "BG": "Bulgaria",
+    "CY": "Cyprus",
+    "CZ": "Czechia",
+    "DE": "Germany",
+    "DK": "Denmark",
+    "EE": "Estonia",
+    "ES": "Spain",
+    "FI": "Finland",
+    "FR": "France",
+    "GB": "United Kingdom",
+    "GR": "Greece",
+    "HR": "Croatia",
+    "HU": "Hungary",
+    "IE": "Ireland",
+    "IS": "Iceland",
+    "IT": "Italy",
+    "LI": "Liechtenstein",
+    "LT": "Lithuania",
+    "LU": "Luxembourg",
+    "LV": "Latvia",
+    "MT": "Malta",
+    "NL": "Netherlands",
+    "NO": "Norway",
+    "PL": "Poland",
+    "PT": "Portugal",
+    "RO": "Romania",
+    "SE": "Sweden",
+    "SI": "Slovenia",
+    "SK": "Slovakia",
+    "3RD": "Outside EU/EEA",
+}
+# a result table's link to one country's protocol, as opposed to the links
+# to the trial's results or to other pages
+PROTOCOL_LINK = re.compile(
+    r"^/ctr-search/trial/(\d{4}-\d{6}-\d{2})/([A-Z]{2}|3RD)$")
+# parts of the pages find and parse_protocol read
+PAGE_LINKS = SoupStrainer("a", href=True)
+RESULT_TABLES = SoupStrainer("table", attrs={"class": "result"})
+PROTOCOL_ROWS = SoupStrainer("tr")
+
+client.set_rate_limit(BASE_URL, RATE_LIMIT)
 
 logger = logging.getLogger(__name__)
 
 
-def find(query, existing):
-  data = {}
+def find(query, existing, since=START_DATE, start_page=0):
+  """
+  Yield every trial matching `query` registered since `since`, and a
+  checkpoint.PageDone after each results page, starting with `start_page`.
+  """
   count = 0
-  url = QUERY_URL.format(BASE_URL=BASE_URL, query=query)
-  page = requests.get(url, verify=False)
+  date_from = since.strftime("%Y-%m-%d")
+  url = QUERY_URL.format(BASE_URL=BASE_URL, query=query, date_from=date_from)
+  page = client.get(url, verify=False)
   if page.status_code == 200:
-    soup = BeautifulSoup(page.content, "html.parser")
-
-    links = [link.get("href") for link in soup.findAll("a", href=True)]
+    links = [
+        link.get("href") for link in soup.make_soup(
+            page.content, only=PAGE_LINKS).findAll("a", href=True)
+    ]
 
     page_links = [int(link.split("=")[1]) for link in links if "&page" in link]
 
@@ -49,146 +113,173 @@ def find(query, existing):
     else:
       num_pages = max(page_links)
 
-    for page_num in range(num_pages):
+    for page_num in range(start_page, num_pages):
       url = QUERY_URL.format(
-          BASE_URL=BASE_URL,
-          query=query) + PAGINATE_QUERY.format(page_num=page_num)
-      time.sleep(1)
-      page = requests.get(url, verify=False)
+          BASE_URL=BASE_URL, query=query,
+          date_from=date_from) + PAGINATE_QUERY.format(page_num=page_num)
+      page = client.get(url, verify=False)
       if page.status_code == 200:
-        soup = BeautifulSoup(page.content, "html.parser")
-
-        result_tables = soup.findAll("table", {"class": "result"})
+        result_tables = soup.make_soup(page.content,
+                                       only=RESULT_TABLES).findAll(
+                                           "table", {"class": "result"})
 
         for result in result_tables:
-          links = result.findAll("a", href=True)
+          links = [
+              PROTOCOL_LINK.match(link.get("href"))
+              for link in result.findAll("a", href=True)
+          ]
+          links = [link for link in links if link]
 
           spans = result.findAll("span", {"class": "label"})
 
           next_siblings = [span.next_sibling.strip() for span in spans]
 
+          eudract_number = next_siblings[0]
           date = next_siblings[2]
           if "Information" in date:
             date = None
           title = next_siblings[4]
 
-          # looks like some studies are done for multiple countries
-          for i in range(len(links)):
-            link = links[i]
-            country = link.text
-            link = link.get("href")
-
-            url = f"{BASE_URL}{link}"
-
-            # skip duplicates
-            if url in existing:
-              continue
-            existing.add(url)
-
-            page = requests.get(url, verify=False)
-            if page.status_code == 200:
-              soup = BeautifulSoup(page.content, "html.parser")
-
-              try:
-                intervention = None
-                sponsor = None
-                main_objective = None
-                secondary_objectives = None
-                location = None
-                institution = None
-                contact_email = None
-                contact_street_address = None
-                contact_town_city = None
-                contact_country = None
-                sample_size = None
-
-                td_second = soup.findAll("td", {"class": "second"})
-                elems = [a.text.strip() for a in td_second]
-                for a in td_second:
-                  if (a.text.strip() ==
-                      "Medical condition(s) being investigated"):
-                    target_disease = a.next_sibling.find("td").text
-                  if a.text.strip() == "Female":
-                    female = a.next_sibling.text.strip() == "Yes"
-                  if a.text.strip() == "Male":
-                    male = a.next_sibling.text.strip() == "Yes"
-                  if a.text.strip() == "Trade name":
-                    intervention = a.next_sibling.text
-                  if a.text.strip() == "Product name":
-                    intervention = a.next_sibling.text
-                  if a.text.strip() == "Name of Sponsor":
-                    sponsor = a.next_sibling.text
-                  if a.text.strip() == "Main objective of the trial":
-                    main_objective = a.next_sibling.find("td").text
-                  if (a.text.strip() == "Secondary objectives of the trial"):
-                    secondary_objectives = a.next_sibling.find("td").text
-                  if a.text.strip() == "Country":
-                    location = a.next_sibling.text
-                  if a.text.strip() == "Name of organisation":
-                    institution = a.next_sibling.text
-                  if a.text.strip() == "E-mail":
-                    contact_email = a.next_sibling.text
-                  if a.text.strip() == "Street Address":
-                    contact_street_address = a.next_sibling.text
-                  if a.text.strip() == "Town/ city":
-                    contact_town_city = a.next_sibling.text
-                  if a.text.strip() == "Country":
-                    contact_country = a.next_sibling.text
-
-                  # none if 0 or can't parse
-                  try:
-                    if a.text.strip() in [
-                        "In the member state",
-                        "In the EEA",
-                        "In the whole clinical trial",
-                    ]:
-                      sample_size = (int(a.next_sibling.text) or None)
-                  except:
-                    sample_size = None
-
-                sex = []
-
-                if male:
-                  sex.append("MALE")
-                if female:
-                  sex.append("FEMALE")
-
-                contact = {
-                    "email":
-                    contact_email,
-                    "address":
-                    f"{contact_street_address}, {contact_town_city}, {contact_country}",
-                }
-
-                this_entry = {
-                    "_source": SOURCE,
-                    "url": url,
-                    "title": title,
-                    "timestamp": date,
-                    "recruiting_status": "",
-                    "sex": sex,
-                    "target_disease": target_disease,
-                    "intervention": intervention,
-                    "sponsor": sponsor,
-                    "summary": f"{main_objective}\n{secondary_objectives}",
-                    "location": location,
-                    "institution": institution,
-                    "contact": contact,
-                    "abandoned": None,
-                    "sample_size": sample_size,
-                }
-
-                data[url] = this_entry
-                count += 1
-              except Exception as e:
-                logger.error(f"[URL: {url}] {e}")
+          # one link per country the trial runs in, each to that country's
+          # copy of the same protocol, so only the first one is fetched
+          urls = [f"{BASE_URL}{link.group(0)}" for link in links]
+          countries = [link.group(2) for link in links]
+          if not urls:
+            continue
+          url = urls[0]
+
+          # skip duplicates
+          if url in existing:
+            continue
+          existing.update(urls)
+
+          page = client.get(url, verify=False, use_cache=True)
+          if page.status_code == 200:
+            try:
+              protocol = parsing.parsed(page, parse_protocol)
+
+              this_entry = {
+                  "_source": SOURCE,
+                  "url": url,
+                  "title": title,
+                  "timestamp": date,
+                  "recruiting_status": "",
+                  "abandoned": None,
+                  **protocol,
+                  "location": get_location(countries) or protocol["location"],
+                  # stored by earlier crawls, which saved every country
+                  "replaces": urls[1:],
+              }
+
+              yield this_entry
+              count += 1
+            except Exception as e:
+              logger.error(f"[EudraCT: {eudract_number}, URL: {url}] {e}")
 
         logger.info(
             f"Page {page_num + 1} out of {num_pages} fetched for {query}")
+        yield checkpoint.PageDone(page_num)
 
   logger.info(f"Fetched {count} results for {query}")
 
-  return data
+
+def get_location(countries):
+  """
+  Return the names of the countries a trial's protocol links are for.
+  """
+  names = []
+  for country in countries:
+    name = COUNTRY_NAMES.get(country, country)
+    if name and name not in names:
+      names.append(name)
+  return ", ".join(names)
+
+
+def parse_protocol(content):
+  """
+  Return the fields read from a trial's protocol page.
+  """
+  page = soup.make_soup(content, only=PROTOCOL_ROWS)
+
+  intervention = None
+  sponsor = None
+  main_objective = None
+  secondary_objectives = None
+  location = None
+  institution = None
+  contact_email = None
+  contact_street_address = None
+  contact_town_city = None
+  contact_country = None
+  sample_size = None
+
+  sample_sizes = {}
+  for a in page.findAll("td", {"class": "second"}):
+    label = a.text.strip()
+    value = a.next_sibling
+    if label == "Medical condition(s) being investigated":
+      target_disease = value.find("td").text
+    elif label == "Female":
+      female = value.text.strip() == "Yes"
+    elif label == "Male":
+      male = value.text.strip() == "Yes"
+    elif label in ["Trade name", "Product name"]:
+      intervention = value.text
+    elif label == "Name of Sponsor":
+      sponsor = value.text
+    elif label == "Main objective of the trial":
+      main_objective = value.find("td").text
+    elif label == "Secondary objectives of the trial":
+      secondary_objectives = value.find("td").text
+    elif label == "Country":
+      location = value.text
+      contact_country = value.text
+    elif label == "Name of organisation":
+      institution = value.text
+    elif label == "E-mail":
+      contact_email = value.text
+    elif label == "Street Address":
+      contact_street_address = value.text
+    elif label == "Town/ city":
+      contact_town_city = value.text
+    elif label in SAMPLE_SIZE_LABELS:
+      # none if 0 or can't parse
+      try:
+        sample_sizes[label] = int(value.text) or None
+      except:
+        sample_sizes[label] = None
+
+  # the widest count the page gives, as one record stands for every country
+  for label in SAMPLE_SIZE_LABELS:
+    if sample_sizes.get(label):
+      sample_size = sample_sizes[label]
+      break
+
+  sex = []
+
+  if male:
+    sex.append("MALE")
+  if female:
+    sex.append("FEMALE")
+
+  contact = {
+      "email":
+      contact_email,
+      "address":
+      f"{contact_street_address}, {contact_town_city}, {contact_country}",
+  }
+
+  return {
+      "sex": sex,
+      "target_disease": target_disease,
+      "intervention": intervention,
+      "sponsor": sponsor,
+      "summary": f"{main_objective}\n{secondary_objectives}",
+      "location": location,
+      "institution": institution,
+      "contact": contact,
+      "sample_size": sample_size,
+  }
 
 
 def translate(info):
@@ -13,19 +13,24 @@
 # limitations under the License.
 
 import xml.etree.ElementTree as ET
-import requests
 import utils
 import logging
 import json
 import os
 from pprint import pprint
 from itertools import groupby
-from bs4 import BeautifulSoup, NavigableString
+from bs4 import NavigableString
 import re
+from datetime import datetime
+
+from crawler import client, soup, parsing
 
 SOURCE = "isrctn.com"
 FILENAME = "isrctn.json"
-API_URL = "http://www.isrctn.com/api/query/format/who?q={query}&dateAssigned%20GT%202019-12-01"
+API_URL = "http://www.isrctn.com/api/query/format/who?q={query}&dateAssigned%20GT%20{date_assigned}"
+START_DATE = datetime(2019, 12, 1)
+# crawled once per search term, see fetch.get_queries
+SUPPORTS_OR_QUERY = False
 
 logger = logging.getLogger(__name__)
 
@@ -38,15 +43,14 @@ def to_iso8601(date):
     return None
 
 
-def find(query, existing):
-  data = {}
+def find(query, existing, since=START_DATE):
+  """
+  Yield every trial matching `query` assigned an ISRCTN since `since`.
+  """
   count = 0
-  url = API_URL.format(query=query)
-  results = requests.get(url).text
-
-  root = ET.fromstring(results)
-
-  for trial in root.iter("trial"):
+  url = API_URL.format(query=query,
+                       date_assigned=since.strftime("%Y-%m-%d"))
+  for trial in iter_trials(url):
     this_entry = {"_source": SOURCE}
     main = trial.find("main")
     trial_id = main.find("trial_id").text
@@ -137,46 +141,13 @@ def find(query, existing):
       recruiting_status = None
       try:
         if url:
-          scrape_page = requests.get(url)
+          scrape_page = client.get(url, use_cache=True)
           if scrape_page.status_code == 200:
-            soup = BeautifulSoup(scrape_page.content, "html.parser")
-
-            def get_info_for_section_title(
-                title,
-                title_tag="h3",
-                title_class="Info_section_title",
-                next_tag="p",
-            ):
-              tag = soup.find(
-                  title_tag,
-                  attrs={"class": title_class},
-                  text=re.compile(title),
-              )
-              container_tag = tag.find_next_sibling(next_tag)
-              # container_tag contains `NavigableString`s potentially separated by <br> tags
-              if container_tag:
-                parts = []
-                for e in container_tag.children:
-                  if isinstance(e, NavigableString) and len(e):
-                    # replace all whitespace with single space
-                    parts.append(re.sub(r"\s+", " ", e).strip())
-                if len(parts):
-                  return "\n".join(parts).strip()
-
-            ### GET INFO
-            intervention = get_info_for_section_title("Intervention")
-            institution = get_info_for_section_title(
-                "Trial participating centre")
-
-            status_context = dict(
-                title_tag="dt",
-                title_class="Meta_name u-eta",
-                next_tag="dd",
-            )
-            overall_status = get_info_for_section_title("Overall trial status",
-                                                        **status_context)
-            recruiting_status = get_info_for_section_title(
-                "Recruitment status", **status_context)
+            details = parsing.parsed(scrape_page, parse_details)
+            intervention = details["intervention"]
+            institution = details["institution"]
+            overall_status = details["overall_status"]
+            recruiting_status = details["recruiting_status"]
       except Exception as e:
         logger.error(f"[ID: {trial_id}, URL: {url}] {e}")
 
@@ -194,14 +165,81 @@ def find(query, existing):
       this_entry["institution"] = institution
       this_entry["location"] = country
 
-      data[url] = this_entry
+      yield this_entry
       count += 1
       # pprint(this_entry)
     except Exception as e:
       logger.error(f"[ID: {trial_id}, URL: {url}] {e}")
 
   print(f"Fetched {count} results for {query}")
-  return data
+
+
+def iter_trials(url):
+  """
+  Stream the WHO-format feed at `url`, yielding every <trial> element as soon
+  as it is parsed. Each one is cleared once the caller asks for the next, so
+  only one trial is held in memory at a time.
+  """
+  with client.get(url, stream=True) as response:
+    response.raise_for_status()
+    # let urllib3 undo any gzip content encoding
+    response.raw.decode_content = True
+    events = ET.iterparse(response.raw, events=("start", "end"))
+    _, root = next(events)
+    for event, element in events:
+      if event == "end" and element.tag == "trial":
+        yield element
+        root.clear()
+
+
+def parse_details(content):
+  """
+  Return the fields only shown on a trial's ISRCTN page.
+  """
+  # section titles are matched to the next tag among their siblings, so the
+  # whole tree is needed
+  page = soup.make_soup(content)
+
+  def get_info_for_section_title(
+      title,
+      title_tag="h3",
+      title_class="Info_section_title",
+      next_tag="p",
+  ):
+    tag = page.find(
+        title_tag,
+        attrs={"class": title_class},
+        text=re.compile(title),
+    )
+    if not tag:
+      return None
+    container_tag = tag.find_next_sibling(next_tag)
+    # container_tag contains `NavigableString`s potentially separated by <br> tags
+    if container_tag:
+      parts = []
+      for e in container_tag.children:
+        if isinstance(e, NavigableString) and len(e):
+          # replace all whitespace with single space
+          parts.append(re.sub(r"\s+", " ", e).strip())
+      if len(parts):
+        return "\n".join(parts).strip()
+
+  ### GET INFO
+  status_context = dict(
+      title_tag="dt",
+      title_class="Meta_name u-eta",
+      next_tag="dd",
+  )
+  return {
+      "intervention":
+      get_info_for_section_title("Intervention"),
+      "institution":
+      get_info_for_section_title("Trial participating centre"),
+      "overall_status":
+      get_info_for_section_title("Overall trial status", **status_context),
+      "recruiting_status":
+      get_info_for_section_title("Recruitment status", **status_context),
+  }
 
 
 def translate(info):
@@ -0,0 +1,191 @@
+# Copyright 2020 The Feverbase Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+
+from pymongo import UpdateOne
+
+from utils import db
+from utils.config import FILTER_OPTION_KEYS
+
+logger = logging.getLogger(__name__)
+
+
+def get_article_values(key, match=None):
+  """
+  Return {lowercased: value} of the distinct values of `key` among the
+  Articles matching `match`, keeping the case used by the newest article.
+  """
+  pipeline = [
+      {
+          "$match": {
+              **(match or {}), key: {
+                  "$nin": [None, ""]
+              }
+          }
+      },
+      {
+          "$sort": {
+              "timestamp": -1
+          }
+      },
+      {
+          "$group": {
+              "_id": {
+                  "$toLower": f"${key}"
+              },
+              "value": {
+                  "$first": f"${key}"
+              },
+          }
+      },
+  ]
+  docs = db.Article._get_collection().aggregate(pipeline, allowDiskUse=True)
+  return {doc["_id"]: doc["value"] for doc in docs}
+
+
+def lowered_in(field, values):
+  """
+  Return a $match for documents whose `field` lowercased is one of `values`
+  lowercased. Both sides are lowercased by Mongo: $toLower only folds ASCII
+  letters, unlike str.lower(), so mixing the two misses non-ASCII values.
+  """
+  return {
+      "$expr": {
+          "$or": [{
+              "$eq": [{
+                  "$toLower": f"${field}"
+              }, {
+                  "$toLower": {
+                      "$literal": value
+                  }
+              }]
+          } for value in values]
+      }
+  }
+
+
+def get_option_values(key, match=None):
+  """
+  Return {lowercased: [(id, value)]} of the stored FilterOptions for `key`
+  matching `match`.
+  """
+  pipeline = [
+      {
+          "$match": {
+              **(match or {}), "key": key
+          }
+      },
+      {
+          "$project": {
+              "value": 1,
+              "lowered": {
+                  "$toLower": "$value"
+              }
+          }
+      },
+  ]
+  options = {}
+  for doc in db.FilterOption._get_collection().aggregate(pipeline):
+    options.setdefault(doc["lowered"], []).append((doc["_id"], doc["value"]))
+  return options
+
+
+def apply(key, inserts, deletes):
+  """
+  Insert the new values before deleting the old option ids, so a key's
+  options never disappear from the dropdowns in between.
+  """
+  collection = db.FilterOption._get_collection()
+  if inserts:
+    collection.bulk_write(
+        [
+            UpdateOne({
+                "key": key,
+                "value": value
+            }, {"$set": {
+                "key": key,
+                "value": value
+            }},
+                      upsert=True) for value in inserts
+        ],
+        ordered=False,
+    )
+  if deletes:
+    collection.delete_many({"_id": {"$in": deletes}})
+  logger.info(
+      f"[{key}] Added {len(inserts)} and removed {len(deletes)} filter options")
+
+
+def rebuild(key):
+  """
+  Make the options for `key` exactly the distinct values of all Articles.
+  """
+  wanted = get_article_values(key)
+  options = get_option_values(key)
+
+  inserts = []
+  deletes = []
+  for lowered, value in wanted.items():
+    stored = options.get(lowered, [])
+    if value not in [v for _, v in stored]:
+      inserts.append(value)
+  for lowered, stored in options.items():
+    for _id, value in stored:
+      # also drops other-case duplicates of a value we keep
+      if wanted.get(lowered) != value:
+        deletes.append(_id)
+  apply(key, inserts, deletes)
+
+
+def update(key, changes):
+  """
+  Add options for the values of the Articles in `changes`, and remove
+  options for the values those Articles had before if no Article uses them
+  anymore.
+  """
+  urls = list(changes.added | changes.changed)
+  options = get_option_values(key)
+
+  inserts = []
+  if urls:
+    new_values = get_article_values(key, {"url": {"$in": urls}})
+    inserts = [
+        value for lowered, value in new_values.items()
+        if lowered not in options
+    ]
+
+  deletes = []
+  previous = changes.previous_values.get(key)
+  if previous:
+    still_used = get_article_values(key, lowered_in(key, previous))
+    candidates = get_option_values(key, lowered_in("value", previous))
+    for lowered, stored in candidates.items():
+      if lowered not in still_used:
+        deletes += [_id for _id, _ in stored]
+  apply(key, inserts, deletes)
+
+
+def preload_filter_options(changes=None):
+  """
+  Keep the FilterOption collection in line with the Articles' values for
+  FILTER_OPTION_KEYS (compared case-insensitively). Without `changes` the
+  options are rebuilt from every Article; with an ingest.ChangeSet only the
+  Articles it lists are looked at.
+  """
+  for key in FILTER_OPTION_KEYS:
+    if changes is None:
+      rebuild(key)
+    elif changes:
+      update(key, changes)
@@ -0,0 +1,126 @@
+# Copyright 2020 The Feverbase Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+import logging
+from collections import defaultdict
+
+from utils import db, location
+from utils.config import FILTER_OPTION_KEYS
+
+# a full crawl that would remove more than this share of a source's articles
+# is assumed to have been cut short by the registry, and removes nothing
+MAX_REMOVED_FRACTION = 0.1
+
+logger = logging.getLogger(__name__)
+
+
+class ChangeSet:
+  """
+  URLs of the articles a fetch run added, changed or removed, for the steps
+  that run after it.
+  """
+
+  def __init__(self):
+    self.added = set()
+    self.changed = set()
+    self.removed = set()
+    self.unchanged = 0
+    # {key: values} of FILTER_OPTION_KEYS that changed and removed articles
+    # had before this run
+    self.previous_values = defaultdict(set)
+
+  def track_previous(self, docs):
+    for doc in docs:
+      for key in FILTER_OPTION_KEYS:
+        if doc.get(key):
+          self.previous_values[key].add(doc[key])
+
+  def __bool__(self):
+    return bool(self.added or self.changed or self.removed)
+
+  def __repr__(self):
+    return f"<ChangeSet {len(self.added)} added, {len(self.changed)} changed, {len(self.removed)} removed, {self.unchanged} unchanged>"
+
+
+def save(articles, changes, use_maps=True):
+  """
+  Upsert translated articles, recording what happened to each in `changes`.
+  Institutions the gazetteer can't place are geocoded with Maps first,
+  unless `use_maps` is off.
+
+  An article may list the urls of stored articles it takes the place of
+  under "replaces", which are deleted.
+  """
+  if not articles:
+    return
+  replaced = [
+      url for article in articles for url in article.pop("replaces", [])
+  ]
+  location.add_location_data(articles, use_maps=use_maps)
+
+  keys = db.bulk_upsert(db.Article,
+                        articles,
+                        tracked_fields=FILTER_OPTION_KEYS)
+  changes.added.update(keys["inserted"])
+  changes.changed.update(keys["modified"])
+  changes.track_previous(keys["previous"])
+  changes.unchanged += len(keys["unchanged"])
+  logger.info(
+      f"Saved {len(articles)} articles: {len(keys['inserted'])} new, {len(keys['modified'])} updated, {len(keys['unchanged'])} unchanged"
+  )
+
+  if replaced:
+    docs = list(db.Article._get_collection().find(
+        {"url": {
+            "$in": replaced
+        }}, {field: 1 for field in ["url", *FILTER_OPTION_KEYS]}))
+    remove(docs, changes)
+    if docs:
+      logger.info(f"Removed {len(docs)} articles replaced by others")
+
+
+def remove_stale(source, seen, changes):
+  """
+  Delete the articles from `source` that a full crawl of it did not see.
+  """
+  # every source's urls are on its host or a subdomain of it
+  pattern = f"^https?://([^/]*\\.)?{re.escape(source)}/"
+  stored = db.Article._get_collection().find({"url": {
+      "$regex": pattern
+  }}, {field: 1 for field in ["url", *FILTER_OPTION_KEYS]})
+  stored = list(stored)
+  stale = [doc for doc in stored if doc["url"] not in seen]
+  if not stale:
+    return
+
+  if len(stale) > MAX_REMOVED_FRACTION * len(stored):
+    logger.warn(
+        f"[{source}] Not removing {len(stale)} of {len(stored)} articles missing from the crawl"
+    )
+    return
+
+  remove(stale, changes)
+  logger.warn(f"[{source}] Removed {len(stale)} articles missing from the crawl")
+
+
+def remove(docs, changes):
+  """
+  Delete the articles `docs`, recording them in `changes`.
+  """
+  urls = [doc["url"] for doc in docs]
+  if urls:
+    db.Article._get_collection().delete_many({"url": {"$in": urls}})
+  changes.removed.update(urls)
+  changes.track_previous(docs)
@@ -0,0 +1,146 @@
+# Copyright 2020 The Feverbase Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import queue
+import logging
+import threading
+from collections import defaultdict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# total number of crawl jobs running at once, across all hosts
+MAX_WORKERS = 8
+# number of crawl jobs allowed to hit the same host at once, unless the
+# faucet sets its own HOST_CONCURRENCY
+DEFAULT_HOST_CONCURRENCY = 1
+# items waiting for the consumer before crawlers have to wait
+BUFFER_SIZE = 1000
+
+logger = logging.getLogger(__name__)
+
+
+# sent by `stream` once a job has no more items
+Done = namedtuple("Done", ["error", "seconds"])
+
+
+class CrawlJob:
+  """
+  A single (source, query) crawl, run by calling `faucet.find`.
+  """
+
+  def __init__(self, source, faucet, query):
+    self.source = source
+    self.faucet = faucet
+    self.query = query
+
+  @property
+  def host(self):
+    # every faucet's SOURCE is the registry's host name
+    return self.source
+
+  @property
+  def host_concurrency(self):
+    return getattr(self.faucet, "HOST_CONCURRENCY", DEFAULT_HOST_CONCURRENCY)
+
+  def __repr__(self):
+    return f"<CrawlJob {self.source} '{self.query}'>"
+
+
+def run(jobs, work, max_workers=MAX_WORKERS):
+  """
+  Run `work(job)` for every job on a bounded thread pool, never running more
+  than `job.host_concurrency` jobs against the same host at once.
+
+  Yields (job, result, error, seconds) as jobs finish. Exactly one of result
+  and error is None.
+  """
+  pending = defaultdict(deque)
+  for job in jobs:
+    pending[job.host].append(job)
+  running = defaultdict(int)
+  futures = {}
+
+  def timed(job):
+    start = time.time()
+    try:
+      return work(job), None, time.time() - start
+    except Exception as e:
+      return None, e, time.time() - start
+
+  with ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+    def dispatch():
+      for host, waiting in pending.items():
+        while waiting and running[host] < waiting[0].host_concurrency:
+          job = waiting.popleft()
+          running[host] += 1
+          futures[executor.submit(timed, job)] = job
+
+    dispatch()
+    while futures:
+      done, _ = wait(futures, return_when=FIRST_COMPLETED)
+      for future in done:
+        job = futures.pop(future)
+        running[job.host] -= 1
+        result, error, delta = future.result()
+        yield job, result, error, delta
+      dispatch()
+
+
+def stream(jobs, work, max_workers=MAX_WORKERS, buffer_size=BUFFER_SIZE):
+  """
+  Like `run`, but `work(job)` returns an iterable and every item is yielded
+  as (job, item) while the jobs are still running. Once a job is finished,
+  (job, Done(error, seconds)) is yielded.
+
+  Items go through a queue of `buffer_size`, so crawlers block instead of
+  piling up records when the consumer falls behind.
+  """
+  items = queue.Queue(maxsize=buffer_size)
+  stopped = threading.Event()
+
+  def put(entry):
+    # give up once the consumer is gone, so no thread blocks forever
+    while not stopped.is_set():
+      try:
+        items.put(entry, timeout=0.1)
+        return True
+      except queue.Full:
+        continue
+    return False
+
+  def drain(job):
+    if stopped.is_set():
+      return
+    for item in work(job):
+      if not put((job, item)):
+        break
+
+  def drive():
+    try:
+      for job, _, error, seconds in run(jobs, drain, max_workers=max_workers):
+        put((job, Done(error, seconds)))
+    finally:
+      put(None)
+
+  thread = threading.Thread(target=drive, daemon=True)
+  thread.start()
+  try:
+    while True:
+      entry = items.get()
+      if entry is None:
+        return
+      yield entry
+  finally:
+    stopped.set()
@@ -23,3 +23,12 @@ def get_query_terms():
   with open(os.path.join(FOLDER, "queries.txt")) as f:
     queries = f.read().splitlines()
   return queries
+
+
+def get_or_query(terms):
+  """
+  Join `terms` into a single boolean query matching any of them. Terms with
+  anything but letters and digits are quoted, so e.g. the dash in
+  "sars-cov-2" is not read as an operator.
+  """
+  return " OR ".join(term if term.isalnum() else f'"{term}"' for term in terms)
@@ -0,0 +1,546 @@
+# Copyright 2020 The Feverbase Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+A crawl split between any number of `fetch.py --worker` processes, on any
+number of machines, through a queue of db.WorkUnits in Mongo.
+
+`fetch.py --enqueue` starts a run with a "listing" unit per crawl job. The
+listing of a faucet that sets SPLITS_DETAILS queues a "detail" unit per
+trial instead of fetching them itself, and saved articles get a "geocode"
+unit per institution the gazetteer couldn't place, when Maps geocoding is
+set up. Once none of a run's units are left to do, a "finish" unit moves
+the watermarks and rebuilds the filter options and search index, like the
+end of fetch.run.
+
+Workers lease units for LEASE and renew the lease while they work. If a
+worker dies, its lease runs out and another worker retries the unit. A unit
+that fails MAX_ATTEMPTS times is left "dead" for inspection, and its
+source's watermark is not moved. Articles are upserted by url, so work done
+twice is harmless.
+"""
+
+import os
+import time
+import socket
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+
+import fetch
+from fetch import ingest, filters
+from crawler import metrics, checkpoint, parsing
+from utils import db, location
+from search import mongo_to_meili
+
+# how long a worker may hold a unit without renewing its lease
+LEASE = timedelta(minutes=5)
+# seconds between lease renewals
+HEARTBEAT_INTERVAL = 60
+MAX_ATTEMPTS = 5
+# wait before retrying a failed unit, doubled after every attempt
+RETRY_DELAY = timedelta(minutes=1)
+# seconds an idle worker waits for units that others may still queue
+POLL_INTERVAL = 10
+# units of these kinds (and the same source) leased and run together, so
+# their requests go out concurrently
+BATCH_SIZES = {"detail": 50, "geocode": 50}
+ACTIVE_STATES = ["queued", "leased"]
+
+logger = logging.getLogger(__name__)
+
+
+def get_collection():
+  return db.WorkUnit._get_collection()
+
+
+def now():
+  # leases are compared between machines, so not in local time
+  return datetime.utcnow()
+
+
+def enqueue(run, kind, payloads, source=None):
+  """
+  Queue a unit of `kind` for every {key: payload} the run doesn't have a
+  unit for yet. Returns how many were added.
+  """
+  if not payloads:
+    return 0
+  operations = [
+      UpdateOne(
+          {
+              "run": run,
+              "key": f"{kind}:{key}"
+          },
+          {
+              "$setOnInsert": {
+                  "kind": kind,
+                  "source": source,
+                  "payload": payload,
+                  "state": "queued",
+                  "attempts": 0,
+                  "available": now(),
+                  "urls": [],
+              }
+          },
+          upsert=True,
+      ) for key, payload in payloads.items()
+  ]
+  try:
+    added = get_collection().bulk_write(operations,
+                                        ordered=False).upserted_count
+  except BulkWriteError as e:
+    # another worker queued some of the same units at the same time
+    if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+      raise
+    added = e.details["nUpserted"]
+  metrics.inc("fetch_units_total", added, kind=kind, state="queued")
+  return added
+
+
+def start_run(full=False):
+  """
+  Queue a listing unit for every crawl job and return the new run's id.
+  """
+  run = str(ObjectId())
+  since = fetch.get_since(full)
+  # watermarks are in local time, see fetch.run
+  started = datetime.now()
+  for source, faucet in fetch.DRIPPING_FAUCETS.items():
+    enqueue(
+        run,
+        "listing",
+        {
+            f"{source}:{query}": {
+                "query": query,
+                "since": since[source],
+                "full": full,
+                "started": started,
+            } for query in fetch.get_queries(faucet)
+        },
+        source=source,
+    )
+  logger.warn(f"----- Queued run {run} -----")
+  return run
+
+
+def check_finished(run):
+  """
+  Queue the run's finish unit once none of its other units are left to do.
+  """
+  if get_collection().count_documents(
+      {
+          "run": run,
+          "kind": {
+              "$ne": "finish"
+          },
+          "state": {
+              "$in": ACTIVE_STATES
+          }
+      },
+      limit=1):
+    return
+  if enqueue(run, "finish", {run: {}}):
+    logger.warn(f"----- Run {run} crawled, finishing -----")
+
+
+class Worker:
+  """
+  Pulls units from the queue until there are none left, see `run`.
+  """
+
+  def __init__(self, name=None):
+    self.name = name or f"{socket.gethostname()}:{os.getpid()}"
+    # ids of the units this worker holds a lease on
+    self.held = set()
+    self.lock = threading.Lock()
+    self.stopped = threading.Event()
+    self.handlers = {
+        "listing": self.crawl_listing,
+        "detail": self.fetch_details,
+        "geocode": self.geocode,
+        "finish": self.finish,
+    }
+
+  def run(self):
+    """
+    Process units until no run has any queued or leased, then stop the
+    parse worker processes. Returns how many units were processed.
+    """
+    heartbeat = threading.Thread(target=self.heartbeat, daemon=True)
+    heartbeat.start()
+    count = 0
+    try:
+      while True:
+        unit = self.lease()
+        if unit:
+          count += self.process(unit)
+          continue
+        # leased units may still fail or queue more
+        if not get_collection().count_documents(
+            {"state": {
+                "$in": ACTIVE_STATES
+            }}, limit=1):
+          return count
+        time.sleep(POLL_INTERVAL)
+    finally:
+      self.stopped.set()
+      parsing.shutdown()
+
+  def lease(self, **match):
+    """
+    Lease the next unit matching `match` that is queued, or whose lease has
+    run out. Returns the unit, or None.
+    """
+    self.bury_expired()
+    leased = now()
+    unit = get_collection().find_one_and_update(
+        {
+            "$or": [{
+                "state": "queued",
+                "available": {
+                    "$lte": leased
+                }
+            }, {
+                "state": "leased",
+                "lease_expires": {
+                    "$lt": leased
+                }
+            }],
+            "attempts": {
+                "$lt": MAX_ATTEMPTS
+            },
+            **match,
+        },
+        {
+            "$set": {
+                "state": "leased",
+                "owner": self.name,
+                "lease_expires": leased + LEASE,
+            },
+            "$inc": {
+                "attempts": 1
+            },
+        },
+        sort=[("available", 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+    if unit:
+      with self.lock:
+        self.held.add(unit["_id"])
+    return unit
+
+  def bury_expired(self):
+    """
+    Mark dead the units whose last attempt's worker went away.
+    """
+    expired = {
+        "state": "leased",
+        "lease_expires": {
+            "$lt": now()
+        },
+        "attempts": {
+            "$gte": MAX_ATTEMPTS
+        },
+    }
+    runs = get_collection().distinct("run", expired)
+    if not runs:
+      return
+    result = get_collection().update_many(
+        expired, {
+            "$set": {
+                "state": "dead",
+                "error": "lease expired",
+                "finished": now()
+            },
+            "$unset": {
+                "owner": "",
+                "lease_expires": ""
+            },
+        })
+    metrics.inc("fetch_units_total", result.modified_count, state="dead")
+    for run in runs:
+      check_finished(run)
+
+  def heartbeat(self):
+    while not self.stopped.wait(HEARTBEAT_INTERVAL):
+      with self.lock:
+        held = list(self.held)
+      if not held:
+        continue
+      try:
+        result = get_collection().update_many(
+            {
+                "_id": {
+                    "$in": held
+                },
+                "owner": self.name,
+                "state": "leased"
+            }, {"$set": {
+                "lease_expires": now() + LEASE
+            }})
+        if result.matched_count < len(held):
+          logger.warn(
+              f"Lost the lease on {len(held) - result.matched_count} units")
+      except Exception as e:
+        logger.error(f"Could not renew leases: {e}")
+
+  def process(self, unit):
+    """
+    Run the handler of `unit`'s kind on it and on more units of the same
+    kind and source, up to its BATCH_SIZES in all. Returns how many units
+    were processed.
+    """
+    units = [unit]
+    while len(units) < BATCH_SIZES.get(unit["kind"], 1):
+      more = self.lease(run=unit["run"],
+                        kind=unit["kind"],
+                        source=unit["source"])
+      if not more:
+        break
+      units.append(more)
+
+    try:
+      with metrics.timer("fetch_unit_seconds", kind=unit["kind"]):
+        fields = self.handlers[unit["kind"]](*units) or {}
+    except Exception as e:
+      logger.error(f"[{unit['kind']} {unit['key']}] {e}")
+      for failed in units:
+        self.fail(failed, e)
+    else:
+      for done in units:
+        self.complete(done, **fields)
+    finally:
+      with self.lock:
+        self.held.difference_update(u["_id"] for u in units)
+    check_finished(unit["run"])
+    return len(units)
+
+  def update(self, unit, update):
+    """
+    Apply `update` to a unit this worker still holds. Returns whether it
+    did.
+    """
+    result = get_collection().update_one(
+        {
+            "_id": unit["_id"],
+            "owner": self.name,
+            "state": "leased"
+        }, update)
+    if not result.matched_count:
+      logger.warn(
+          f"[{unit['kind']} {unit['key']}] Lost the lease, another worker may repeat it"
+      )
+    return bool(result.matched_count)
+
+  def complete(self, unit, **fields):
+    self.update(
+        unit, {
+            "$set": {
+                "state": "done",
+                "finished": now(),
+                **fields
+            },
+            "$unset": {
+                "owner": "",
+                "lease_expires": ""
+            },
+        })
+    metrics.inc("fetch_units_total", kind=unit["kind"], state="done")
+
+  def fail(self, unit, error):
+    fields = {"error": str(error)}
+    if unit["attempts"] >= MAX_ATTEMPTS:
+      fields.update(state="dead", finished=now())
+    else:
+      fields.update(state="queued",
+                    available=now() +
+                    RETRY_DELAY * 2**(unit["attempts"] - 1))
+    self.update(unit, {
+        "$set": fields,
+        "$unset": {
+            "owner": "",
+            "lease_expires": ""
+        },
+    })
+    state = "dead" if fields["state"] == "dead" else "retried"
+    metrics.inc("fetch_units_total", kind=unit["kind"], state=state)
+
+  def save(self, unit, articles):
+    """
+    Upsert translated articles and queue the institutions the gazetteer
+    couldn't place for geocoding.
+    """
+    ingest.save(articles, ingest.ChangeSet(), use_maps=False)
+    if location.BASE_URL:
+      institutions = location.get_institutions(articles)
+      placed = location.get_location_ids(institutions, use_maps=False)
+      enqueue(unit["run"], "geocode", {
+          name: {
+              "institution": name,
+              "countries": countries
+          } for name, countries in institutions.items() if name not in placed
+      })
+
+  def crawl_listing(self, unit):
+    source = unit["source"]
+    faucet = fetch.DRIPPING_FAUCETS[source]
+    payload = unit["payload"]
+
+    if getattr(faucet, "SPLITS_DETAILS", False):
+      infos = faucet.list_details(payload["query"], set(), payload["since"])
+      enqueue(unit["run"],
+              "detail", {info["url"]: info for info in infos},
+              source=source)
+      return {"urls": [info["url"] for info in infos]}
+
+    # resume where an earlier attempt left off, skipping trials the run's
+    # other queries of this source found already
+    others = self.get_seen(unit)
+    existing = set(unit["urls"]) | others
+    resume = {}
+    if unit.get("page") is not None:
+      resume["start_page"] = unit["page"] + 1
+
+    batch = []
+    urls = []
+
+    def save(**fields):
+      self.save(unit, batch)
+      self.update(unit, {
+          "$set": fields,
+          "$addToSet": {
+              "urls": {
+                  "$each": urls
+              }
+          }
+      })
+      batch.clear()
+      urls.clear()
+
+    records = faucet.find(payload["query"], existing, payload["since"],
+                          **resume)
+    for record in records:
+      if isinstance(record, checkpoint.PageDone):
+        save(page=record.page)
+        continue
+      metrics.inc("fetch_records_total", source=source)
+      urls.append(record.get("url"))
+      with metrics.timer("fetch_translate_seconds", source=source):
+        batch.append(fetch.translate(record))
+      if len(batch) >= fetch.BATCH_SIZE:
+        save()
+    save()
+    return {"urls": list(existing - others)}
+
+  def get_seen(self, unit):
+    """
+    Return the urls the run's other listings of `unit`'s source found.
+    """
+    others = get_collection().find(
+        {
+            "run": unit["run"],
+            "kind": "listing",
+            "source": unit["source"],
+            "_id": {
+                "$ne": unit["_id"]
+            },
+        }, {"urls": 1})
+    return {url for other in others for url in other.get("urls", [])}
+
+  def fetch_details(self, *units):
+    source = units[0]["source"]
+    faucet = fetch.DRIPPING_FAUCETS[source]
+    articles = []
+    for info in faucet.fetch_details([unit["payload"] for unit in units]):
+      metrics.inc("fetch_records_total", source=source)
+      try:
+        with metrics.timer("fetch_translate_seconds", source=source):
+          articles.append(fetch.translate(info))
+      except Exception as e:
+        logger.error(f"[ID: {info.get('_id')}, URL: {info['url']}] {e}")
+    self.save(units[0], articles)
+
+  def geocode(self, *units):
+    institutions = {
+        unit["payload"]["institution"]: unit["payload"].get("countries", [])
+        for unit in units
+    }
+    location_ids = location.get_location_ids(institutions)
+    if not location_ids:
+      return
+    # saved through bulk_upsert so their content hashes change, which is
+    # what the search index sync looks at
+    articles = list(db.Article._get_collection().find(
+        {"institution": {
+            "$in": list(location_ids)
+        }}))
+    for article in articles:
+      article["location_data"] = location_ids[article["institution"]]
+    db.bulk_upsert(db.Article, articles)
+
+  def finish(self, unit):
+    """
+    The steps fetch.run takes after crawling, for the whole run.
+    """
+    run = unit["run"]
+    collection = get_collection()
+    listing = collection.find_one({"run": run, "kind": "listing"})
+    full = listing["payload"]["full"]
+    started = listing["payload"]["started"]
+    failed_sources = set(
+        collection.distinct("source", {
+            "run": run,
+            "state": "dead"
+        }))
+
+    changes = ingest.ChangeSet()
+    for source in collection.distinct("source", {
+        "run": run,
+        "kind": "listing"
+    }):
+      if source in failed_sources:
+        logger.error(f"[{source}] Units failed, not moving the watermark")
+        continue
+      db.set_watermark(source, started)
+      if full:
+        seen = set()
+        for doc in collection.find(
+            {
+                "run": run,
+                "kind": "listing",
+                "source": source
+            }, {"urls": 1}):
+          seen.update(doc["urls"])
+        with metrics.timer("fetch_stage_seconds", stage="remove_stale"):
+          ingest.remove_stale(source, seen, changes)
+
+    # the workers' changes aren't collected anywhere, so rebuild everything
+    with metrics.timer("fetch_stage_seconds", stage="filter_options"):
+      filters.preload_filter_options()
+    with metrics.timer("fetch_stage_seconds", stage="index"):
+      mongo_to_meili()
+
+    # keep the dead units to look into
+    collection.delete_many({
+        "run": run,
+        "state": "done",
+        "kind": {
+            "$ne": "finish"
+        }
+    })
+    logger.warn(f"----- Finished run {run} -----")
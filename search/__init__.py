@@ -13,68 +13,213 @@
 # limitations under the License.
 
 import sys
-import json
 import re
+import time
+import calendar
 import logging
+from datetime import datetime
+
+from bson import ObjectId
 
 sys.path.append("../")
 from utils import db, ms, config
+from . import upload
 
 logger = logging.getLogger(__name__)
 
 
-def parse_documents():
-  parsed_documents = []
-  for doc in db.Article.objects:
-    entry_json = json.loads(doc.to_json())
-
-    # these values should be guaranteed by Mongo
-    _id = entry_json.get("_id")
-    assert _id, "_id not present in Mongo document"
-    oid = _id.get("$oid")
-    assert oid, "$oid not present in Mongo document"
-
+# Articles read from Mongo at once when syncing changed documents
+SYNC_CHUNK_SIZE = 1000
+# Articles fetched from Mongo per cursor round trip
+EXPORT_BATCH_SIZE = 1000
+# documents read from the index per request when comparing it with Mongo
+SCAN_PAGE_SIZE = 10000
+# a rebuilt index with fewer documents than this share of the live one is
+# assumed broken and never switched to
+MIN_REBUILD_RATIO = 0.9
+# index generations kept around (including the live one) for rollbacks
+KEPT_GENERATIONS = 2
+
+
+def to_extended_json(value):
+  """
+  Convert BSON values the way Document.to_json() did, without serializing:
+  ObjectIds become {"$oid": str} and datetimes {"$date": epoch millis}.
+  """
+  if isinstance(value, ObjectId):
+    return {"$oid": str(value)}
+  if isinstance(value, datetime):
+    millis = calendar.timegm(value.timetuple()) * 1000
+    return {"$date": millis + value.microsecond // 1000}
+  if isinstance(value, dict):
+    return {k: to_extended_json(v) for k, v in value.items()}
+  if isinstance(value, list):
+    return [to_extended_json(v) for v in value]
+  return value
+
+
+def export_documents(ids=None, batch_size=EXPORT_BATCH_SIZE):
+  """
+  Yield Meilisearch documents for every Article (or only those with the given
+  ms-ids), read straight off a raw cursor so the corpus is never held in
+  memory.
+  """
+  projection = {field.db_field: 1 for field in db.Article._fields.values()}
+  query = {}
+  if ids is not None:
+    query = {"_id": {"$in": [ObjectId(i) for i in ids]}}
+
+  count = 0
+  cursor = db.Article._get_collection().find(query,
+                                             projection,
+                                             batch_size=batch_size)
+  for doc in cursor:
     # remove _id key so we can feed directly to meili
-    del entry_json["_id"]
-    entry_json["ms-id"] = oid
+    oid = str(doc.pop("_id"))
+    timestamp = doc.get("timestamp")
 
+    entry = to_extended_json(doc)
+    entry["ms-id"] = oid
     # convert timestamp to epoch
-    if doc.timestamp:
-      entry_json["parsed_timestamp"] = int(doc.timestamp.timestamp())
+    if timestamp:
+      entry["parsed_timestamp"] = int(timestamp.timestamp())
     else:
-      entry_json["parsed_timestamp"] = -1
+      entry["parsed_timestamp"] = -1
 
-    parsed_documents.append(entry_json)
-  logger.warn(
-      f"[Meili] Retrieved {len(parsed_documents)} documents from MongoDB")
-  return parsed_documents
+    count += 1
+    yield entry
+  logger.warn(f"[Meili] Retrieved {count} documents from MongoDB")
 
 
-def push_to_meili(documents):
+def rebuild_meili(documents):
+  """
+  Upload documents (any iterable) into a fresh index generation, then switch searches over
+  to it once its document count checks out. The live index keeps serving
+  until then, and is left untouched if the new one is rejected.
+  """
+  client = ms.get_ms_client()
+  active = ms.get_ms_trials_index(client)
+  active_count = active.get_stats().get("numberOfDocuments", 0)
+
+  uid = f"{ms.TRIALS_INDEX}-{int(time.time())}"
+  index = client.create_index(uid, {"primaryKey": "ms-id"})
+  logger.warn(f"[Meili] Building index '{uid}'")
+  try:
+    upload.wait_for_update(
+        index,
+        index.update_settings(active.get_settings()).get("updateId"))
+
+    # don't switch until all documents have been pushed
+    results = upload.upload_documents(index, documents)
+    failed = [r for r in results if r["error"]]
+    if failed:
+      raise upload.UploadError(
+          f"{len(failed)} of {len(results)} updates failed, see log")
+
+    expected = sum(r["size"] for r in results)
+    count = index.get_stats().get("numberOfDocuments", 0)
+    if count != expected:
+      raise Exception(f"Expected {expected} documents, found {count}")
+    if count < MIN_REBUILD_RATIO * active_count:
+      raise Exception(
+          f"Only {count} documents, '{active.uid}' has {active_count}")
+  except Exception as e:
+    logger.error(f"[Meili] Not switching to '{uid}': {e}")
+    index.delete()
+    raise
+
+  ms.set_active_index_uid(uid)
+  logger.warn(f"[Meili] Switched searches to '{uid}' ({count} documents)")
+  collect_generations(client, uid)
+
+
+def collect_generations(client, active_uid):
+  """
+  Delete all but the KEPT_GENERATIONS newest trials indexes, never deleting
+  the active one.
+  """
+  generations = [
+      i for i in client.get_indexes()
+      if i.get("uid") == ms.TRIALS_INDEX or
+      i.get("uid", "").startswith(f"{ms.TRIALS_INDEX}-")
+  ]
+  generations.sort(key=lambda i: i.get("createdAt", ""), reverse=True)
+  for generation in generations[KEPT_GENERATIONS:]:
+    if generation["uid"] == active_uid:
+      continue
+    client.get_index(generation["uid"]).delete()
+    logger.warn(f"[Meili] Deleted old index '{generation['uid']}'")
+
+
+def get_index_versions(index):
+  """
+  Return {ms-id: content_hash} for every document in the index.
+  """
+  versions = {}
+  offset = 0
+  while True:
+    page = index.get_documents({
+        "offset": offset,
+        "limit": SCAN_PAGE_SIZE,
+        "attributesToRetrieve": "ms-id,content_hash",
+    })
+    for doc in page:
+      versions[doc["ms-id"]] = doc.get("content_hash")
+    if len(page) < SCAN_PAGE_SIZE:
+      return versions
+    offset += SCAN_PAGE_SIZE
+
+
+def get_mongo_versions():
+  """
+  Return {ms-id: content_hash} for every Article in Mongo.
+  """
+  docs = db.Article._get_collection().find({}, {"content_hash": 1})
+  return {str(doc["_id"]): doc.get("content_hash") for doc in docs}
+
+
+def sync_to_meili():
+  """
+  Bring the index in line with Mongo by only adding the documents that are
+  new or whose content_hash changed, and deleting the ones no longer in
+  Mongo. The index keeps serving the unchanged documents throughout.
+  """
   client = ms.get_ms_client()
   index = ms.get_ms_trials_index(client)
 
-  # we want to delete all current documents in the index
-  delete_id = index.delete_all_documents().get("updateId")
-  status = None
-  while status != "processed":
-    update_status = index.get_update_status(delete_id)
-    status = update_status.get("status")
-  logger.warn("[Meili] Successfully cleared previous documents")
-
-  update_id = index.add_documents(documents).get("updateId")
-
-  # don't return until all documents have been pushed
-  status = None
-  while status != "processed":
-    update_status = index.get_update_status(update_id)
-    status = update_status.get("status")
-  logger.warn("[Meili] Successfully uploaded data to Meilisearch")
-
-
-def mongo_to_meili():
-  docs = parse_documents()
-  push_to_meili(docs)
+  indexed = get_index_versions(index)
+  stored = get_mongo_versions()
+  upserts = [
+      ms_id for ms_id, version in stored.items()
+      if ms_id not in indexed or indexed[ms_id] != version
+  ]
+  deletes = [ms_id for ms_id in indexed if ms_id not in stored]
+  logger.warn(
+      f"[Meili] {len(upserts)} documents to add or update, {len(deletes)} to delete, {len(stored) - len(upserts)} unchanged"
+  )
+
+  def changed_documents():
+    for i in range(0, len(upserts), SYNC_CHUNK_SIZE):
+      yield from export_documents(upserts[i:i + SYNC_CHUNK_SIZE])
+
+  results = upload.upload_documents(index, changed_documents())
+  results += upload.delete_documents(index, deletes)
+
+  failed = [r for r in results if r["error"]]
+  if failed:
+    raise upload.UploadError(
+        f"{len(failed)} of {len(results)} updates failed, see log")
+  logger.warn("[Meili] Successfully synced Meilisearch with MongoDB")
+
+
+def mongo_to_meili(full=False):
+  """
+  Sync the index with Mongo, or with `full`, rebuild it from scratch.
+  """
+  if full:
+    rebuild_meili(export_documents())
+  else:
+    sync_to_meili()
 
 
 def perform_meili_search(query):
@@ -13,10 +13,20 @@
 # limitations under the License.
 
 import sys
+import argparse
 sys.path.append("../")
 from utils import ms
 
 from search import mongo_to_meili
 
 if __name__ == "__main__":
-  mongo_to_meili()
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      "--full",
+      dest="full",
+      action="store_true",
+      help="rebuild the index from scratch instead of syncing",
+  )
+  args = parser.parse_args()
+
+  mongo_to_meili(full=args.full)
@@ -0,0 +1,123 @@
+# Copyright 2020 The Feverbase Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import logging
+from collections import deque
+from itertools import islice
+
+# documents (or ids to delete) sent to Meilisearch per update
+CHUNK_SIZE = 1000
+# updates enqueued in Meilisearch before waiting for the oldest one
+MAX_IN_FLIGHT = 4
+# update status polling starts at POLL_INTERVAL and backs off up to
+# MAX_POLL_INTERVAL while the update is still pending
+POLL_INTERVAL = 0.1  # seconds
+MAX_POLL_INTERVAL = 5  # seconds
+
+logger = logging.getLogger(__name__)
+
+
+class UploadError(Exception):
+  pass
+
+
+def wait_for_update(index, update_id):
+  """
+  Poll an update until Meilisearch has processed it, sleeping longer between
+  every check. Returns the final status, or raises UploadError if the update
+  failed.
+  """
+  interval = POLL_INTERVAL
+  while True:
+    update_status = index.get_update_status(update_id)
+    status = update_status.get("status")
+    if status == "processed":
+      return update_status
+    if status == "failed":
+      raise UploadError(
+          f"Update {update_id} failed: {update_status.get('error')}")
+    time.sleep(interval)
+    interval = min(MAX_POLL_INTERVAL, interval * 2)
+
+
+def chunked(items, size):
+  items = iter(items)
+  while True:
+    chunk = list(islice(items, size))
+    if not chunk:
+      return
+    yield chunk
+
+
+def send_chunks(index, items, send, chunk_size=CHUNK_SIZE,
+                max_in_flight=MAX_IN_FLIGHT):
+  """
+  Call `send(chunk)` for every chunk of `items`, keeping up to
+  `max_in_flight` updates enqueued at once, and wait for all of them.
+
+  Returns one dict per chunk with its update id, size, seconds from enqueue
+  to processed and error (None if it succeeded).
+  """
+  results = []
+  in_flight = deque()
+
+  def finish(result):
+    try:
+      wait_for_update(index, result["update_id"])
+    except UploadError as e:
+      result["error"] = str(e)
+    result["seconds"] = round(time.time() - result["seconds"], 2)
+    results.append(result)
+    if result["error"]:
+      logger.error(f"[Meili] Chunk {len(results)} failed: {result['error']}")
+    else:
+      logger.info(
+          f"[Meili] Chunk {len(results)} ({result['size']} documents) processed in {result['seconds']}s"
+      )
+
+  for chunk in chunked(items, chunk_size):
+    if len(in_flight) >= max_in_flight:
+      finish(in_flight.popleft())
+    update_id = send(chunk).get("updateId")
+    in_flight.append({
+        "update_id": update_id,
+        "size": len(chunk),
+        # replaced by the duration once processed
+        "seconds": time.time(),
+        "error": None,
+    })
+  while in_flight:
+    finish(in_flight.popleft())
+
+  failed = [r for r in results if r["error"]]
+  total = sum(r["size"] for r in results)
+  logger.warn(
+      f"[Meili] Sent {total} documents in {len(results)} chunks, {len(failed)} failed"
+  )
+  return results
+
+
+def upload_documents(index, documents, **kwargs):
+  """
+  Add or replace `documents` in chunks. See send_chunks.
+  """
+  return send_chunks(index, documents, index.add_documents, **kwargs)
+
+
+def delete_documents(index, ids, **kwargs):
+  """
+  Delete the documents with the given ids in chunks. See send_chunks.
+  """
+  return send_chunks(index, ids, index.delete_documents, **kwargs)
@@ -59,7 +59,6 @@ app.config.from_object(__name__)
 limiter = Limiter(app, global_limits=["100 per hour", "20 per minute"])
 
 ms_client = ms.get_ms_client()
-ms_index = ms.get_ms_trials_index(ms_client)
 
 slack_api_url = os.environ.get("SLACK_WEBHOOK_URL", "")
 
@@ -254,7 +253,7 @@ def filter_papers(page, qraw, dynamic_filters=[]):
 
     # perform meilisearch query
 
-    results = ms_index.search(qraw, options)
+    results = ms.get_cached_trials_index(ms_client).search(qraw, options)
 
     # was going to use results.get('exhaustiveNbHits')
     # and prepend 'about' if it is False, but source
@@ -0,0 +1,77 @@
+# Copyright 2020 The Feverbase Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+import requests
+
+from crawler import archive
+
+EU_URL = "https://www.clinicaltrialsregister.eu/ctr-search/search?query=covid&dateFrom={}"
+ISRCTN_URL = "http://www.isrctn.com/api/query/format/who?q=covid&dateAssigned%20GT%20{}"
+CTGOV_URL = "https://clinicaltrials.gov/api/query/full_studies"
+CTGOV_EXPR = "AREA[ConditionSearch](covid) AND AREA[StudyFirstSubmitDate]RANGE[{}, MAX]"
+
+
+def make_response(body):
+  response = requests.Response()
+  response.status_code = 200
+  response._content = body
+  response.headers["Content-Type"] = "text/html"
+  return response
+
+
+@pytest.fixture
+def recorded(tmp_path):
+  path = str(tmp_path / "archive.jsonl.gz")
+  archive.record(path)
+  yield path
+  archive.stop()
+
+
+def test_key_leaves_out_the_maps_key():
+  url = "https://maps.googleapis.com/maps/api/geocode/json?key=secret"
+  key = archive.get_key("GET", url, {"address": "Lyon"})
+  assert "secret" not in key
+  assert key == archive.get_key("GET", url.replace("secret", "other"),
+                                {"address": "Lyon"})
+
+
+@pytest.mark.parametrize("url, params, before, after", [
+    (EU_URL, None, "2019-12-01", "2020-06-01"),
+    (ISRCTN_URL, None, "2020-01-01", "2020-06-01"),
+    (CTGOV_URL, CTGOV_EXPR, "12/01/2019", "06/01/2020"),
+])
+def test_key_matches_any_since_date(url, params, before, after):
+
+  def get_key(date):
+    if params:
+      return archive.get_key("GET", url, {"expr": params.format(date)})
+    return archive.get_key("GET", url.format(date))
+
+  assert get_key(before) == get_key(after)
+  assert before not in get_key(before)
+
+
+def test_replay_serves_recorded_responses(recorded):
+  archive.save("GET", EU_URL.format("2019-12-01"), make_response(b"first"))
+  archive.save("GET", EU_URL.format("2019-12-01"), make_response(b"second"))
+  archive.stop()
+
+  archive.replay(recorded)
+  # the watermark moved since the recording
+  url = EU_URL.format("2020-06-01")
+  bodies = [archive.load("GET", url).content for _ in range(3)]
+  assert bodies == [b"first", b"second", b"second"]
+  with pytest.raises(archive.NotArchived):
+    archive.load("GET", url.replace("covid", "sars"))
@@ -0,0 +1,93 @@
+# Copyright 2020 The Feverbase Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+import pytest
+import requests
+
+from crawler import cache, soup
+
+
+def make_response(body):
+  response = requests.Response()
+  response.status_code = 200
+  response._content = body
+  response.headers["ETag"] = '"x"'
+  return response
+
+
+def parse_page(content):
+  return {"length": len(content)}
+
+
+@pytest.fixture
+def db(monkeypatch, tmp_path):
+  monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path))
+  monkeypatch.setattr(cache, "connection", None)
+  monkeypatch.setattr(cache, "MAX_SIZE", 25)
+  yield cache.get_connection()
+  cache.connection.close()
+
+
+def test_changed_page_releases_its_old_body(db):
+  first = make_response(b"a" * 10)
+  cache.store("http://a", first)
+  cache.parsed(first, parse_page)
+  directory = os.path.dirname(cache.get_blob_path(first.cache_digest))
+  assert len(os.listdir(directory)) == 2
+
+  cache.store("http://a", make_response(b"b" * 10))
+  # the body and its parse result
+  assert not any(
+      name.startswith(first.cache_digest) for name in os.listdir(directory))
+  assert cache.get_total(db) == 10
+
+
+def test_store_evicts_least_recently_used(db):
+  for i, url in enumerate(["http://a", "http://b", "http://c"]):
+    cache.store(url, make_response(bytes([i]) * 10))
+  # a body shared by two urls is only counted once
+  cache.store("http://d", make_response(bytes([2]) * 10))
+
+  assert cache.lookup("http://a") is None
+  assert cache.lookup("http://b") and cache.lookup("http://d")
+  assert cache.get_total(db) == 20
+
+
+def test_total_is_summed_for_an_index_without_one(db):
+  cache.store("http://a", make_response(b"a" * 10))
+  db.execute("DROP TABLE total")
+  db.commit()
+  db.close()
+  cache.connection = None
+  assert cache.get_total(cache.get_connection()) == 10
+
+
+def test_parse_key_changes_with_the_tree_builder(monkeypatch):
+  key = cache.get_parse_key(parse_page)
+  monkeypatch.setattr(soup, "PARSER", "html.parser")
+  assert cache.get_parse_key(parse_page) != key
+  monkeypatch.setattr(soup, "RESTRICT", not soup.RESTRICT)
+  assert cache.get_parse_key(parse_page) != key
+
+
+def test_revalidating_an_evicted_body_is_a_miss(db):
+  cache.store("http://a", make_response(b"a" * 10))
+  entry = cache.lookup("http://a")
+  os.remove(cache.get_blob_path(entry["digest"]))
+
+  not_modified = make_response(b"")
+  not_modified.status_code = 304
+  assert cache.revalidated("http://a", entry, not_modified) is None
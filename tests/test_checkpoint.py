@@ -0,0 +1,137 @@
+# Copyright 2020 The Feverbase Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime, timedelta
+
+import pytest
+
+import fetch
+from fetch import scheduler
+from crawler import checkpoint
+from utils import db, location
+
+SOURCE = "paged.test"
+
+
+class Paged:
+  """
+  Lists 3 pages of 2 trials, reporting each page as it is done.
+  """
+  SOURCE = SOURCE
+  START_DATE = datetime(2020, 1, 1)
+  starts = []
+  found = []
+
+  @staticmethod
+  def find(query, existing, since, start_page=0):
+    Paged.starts.append(start_page)
+    for page in range(start_page, 3):
+      for i in range(2):
+        url = f"https://{SOURCE}/{page}/{i}"
+        if url in existing:
+          continue
+        existing.add(url)
+        Paged.found.append(url)
+        yield {"_source": SOURCE, "url": url, "title": query}
+      yield checkpoint.PageDone(page)
+
+  @staticmethod
+  def translate(info):
+    return {"url": info["url"], "title": info["title"]}
+
+
+def clear():
+  db.Checkpoint.objects(source=SOURCE).delete()
+  db.Watermark.objects(source=SOURCE).delete()
+  db.Article._get_collection().delete_many(
+      {"url": {
+          "$regex": f"^https://{SOURCE}/"
+      }})
+
+
+@pytest.fixture
+def job():
+  clear()
+  Paged.starts = []
+  Paged.found = []
+  yield scheduler.CrawlJob(SOURCE, Paged, "q")
+  clear()
+
+
+def test_progress_is_only_kept_once_flushed(job):
+  started = datetime.now()
+  progress = checkpoint.Tracker([job], False, started)
+  progress.record(job, "https://paged.test/0/0")
+  progress.page_done(job, 0)
+
+  resumed = checkpoint.Tracker([job], False, started + timedelta(hours=1))
+  assert resumed.resume(job) == {}
+  assert resumed.get_existing() == set()
+
+  progress.flush()
+  resumed = checkpoint.Tracker([job], False, started + timedelta(hours=1))
+  assert resumed.resume(job) == {"start_page": 1}
+  assert resumed.get_existing() == {"https://paged.test/0/0"}
+  assert not resumed.is_done(job)
+  # the watermark covers the interrupted run
+  assert abs(resumed.started - started) < timedelta(seconds=1)
+
+  # a full run doesn't resume an incremental one
+  assert checkpoint.Tracker([job], True, started).resume(job) == {}
+  assert not db.Checkpoint.objects(source=SOURCE)
+
+
+def test_crawl_resumes_after_the_last_saved_page(job, monkeypatch):
+  monkeypatch.setattr(fetch, "DRIPPING_FAUCETS", {SOURCE: Paged})
+  monkeypatch.setattr(fetch, "get_queries", lambda faucet: ["q"])
+  monkeypatch.setattr(fetch, "BATCH_SIZE", 3)
+  monkeypatch.setattr(fetch.filters, "preload_filter_options",
+                      lambda changes: None)
+  monkeypatch.setattr(fetch, "mongo_to_meili", lambda: None)
+  monkeypatch.setattr(location, "BASE_URL", None)
+
+  save = fetch.ingest.save
+  saves = []
+
+  def save_once(batch, changes):
+    if saves:
+      raise RuntimeError("Mongo went away")
+    saves.append(batch)
+    save(batch, changes)
+
+  monkeypatch.setattr(fetch.ingest, "save", save_once)
+  with pytest.raises(RuntimeError):
+    fetch.crawl(False)
+
+  # page 1 was done, but only its first trial was saved
+  [saved] = db.Checkpoint.objects(source=SOURCE)
+  assert saved.page == 0
+  assert set(saved.urls) == set(Paged.found[:3])
+
+  monkeypatch.setattr(fetch.ingest, "save", save)
+  Paged.found = []
+  fetch.crawl(False)
+
+  assert Paged.starts == [0, 1]
+  assert Paged.found == [
+      "https://paged.test/1/1", "https://paged.test/2/0",
+      "https://paged.test/2/1"
+  ]
+  articles = db.Article._get_collection().find(
+      {"url": {
+          "$regex": f"^https://{SOURCE}/"
+      }})
+  assert len(list(articles)) == 6
+  assert not db.Checkpoint.objects(source=SOURCE)
+  assert db.get_watermark(SOURCE)
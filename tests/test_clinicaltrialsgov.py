@@ -0,0 +1,284 @@
+# Copyright 2020 The Feverbase Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import json
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from crawler import client, cache, soup, archive, parsing
+
+sys.path.append("./fetch")
+from faucets import clinicaltrialsgov
+
+TRIAL_IDS = [f"NCT0000{i}" for i in range(5)]
+
+RECORD_PAGE = """
+<html><body><table>
+  <tr><th class="tr-rowHeader">Official Title ICMJE</th><td> Trial {id} </td></tr>
+  <tr><th class="tr-rowHeader">Estimated Enrollment ICMJE (submitted: May 1, 2020)</th><td>100</td></tr>
+  <tr><th class="tr-rowHeader">Sponsor</th><td>Not Provided</td></tr>
+</table></body></html>
+"""
+
+
+class StandIn(BaseHTTPRequestHandler):
+  # number of requests seen per path
+  hits = {}
+  # number of 304s sent
+  not_modified = 0
+
+  def log_message(self, *args):
+    pass
+
+  def do_GET(self):
+    path = self.path.split("?")[0]
+    hits = StandIn.hits[path] = StandIn.hits.get(path, 0) + 1
+
+    if path.endswith("rss.xml"):
+      base = f"http://{self.headers['Host']}"
+      items = "".join(
+          f"<item><guid isPermaLink='false'>{i}</guid><link>{base}/ct2/show/{i}?cond=x</link></item>"
+          for i in TRIAL_IDS)
+      body = f"<rss version='2.0'><channel>{items}</channel></rss>"
+    elif path.startswith("/ct2/show/record/"):
+      trial_id = path.split("/")[-1]
+      # first request for the flaky trial fails
+      if trial_id == TRIAL_IDS[0] and hits == 1:
+        self.send_response(503)
+        self.end_headers()
+        return
+      etag = f'"{trial_id}"'
+      if self.headers.get("If-None-Match") == etag:
+        StandIn.not_modified += 1
+        self.send_response(304)
+        self.end_headers()
+        return
+      body = RECORD_PAGE.format(id=trial_id)
+    else:
+      self.send_response(404)
+      self.end_headers()
+      return
+
+    self.send_response(200)
+    if path.startswith("/ct2/show/record/"):
+      self.send_header("ETag", etag)
+    self.end_headers()
+    self.wfile.write(body.encode())
+
+
+@pytest.fixture
+def stand_in(monkeypatch, tmp_path):
+  server = HTTPServer(("127.0.0.1", 0), StandIn)
+  thread = threading.Thread(target=server.serve_forever, daemon=True)
+  thread.start()
+  StandIn.hits = {}
+  StandIn.not_modified = 0
+  monkeypatch.setattr(clinicaltrialsgov, "BASE_URL",
+                      f"http://127.0.0.1:{server.server_port}")
+  monkeypatch.setattr(client, "BACKOFF", 0)
+  monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path))
+  monkeypatch.setattr(cache, "connection", None)
+  yield server
+  server.shutdown()
+
+
+@pytest.mark.parametrize("processes", [0, 2])
+def test_find_fetches_details_concurrently(stand_in, monkeypatch, processes):
+  monkeypatch.setattr(parsing, "PROCESSES", processes)
+  existing = set()
+  data = {
+      info["url"]: info
+      for info in clinicaltrialsgov.find("covid", existing, max_in_flight=2)
+  }
+
+  assert len(data) == len(TRIAL_IDS)
+  assert existing == set(data)
+  for info in data.values():
+    assert info["Official Title"] == f"Trial {info['_id']}"
+    assert info["Estimated Enrollment"] == "100"
+    assert info["Sponsor"] == ""
+
+  # the 503 was retried
+  assert StandIn.hits[f"/ct2/show/record/{TRIAL_IDS[0]}"] == 2
+
+
+def test_find_skips_existing(stand_in):
+  existing = set()
+  list(clinicaltrialsgov.find("covid", existing))
+  assert list(clinicaltrialsgov.find("covid", existing)) == []
+
+
+def test_find_revalidates_cached_pages(stand_in, monkeypatch):
+  # parse here, where the patched make_soup applies
+  monkeypatch.setattr(parsing, "PROCESSES", 0)
+  first = list(clinicaltrialsgov.find("covid", set()))
+
+  def fail(*args):
+    raise AssertionError("unchanged page was parsed again")
+
+  monkeypatch.setattr(soup, "make_soup", fail)
+  second = list(clinicaltrialsgov.find("covid", set()))
+
+  assert StandIn.not_modified == len(TRIAL_IDS)
+  key = lambda info: info["url"]
+  assert sorted(second, key=key) == sorted(first, key=key)
+
+
+def test_find_refetches_pages_evicted_while_revalidating(
+    stand_in, monkeypatch):
+  monkeypatch.setattr(parsing, "PROCESSES", 0)
+  first = list(clinicaltrialsgov.find("covid", set()))
+  lookup = cache.lookup
+
+  def lookup_then_evict(url):
+    entry = lookup(url)
+    if entry:
+      os.remove(cache.get_blob_path(entry["digest"]))
+    return entry
+
+  monkeypatch.setattr(cache, "lookup", lookup_then_evict)
+  second = list(clinicaltrialsgov.find("covid", set()))
+
+  # every 304 was followed by a plain GET
+  assert StandIn.not_modified == len(TRIAL_IDS)
+  assert StandIn.hits[f"/ct2/show/record/{TRIAL_IDS[1]}"] == 3
+  key = lambda info: info["url"]
+  assert sorted(second, key=key) == sorted(first, key=key)
+
+
+def test_find_replays_recorded_archive(stand_in, tmp_path):
+  path = str(tmp_path / "archive.jsonl.gz")
+  archive.record(path)
+  try:
+    recorded = list(clinicaltrialsgov.find("covid", set()))
+  finally:
+    archive.stop()
+  hits = dict(StandIn.hits)
+
+  archive.replay(path)
+  try:
+    replayed = list(clinicaltrialsgov.find("covid", set()))
+  finally:
+    archive.stop()
+
+  # nothing reached the stand-in
+  assert StandIn.hits == hits
+  key = lambda info: info["url"]
+  assert sorted(replayed, key=key) == sorted(recorded, key=key)
+
+
+@pytest.mark.parametrize("parser", ["html.parser", "lxml"])
+@pytest.mark.parametrize("restrict", [True, False])
+def test_parse_record_same_for_every_backend(monkeypatch, parser, restrict):
+  page = RECORD_PAGE.format(id=TRIAL_IDS[0]).encode()
+  monkeypatch.setattr(soup, "PARSER", parser)
+  monkeypatch.setattr(soup, "RESTRICT", restrict)
+  assert clinicaltrialsgov.parse_record(page) == {
+      "Official Title": f"Trial {TRIAL_IDS[0]}",
+      "Estimated Enrollment": "100",
+      "Sponsor": "",
+  }
+
+
+def make_study(trial_id):
+  return {
+      "ProtocolSection": {
+          "IdentificationModule": {
+              "NCTId": trial_id,
+              "BriefTitle": "Brief",
+              "OfficialTitle": f"Trial {trial_id}",
+          },
+          "StatusModule": {
+              "OverallStatus": "Recruiting",
+              "StudyFirstSubmitDate": "March 3, 2020",
+              "StudyFirstPostDateStruct": {
+                  "StudyFirstPostDate": "March 5, 2020"
+              },
+          },
+          "SponsorCollaboratorsModule": {
+              "LeadSponsor": {
+                  "LeadSponsorName": "Acme"
+              },
+              "ResponsibleParty": {
+                  "ResponsiblePartyType": "Sponsor"
+              },
+          },
+          "ConditionsModule": {
+              "ConditionList": {
+                  "Condition": ["COVID-19", "Pneumonia"]
+              }
+          },
+          "ArmsInterventionsModule": {
+              "InterventionList": {
+                  "Intervention": [{
+                      "InterventionType": "Drug",
+                      "InterventionName": "Placebo"
+                  }]
+              }
+          },
+          "EligibilityModule": {
+              "Gender": "All"
+          },
+          "DesignModule": {
+              "EnrollmentInfo": {
+                  "EnrollmentCount": "100",
+                  "EnrollmentType": "Anticipated"
+              }
+          },
+          "ContactsLocationsModule": {
+              "LocationList": {
+                  "Location": [{
+                      "LocationCountry": "France"
+                  }, {
+                      "LocationCountry": "France"
+                  }]
+              }
+          },
+      }
+  }
+
+
+def test_find_records_reads_saved_study_records(tmp_path):
+  for i, trial_ids in enumerate([TRIAL_IDS[:3], TRIAL_IDS[2:]]):
+    studies = [{"Rank": 1, "Study": make_study(id)} for id in trial_ids]
+    page = {"FullStudiesResponse": {"FullStudies": studies}}
+    (tmp_path / f"{i}.json").write_text(json.dumps(page))
+
+  existing = set()
+  infos = list(
+      clinicaltrialsgov.find_records("covid", existing, directory=tmp_path))
+
+  assert [info["_id"] for info in infos] == TRIAL_IDS
+  assert existing == {info["url"] for info in infos}
+  assert clinicaltrialsgov.translate(infos[0]) == {
+      "title": f"Trial {TRIAL_IDS[0]}",
+      "url": f"{clinicaltrialsgov.BASE_URL}/ct2/show/{TRIAL_IDS[0]}",
+      "timestamp": "2020-03-05",
+      "recruiting_status": "Recruiting",
+      "sex": ["male", "female"],
+      "target_disease": "COVID-19",
+      "intervention": "Drug: Placebo",
+      "sponsor": "Acme",
+      "summary": "",
+      "location": "France",
+      "institution": "Acme",
+      "contact": {},
+      "sample_size": 100,
+      "abandoned": None,
+      "abandoned_reason": None,
+  }
@@ -0,0 +1,102 @@
+# Copyright 2020 The Feverbase Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+from utils import db
+
+HOST = "https://db.test"
+LOCATION_KEY = "db.test:"
+
+
+def clear():
+  db.Article._get_collection().delete_many({"url": {"$regex": f"^{HOST}/"}})
+  db.Location._get_collection().delete_many(
+      {"key": {
+          "$regex": f"^{LOCATION_KEY}"
+      }})
+
+
+@pytest.fixture
+def writes(monkeypatch):
+  """
+  Record the operations of every bulk write.
+  """
+  clear()
+  written = []
+  collection = type(db.Article._get_collection())
+  bulk_write = collection.bulk_write
+
+  def recorded(self, operations, **kwargs):
+    written.append(len(operations))
+    return bulk_write(self, operations, **kwargs)
+
+  monkeypatch.setattr(collection, "bulk_write", recorded)
+  yield written
+  clear()
+
+
+def make_article(name, title):
+  return {"url": f"{HOST}/{name}", "title": title, "sponsor": "Acme"}
+
+
+def test_unchanged_articles_are_not_written(writes):
+  a, b, c = [f"{HOST}/{name}" for name in "abc"]
+  keys = db.bulk_upsert(db.Article,
+                        [make_article("a", "A"),
+                         make_article("b", "B")])
+  assert keys["inserted"] == [a, b]
+  assert writes == [2]
+
+  keys = db.bulk_upsert(db.Article,
+                        [make_article("a", "A"),
+                         make_article("b", "B")])
+  assert keys["unchanged"] == [a, b]
+  assert keys["inserted"] == keys["modified"] == []
+  assert writes == [2]
+
+  keys = db.bulk_upsert(db.Article, [
+      make_article("c", "C"),
+      make_article("b", "B"),
+      make_article("a", "A, edited"),
+  ],
+                        tracked_fields=["title"])
+  assert keys == {
+      "inserted": [c],
+      "modified": [a],
+      "unchanged": [b],
+      "previous": [{
+          "title": "A"
+      }],
+  }
+  assert writes == [2, 2]
+  stored = db.Article._get_collection().find_one({"url": a})
+  assert stored["title"] == "A, edited"
+  assert stored["content_hash"] == db.get_content_hash(
+      db.to_mongo_fields(db.Article, make_article("a", "A, edited")))
+
+
+def test_unhashed_documents_are_compared_field_by_field(writes):
+  key = f"{LOCATION_KEY}acme"
+  location = {"key": key, "institution": "Acme", "address": "1 Main St"}
+  assert db.bulk_upsert(db.Location, [location],
+                        key="key")["inserted"] == [key]
+
+  assert db.bulk_upsert(db.Location, [location],
+                        key="key")["unchanged"] == [key]
+  assert writes == [1]
+
+  moved = {**location, "address": "2 Main St"}
+  assert db.bulk_upsert(db.Location, [moved], key="key")["modified"] == [key]
+  assert writes == [1, 1]
@@ -0,0 +1,92 @@
+# Copyright 2020 The Feverbase Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+
+import pytest
+import requests
+
+from crawler import client, parsing
+
+sys.path.append("./fetch")
+from faucets import eu
+
+TRIAL = "/ctr-search/trial/2020-001113-21"
+
+RESULTS_PAGE = f"""
+<html><body><table class="result">
+  <tr><td><span class="label">EudraCT Number:</span> 2020-001113-21</td><td><span class="label">Sponsor Protocol Number:</span> P-1</td><td><span class="label">Start Date*:</span> 2020-03-20</td></tr>
+  <tr><td colspan="3"><span class="label">Sponsor Name:</span> Acme</td></tr>
+  <tr><td colspan="3"><span class="label">Full Title:</span> A trial of acmevir</td></tr>
+  <tr><td colspan="3"><span class="label">Trial results:</span> <a href="{TRIAL}/results">View results</a></td></tr>
+  <tr><td colspan="3"><span class="label">Trial protocol:</span> <a href="{TRIAL}/GB">GB</a> (Ongoing) <a href="{TRIAL}/DE">DE</a> (Ongoing) <a href="{TRIAL}/3RD">Outside EU/EEA</a></td></tr>
+</table></body></html>
+"""
+
+PROTOCOL_PAGE = """
+<html><body><table>
+  <tr><td class="second">Medical condition(s) being investigated</td><td class="third"><table><tr><td>COVID-19</td></tr></table></td></tr>
+  <tr><td class="second">Female</td><td class="third">Yes</td></tr>
+  <tr><td class="second">Male</td><td class="third">No</td></tr>
+  <tr><td class="second">Name of Sponsor</td><td class="third">Acme</td></tr>
+  <tr><td class="second">Country</td><td class="third">United Kingdom</td></tr>
+  <tr><td class="second">In the member state</td><td class="third">40</td></tr>
+  <tr><td class="second">In the whole clinical trial</td><td class="third">300</td></tr>
+</table></body></html>
+"""
+
+
+@pytest.fixture
+def register(monkeypatch):
+  requested = []
+
+  def get(url, **kwargs):
+    requested.append(url)
+    response = requests.Response()
+    response.status_code = 200
+    response._content = (PROTOCOL_PAGE if TRIAL in url else
+                         RESULTS_PAGE).encode()
+    return response
+
+  monkeypatch.setattr(client, "get", get)
+  monkeypatch.setattr(parsing, "PROCESSES", 0)
+  return requested
+
+
+def test_find_merges_a_trials_countries(register):
+  existing = set()
+  records = [
+      record for record in eu.find("covid", existing)
+      if isinstance(record, dict)
+  ]
+
+  assert len(records) == 1
+  record = records[0]
+  protocols = [f"{eu.BASE_URL}{TRIAL}/{code}" for code in ["GB", "DE", "3RD"]]
+  # only the first country's protocol is fetched
+  assert [url for url in register if TRIAL in url] == protocols[:1]
+  assert record["url"] == protocols[0]
+  assert record["replaces"] == protocols[1:]
+  assert existing == set(protocols)
+  assert record["location"] == "United Kingdom, Germany, Outside EU/EEA"
+  assert record["title"] == "A trial of acmevir"
+  assert record["sex"] == ["FEMALE"]
+  assert record["target_disease"] == "COVID-19"
+  assert record["sample_size"] == 300
+
+  # the trial's other copies count as seen
+  assert not [
+      record for record in eu.find("covid", existing)
+      if isinstance(record, dict)
+  ]
@@ -0,0 +1,124 @@
+# Copyright 2020 The Feverbase Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+The options are kept for a key only these tests use, so they don't touch
+the real FILTER_OPTION_KEYS' options in the test database.
+"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from fetch import filters, ingest
+from utils import db
+
+KEY = "filter_test"
+HOST = "https://filters.test"
+
+
+def add_articles(*values):
+  """
+  Store an Article per value, each newer than the last, and return their
+  urls.
+  """
+  start = datetime(2020, 1, 1)
+  urls = [f"{HOST}/{value}/{i}" for i, value in enumerate(values)]
+  db.Article._get_collection().insert_many([{
+      "url": url,
+      KEY: value,
+      "timestamp": start + timedelta(days=i)
+  } for i, (url, value) in enumerate(zip(urls, values))])
+  return urls
+
+
+def get_options():
+  return sorted(option.value for option in db.FilterOption.objects(key=KEY))
+
+
+def clear():
+  db.FilterOption.objects(key=KEY).delete()
+  db.Article._get_collection().delete_many({"url": {"$regex": f"^{HOST}/"}})
+
+
+@pytest.fixture
+def articles():
+  clear()
+  yield
+  clear()
+
+
+def test_rebuild_matches_the_articles(articles):
+  db.FilterOption(key=KEY, value="Gone").save()
+  add_articles("Acme", "Globex", "Acme", "")
+
+  filters.rebuild(KEY)
+  assert get_options() == ["Acme", "Globex"]
+
+  # nothing to do the second time
+  ids = {option.id for option in db.FilterOption.objects(key=KEY)}
+  filters.rebuild(KEY)
+  assert {option.id for option in db.FilterOption.objects(key=KEY)} == ids
+
+
+def test_case_variants_are_one_option(articles):
+  add_articles("COVID-19", "covid-19")
+  db.FilterOption(key=KEY, value="COVID-19").save()
+
+  # the newest article's case wins, and replaces the older one
+  filters.rebuild(KEY)
+  assert get_options() == ["covid-19"]
+
+  # an article in another case doesn't add an option
+  [url] = add_articles("Covid-19")
+  changes = ingest.ChangeSet()
+  changes.changed.add(url)
+  filters.update(KEY, changes)
+  assert get_options() == ["covid-19"]
+
+
+def test_update_adds_new_values(articles):
+  add_articles("Acme")
+  filters.rebuild(KEY)
+
+  db.Article._get_collection().insert_one({
+      "url": f"{HOST}/new",
+      KEY: "Initech",
+      "timestamp": datetime(2021, 1, 1)
+  })
+  changes = ingest.ChangeSet()
+  changes.added.add(f"{HOST}/new")
+  filters.update(KEY, changes)
+  assert get_options() == ["Acme", "Initech"]
+
+
+def test_update_removes_values_no_article_has(articles):
+  urls = add_articles("Acme", "Globex", "Globex")
+  filters.rebuild(KEY)
+
+  # one of two Globex articles is gone, the option stays
+  collection = db.Article._get_collection()
+  collection.delete_one({"url": urls[1]})
+  changes = ingest.ChangeSet()
+  changes.removed.add(urls[1])
+  changes.previous_values[KEY].add("Globex")
+  filters.update(KEY, changes)
+  assert get_options() == ["Acme", "Globex"]
+
+  # the last Acme article changed sponsor, in another case than it was
+  collection.update_one({"url": urls[0]}, {"$set": {KEY: "Initech"}})
+  changes = ingest.ChangeSet()
+  changes.changed.add(urls[0])
+  changes.previous_values[KEY].add("ACME")
+  filters.update(KEY, changes)
+  assert get_options() == ["Globex", "Initech"]
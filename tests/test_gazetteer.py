@@ -0,0 +1,93 @@
+# Copyright 2020 The Feverbase Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+import pytest
+
+from utils import gazetteer, location
+
+SOURCE = """# kind, country, latitude, longitude, names
+country\tFR\t46.23\t2.21\tFrance
+country\tKR\t35.91\t127.77\tSouth Korea|Korea, Republic of
+country\tJO\t30.59\t36.24\tJordan
+country\tUS\t37.09\t-95.71\tUnited States
+country\tGB\t55.38\t-3.44\tUnited Kingdom
+country\tCA\t56.13\t-106.35\tCanada
+region\tUS\t31.05\t-97.56\tTexas
+city\tFR\t45.76\t4.84\tLyon
+city\tUS\t29.76\t-95.37\tHouston
+city\tCA\t42.98\t-81.25\tLondon, Ontario
+city\tGB\t51.51\t-0.13\tLondon
+"""
+
+
+@pytest.fixture
+def table(monkeypatch, tmp_path):
+  source_path = tmp_path / "gazetteer.tsv"
+  source_path.write_text(SOURCE)
+  monkeypatch.setattr(gazetteer, "SOURCE_PATH", str(source_path))
+  monkeypatch.setattr(gazetteer, "TABLE_PATH", str(tmp_path / "gazetteer.bin"))
+  monkeypatch.setattr(gazetteer, "table", None)
+  return gazetteer.get_table()
+
+
+def test_lookup_finds_every_spelling(table):
+  assert table.count == 12
+  korea = table.lookup("korea republic of")
+  assert [place.name for place in korea] == ["South Korea"]
+  assert korea == table.lookup("south korea")
+  assert table.lookup("atlantis") == []
+
+
+def test_edited_source_is_rebuilt(table, monkeypatch):
+  source_path = gazetteer.SOURCE_PATH
+  with open(source_path, "a") as f:
+    f.write("city\tFR\t43.30\t5.37\tMarseille\n")
+  stat = os.stat(gazetteer.TABLE_PATH)
+  os.utime(source_path, (stat.st_atime, stat.st_mtime + 1))
+  monkeypatch.setattr(gazetteer, "table", None)
+  assert gazetteer.get_table().lookup("marseille")
+
+
+def test_find_countries_reads_registry_lists(table):
+  countries = gazetteer.find_countries("Korea, Republic of, France\nAtlantis")
+  assert [place.country for place in countries] == ["KR", "FR"]
+
+
+@pytest.mark.parametrize("institution, countries, address", [
+    ("Hospices Civils de Lyon", None, "Lyon, France"),
+    ("University of Texas Health Science Center at Houston", None,
+     "Houston, United States"),
+    ("University of Texas", None, "Texas, United States"),
+    ("University College London", None, "London, United Kingdom"),
+    ("Western University, London, Ontario", None, "London, Ontario, Canada"),
+    ("Jordan Smith, MD", ["US"], None),
+    ("Mayo Clinic", None, None),
+])
+def test_find_place_prefers_specific_places(table, institution, countries,
+                                            address):
+  place = gazetteer.find_place(institution, countries)
+  assert (place and gazetteer.get_address(place)) == address
+
+
+def test_place_all_leaves_regions_and_countries_to_maps(table):
+  spellings = {
+      "hospices civils de lyon": "Hospices Civils de Lyon",
+      "university of texas": "University of Texas",
+      "university of jordan": "University of Jordan",
+  }
+  placed = location.place_all(spellings, {"University of Jordan": ["JO"]})
+  assert list(placed) == ["hospices civils de lyon"]
+  assert placed["hospices civils de lyon"]["address"] == "Lyon, France"
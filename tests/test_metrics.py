@@ -0,0 +1,93 @@
+# Copyright 2020 The Feverbase Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+import pytest
+
+from crawler import metrics
+
+
+@pytest.fixture(autouse=True)
+def reset():
+  metrics.reset()
+  yield
+  metrics.reset()
+
+
+def test_histogram_buckets_are_cumulative():
+  for seconds in [0.001, 0.2, 0.2, 100]:
+    metrics.observe("fetch_parse_seconds", seconds, faucet="eu")
+
+  [histogram] = metrics.get_report()["histograms"]
+  assert histogram["count"] == 4
+  assert histogram["sum"] == pytest.approx(100.401)
+  buckets = histogram["buckets"]
+  assert buckets["0.005"] == 1
+  assert buckets["0.1"] == 1
+  assert buckets["0.25"] == 3
+  assert buckets["60"] == 3
+  assert buckets["+Inf"] == 4
+  assert list(buckets.values()) == sorted(buckets.values())
+
+
+def test_to_prometheus():
+  metrics.inc("fetch_requests_total", host="eu", status=200)
+  metrics.inc("fetch_requests_total", 2, host="eu", status=200)
+  metrics.inc("fetch_requests_total", host="eu", status="Timeout")
+  metrics.set_gauge("fetch_articles", 5, change="added")
+  metrics.observe("fetch_job_seconds", 3, source="eu")
+
+  lines = metrics.to_prometheus(metrics.get_report()).splitlines()
+  assert lines[:6] == [
+      "# TYPE fetch_requests_total counter",
+      'fetch_requests_total{host="eu",status="200"} 3',
+      'fetch_requests_total{host="eu",status="Timeout"} 1',
+      "# TYPE fetch_articles gauge",
+      'fetch_articles{change="added"} 5',
+      "# TYPE fetch_job_seconds histogram",
+  ]
+  assert 'fetch_job_seconds_bucket{source="eu",le="2.5"} 0' in lines
+  assert 'fetch_job_seconds_bucket{source="eu",le="5"} 1' in lines
+  assert 'fetch_job_seconds_bucket{source="eu",le="+Inf"} 1' in lines
+  assert lines[-2:] == [
+      'fetch_job_seconds_sum{source="eu"} 3',
+      'fetch_job_seconds_count{source="eu"} 1',
+  ]
+
+
+def test_label_values_are_escaped():
+  metrics.inc("fetch_records_total", source='a "quoted"\\ name')
+  lines = metrics.to_prometheus(metrics.get_report()).splitlines()
+  assert lines[1] == 'fetch_records_total{source="a \\"quoted\\"\\\\ name"} 1'
+
+
+def test_write_report(tmp_path):
+  metrics.inc("fetch_records_total", source="eu")
+  with pytest.raises(ValueError):
+    with metrics.timer("fetch_stage_seconds", stage="save"):
+      raise ValueError()
+
+  for _ in range(2):
+    report = metrics.write_report(str(tmp_path))
+
+  with open(tmp_path / "metrics.json") as f:
+    assert json.load(f) == report
+  with open(tmp_path / "metrics.prom") as f:
+    assert f.read() == metrics.to_prometheus(report)
+  with open(tmp_path / "metrics.jsonl") as f:
+    assert len(f.readlines()) == 2
+  # the timed block counts even though it raised
+  assert report["histograms"][0]["count"] == 1
+  assert [g["name"] for g in report["gauges"]] == ["fetch_run_seconds"]
@@ -0,0 +1,369 @@
+# Copyright 2020 The Feverbase Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Searches go to a stand-in Meilisearch, which processes every update right
+away. The trials index is renamed for these tests, so the test database's
+pointer to the real one is left alone.
+"""
+
+import json
+import threading
+from datetime import datetime
+from urllib.parse import urlparse, parse_qs
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+import search
+from search import upload
+from utils import db, ms
+
+TRIALS_INDEX = "search-test"
+HOST = "https://search.test"
+
+
+class StandIn(BaseHTTPRequestHandler):
+  # {uid: {"createdAt", "settings", "documents": {ms-id: document}}}
+  indexes = {}
+  # {update id: status}
+  updates = {}
+  # pending statuses reported before an update is processed
+  pending_polls = 0
+  polls = {}
+  # ms-ids of the documents in every add and delete update
+  added = []
+  deleted = []
+  # methods and paths of the requests seen
+  requests = []
+
+  @classmethod
+  def reset(cls):
+    cls.indexes = {}
+    cls.updates = {}
+    cls.pending_polls = 0
+    cls.polls = {}
+    cls.added = []
+    cls.deleted = []
+    cls.requests = []
+
+  def log_message(self, *args):
+    pass
+
+  def reply(self, body=None, code=200):
+    self.send_response(code)
+    if body is None:
+      self.end_headers()
+      return
+    data = json.dumps(body).encode()
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def read_body(self):
+    length = int(self.headers.get("Content-Length", 0))
+    return json.loads(self.rfile.read(length)) if length else None
+
+  def enqueue(self, error=None):
+    update_id = len(StandIn.updates)
+    StandIn.updates[update_id] = {
+        "updateId": update_id,
+        "status": "failed" if error else "processed",
+        "error": error,
+    }
+    self.reply({"updateId": update_id}, 202)
+
+  def handle_request(self, method):
+    url = urlparse(self.path)
+    parts = url.path.strip("/").split("/")
+    StandIn.requests.append((method, url.path))
+    body = self.read_body() if method in ("POST", "PUT") else None
+
+    if parts == ["indexes"]:
+      if method == "GET":
+        return self.reply([{
+            "uid": uid,
+            "createdAt": index["createdAt"]
+        } for uid, index in StandIn.indexes.items()])
+      StandIn.indexes[body["uid"]] = {
+          "createdAt": datetime.now().isoformat(),
+          "settings": {},
+          "documents": {},
+      }
+      return self.reply({"uid": body["uid"]}, 201)
+
+    index = StandIn.indexes.get(parts[1])
+    if index is None:
+      return self.reply({"message": "Index not found"}, 404)
+    rest = parts[2:]
+    if rest == [] and method == "DELETE":
+      del StandIn.indexes[parts[1]]
+      return self.reply(code=204)
+    if rest == ["stats"]:
+      return self.reply({"numberOfDocuments": len(index["documents"])})
+    if rest == ["settings"]:
+      if method == "GET":
+        return self.reply(index["settings"])
+      index["settings"] = body
+      return self.enqueue()
+    if rest == ["documents"] and method == "GET":
+      query = {k: v[0] for k, v in parse_qs(url.query).items()}
+      offset = int(query.get("offset", 0))
+      limit = int(query.get("limit", 20))
+      fields = query.get("attributesToRetrieve", "").split(",")
+      docs = list(index["documents"].values())[offset:offset + limit]
+      return self.reply([{k: v for k, v in doc.items() if k in fields}
+                         for doc in docs])
+    if rest == ["documents"]:
+      StandIn.added.append([doc["ms-id"] for doc in body])
+      # a document can make its whole update fail
+      if any(doc.get("title") == "unindexable" for doc in body):
+        return self.enqueue("invalid document")
+      index["documents"].update({doc["ms-id"]: doc for doc in body})
+      return self.enqueue()
+    if rest == ["documents", "delete-batch"]:
+      StandIn.deleted.append(body)
+      for ms_id in body:
+        index["documents"].pop(ms_id, None)
+      return self.enqueue()
+    if rest[0] == "updates":
+      update_id = int(rest[1])
+      polls = StandIn.polls[update_id] = StandIn.polls.get(update_id, 0) + 1
+      if polls <= StandIn.pending_polls:
+        return self.reply({"updateId": update_id, "status": "enqueued"})
+      return self.reply(StandIn.updates[update_id])
+    self.reply({"message": "Not found"}, 404)
+
+  def do_GET(self):
+    self.handle_request("GET")
+
+  def do_POST(self):
+    self.handle_request("POST")
+
+  def do_PUT(self):
+    self.handle_request("PUT")
+
+  def do_DELETE(self):
+    self.handle_request("DELETE")
+
+
+@pytest.fixture(scope="module")
+def server():
+  httpd = HTTPServer(("127.0.0.1", 0), StandIn)
+  thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+  thread.start()
+  yield f"http://127.0.0.1:{httpd.server_port}"
+  httpd.shutdown()
+
+
+def get_articles():
+  return db.Article._get_collection().find({"url": {"$regex": f"^{HOST}/"}})
+
+
+def clear():
+  db.SearchIndex.objects(name=TRIALS_INDEX).delete()
+  db.Article._get_collection().delete_many({"url": {"$regex": f"^{HOST}/"}})
+
+
+@pytest.fixture
+def meili(server, monkeypatch):
+  StandIn.reset()
+  monkeypatch.setenv("MEILI_URL", server)
+  monkeypatch.setattr(ms, "TRIALS_INDEX", TRIALS_INDEX)
+  monkeypatch.setattr(upload, "POLL_INTERVAL", 0)
+  clear()
+  yield StandIn
+  clear()
+
+
+def add_articles(*titles):
+  db.bulk_upsert(db.Article, [{
+      "url": f"{HOST}/{i}",
+      "title": title,
+      "timestamp": datetime(2020, 1, i + 1),
+  } for i, title in enumerate(titles)])
+  return {
+      article["url"]: str(article["_id"]) for article in get_articles()
+  }
+
+
+def get_documents(meili, uid):
+  return meili.indexes[uid]["documents"]
+
+
+def test_sync_only_sends_changed_documents(meili):
+  ids = add_articles("First", "Second", "Third")
+  search.sync_to_meili()
+  documents = get_documents(meili, TRIALS_INDEX)
+  assert set(ids.values()) <= set(documents)
+
+  # change one article, delete another, and leave the third alone
+  db.bulk_upsert(db.Article, [{
+      "url": f"{HOST}/0",
+      "title": "First, edited",
+      "timestamp": datetime(2020, 1, 1),
+  }])
+  db.Article._get_collection().delete_one({"url": f"{HOST}/1"})
+  meili.added = []
+  search.sync_to_meili()
+
+  assert meili.added == [[ids[f"{HOST}/0"]]]
+  assert meili.deleted == [[ids[f"{HOST}/1"]]]
+  assert documents[ids[f"{HOST}/0"]]["title"] == "First, edited"
+  assert ids[f"{HOST}/1"] not in documents
+  assert documents[ids[f"{HOST}/2"]]["title"] == "Third"
+
+
+def test_export_documents_shape(meili):
+  ids = add_articles("Trial")
+  [document] = search.export_documents(list(ids.values()))
+
+  assert document["ms-id"] == ids[f"{HOST}/0"]
+  assert "_id" not in document
+  assert document["title"] == "Trial"
+  assert document["timestamp"] == {"$date": 1577836800000}
+  assert document["parsed_timestamp"] == int(datetime(2020, 1, 1).timestamp())
+  assert document["content_hash"]
+
+
+def make_documents(count, title="Trial"):
+  return [{"ms-id": str(i), "title": title} for i in range(count)]
+
+
+def make_live_index(meili, count):
+  """
+  Start from a rebuilt index of `count` documents, and return its uid.
+  """
+  search.rebuild_meili(make_documents(count))
+  return ms.get_active_index_uid()
+
+
+def test_rebuild_switches_searches_to_the_new_index(meili):
+  # before the first rebuild, the original index serves
+  ms.get_ms_trials_index(None)
+  meili.indexes[TRIALS_INDEX]["settings"] = {"searchableAttributes": ["title"]}
+
+  search.rebuild_meili(make_documents(5))
+  uid = ms.get_active_index_uid()
+  assert uid.startswith(f"{TRIALS_INDEX}-")
+  assert len(get_documents(meili, uid)) == 5
+  # the new generation is set up like the live one
+  assert meili.indexes[uid]["settings"] == {"searchableAttributes": ["title"]}
+  # the old one is kept for rollbacks
+  assert TRIALS_INDEX in meili.indexes
+
+
+def test_rebuild_with_too_few_documents_is_rejected(meili, monkeypatch):
+  live = make_live_index(meili, 10)
+  # rebuilds in the same second would share a uid
+  monkeypatch.setattr(search.time, "time", lambda: 0)
+
+  with pytest.raises(Exception, match="Only 8 documents"):
+    search.rebuild_meili(make_documents(8))
+  assert ms.get_active_index_uid() == live
+  assert f"{TRIALS_INDEX}-0" not in meili.indexes
+
+  search.rebuild_meili(make_documents(9))
+  assert ms.get_active_index_uid() == f"{TRIALS_INDEX}-0"
+
+
+def test_rebuild_with_a_failed_chunk_is_rejected(meili, monkeypatch):
+  live = make_live_index(meili, 2)
+  monkeypatch.setattr(search.time, "time", lambda: 0)
+  documents = make_documents(1) + make_documents(1, "unindexable")
+
+  with pytest.raises(upload.UploadError, match="1 of 1 updates failed"):
+    search.rebuild_meili(documents)
+  assert ms.get_active_index_uid() == live
+  assert f"{TRIALS_INDEX}-0" not in meili.indexes
+
+
+def test_old_generations_are_collected(meili, monkeypatch):
+  monkeypatch.setattr(search, "KEPT_GENERATIONS", 2)
+  meili.indexes = {
+      uid: {
+          "createdAt": created,
+          "settings": {},
+          "documents": {}
+      } for uid, created in [
+          (TRIALS_INDEX, "2020-01-01"),
+          (f"{TRIALS_INDEX}-1", "2020-01-02"),
+          (f"{TRIALS_INDEX}-2", "2020-01-03"),
+          (f"{TRIALS_INDEX}-3", "2020-01-04"),
+          (f"{TRIALS_INDEX}-4", "2020-01-05"),
+          ("patients", "2020-01-01"),
+      ]
+  }
+
+  # a rolled back generation is kept even if it's old
+  search.collect_generations(ms.get_ms_client(), f"{TRIALS_INDEX}-1")
+  assert set(meili.indexes) == {
+      f"{TRIALS_INDEX}-1",
+      f"{TRIALS_INDEX}-3",
+      f"{TRIALS_INDEX}-4",
+      "patients",
+  }
+
+
+def test_cached_index_is_checked_again_after_the_ttl(meili, monkeypatch):
+  monkeypatch.setattr(ms, "cached_index", {
+      "uid": None,
+      "index": None,
+      "checked": 0
+  })
+  client = ms.get_ms_client()
+  assert ms.get_cached_trials_index(client).uid == TRIALS_INDEX
+
+  live = make_live_index(meili, 1)
+  meili.requests = []
+  assert ms.get_cached_trials_index(client).uid == TRIALS_INDEX
+  # served from the cache without asking Meilisearch
+  assert meili.requests == []
+
+  ms.cached_index["checked"] -= ms.CACHED_INDEX_TTL
+  assert ms.get_cached_trials_index(client).uid == live
+
+
+def test_failed_chunks_are_reported(meili):
+  index = ms.get_ms_trials_index(None)
+  documents = make_documents(3) + make_documents(1, "unindexable")
+  documents[3]["ms-id"] = "3"
+
+  results = upload.upload_documents(index,
+                                    documents,
+                                    chunk_size=2,
+                                    max_in_flight=1)
+  assert [r["size"] for r in results] == [2, 2]
+  assert results[0]["error"] is None
+  assert "invalid document" in results[1]["error"]
+  # the other chunk went through
+  assert set(get_documents(meili, TRIALS_INDEX)) == {"0", "1"}
+
+
+def test_update_is_polled_less_often_until_processed(meili, monkeypatch):
+  index = ms.get_ms_trials_index(None)
+  monkeypatch.setattr(upload, "POLL_INTERVAL", 1)
+  monkeypatch.setattr(upload, "MAX_POLL_INTERVAL", 4)
+  sleeps = []
+  monkeypatch.setattr(upload.time, "sleep", sleeps.append)
+  meili.pending_polls = 4
+
+  update_id = index.add_documents(make_documents(1)).get("updateId")
+  status = upload.wait_for_update(index, update_id)
+  assert status["status"] == "processed"
+  assert sleeps == [1, 2, 4, 4]
+
+  update_id = index.add_documents(make_documents(1, "unindexable"))["updateId"]
+  with pytest.raises(upload.UploadError, match="invalid document"):
+    upload.wait_for_update(index, update_id)
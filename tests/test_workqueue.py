@@ -0,0 +1,402 @@
+# Copyright 2020 The Feverbase Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+The workers run in processes of their own, against the test database, so
+they only share what goes through Mongo. The stand-in faucets note what
+they do in files, which every process can see.
+"""
+
+import os
+import time
+import multiprocessing
+from datetime import datetime, timedelta
+
+import pytest
+
+import fetch
+from fetch import workqueue
+from crawler import checkpoint, parsing
+from utils import db, location
+
+# directory the stand-in faucets note what they do in
+state_dir = None
+# worker processes and runs started by the current test
+processes = []
+runs = []
+
+
+def note(name, line=""):
+  with open(os.path.join(state_dir, name), "a") as f:
+    f.write(f"{line}\n")
+
+
+def read(name):
+  path = os.path.join(state_dir, name)
+  if not os.path.exists(path):
+    return []
+  with open(path) as f:
+    return f.read().splitlines()
+
+
+def first_time(name):
+  """
+  Return True the first time this is called with `name`, in any process.
+  """
+  try:
+    os.close(os.open(os.path.join(state_dir, name), os.O_CREAT | os.O_EXCL))
+    return True
+  except FileExistsError:
+    return False
+
+
+class Listed:
+  """
+  Lists 3 pages of trials per query. Both queries find the "shared" trials.
+  """
+  SOURCE = "listed.test"
+  START_DATE = datetime(2020, 1, 1)
+
+  @staticmethod
+  def find(query, existing, since, start_page=0):
+    for page in range(start_page, 3):
+      for url in [f"{query}/{page}", f"shared/{page}"]:
+        url = f"https://listed.test/{url}"
+        if url in existing:
+          continue
+        existing.add(url)
+        note("found", url)
+        yield {"_source": Listed.SOURCE, "url": url, "title": query}
+      yield checkpoint.PageDone(page)
+
+  @staticmethod
+  def translate(info):
+    return {"url": info["url"], "title": info["title"]}
+
+
+class Split:
+  """
+  Queues a detail unit per trial, and fails the first attempt at one.
+  """
+  SOURCE = "split.test"
+  START_DATE = datetime(2020, 1, 1)
+  SPLITS_DETAILS = True
+
+  @staticmethod
+  def list_details(query, existing, since):
+    return [{
+        "_source": Split.SOURCE,
+        "url": f"https://split.test/{i}"
+    } for i in range(10)]
+
+  @staticmethod
+  def fetch_details(infos):
+    for info in infos:
+      if info["url"].endswith("/7"):
+        note("flaky")
+        if first_time("flaky failed"):
+          raise RuntimeError("flaky")
+      yield {**info, "title": "detail"}
+
+  @staticmethod
+  def translate(info):
+    return {"url": info["url"], "title": info["title"]}
+
+
+class Broken:
+  SOURCE = "broken.test"
+  START_DATE = datetime(2020, 1, 1)
+
+  @staticmethod
+  def find(query, existing, since, start_page=0):
+    raise RuntimeError("down")
+
+
+class Hanging:
+  """
+  Hangs on the first listing it is asked for, until its worker is killed.
+  """
+  SOURCE = "hanging.test"
+  START_DATE = datetime(2020, 1, 1)
+
+  @staticmethod
+  def find(query, existing, since, start_page=0):
+    note("attempts", query)
+    if first_time("hanging"):
+      time.sleep(600)
+    yield {
+        "_source": Hanging.SOURCE,
+        "url": f"https://hanging.test/{query}",
+        "title": query
+    }
+
+  @staticmethod
+  def translate(info):
+    return {"url": info["url"], "title": info["title"]}
+
+
+FAUCETS = {faucet.SOURCE: faucet for faucet in [Listed, Split, Broken, Hanging]}
+SOURCES = [Listed.SOURCE, Split.SOURCE, Broken.SOURCE]
+SETTINGS = {
+    "MAX_ATTEMPTS": 3,
+    "RETRY_DELAY": timedelta(0),
+    "POLL_INTERVAL": 0.05,
+}
+
+
+def get_queries(faucet):
+  return ["a", "b"]
+
+
+def use_stand_ins(set, directory, sources=SOURCES, **settings):
+  """
+  Crawl the stand-in faucets of `sources` with the queue `settings`, and
+  leave the filter options and search index alone. `set` is
+  monkeypatch.setattr in the test, setattr in a worker process.
+  """
+  global state_dir
+  state_dir = directory
+  set(fetch, "DRIPPING_FAUCETS", {source: FAUCETS[source] for source in sources})
+  set(fetch, "get_queries", get_queries)
+  for name, value in {**SETTINGS, **settings}.items():
+    set(workqueue, name, value)
+  set(workqueue.filters, "preload_filter_options", lambda: None)
+  set(workqueue, "mongo_to_meili", lambda: note("finished"))
+  set(location, "BASE_URL", None)
+  set(parsing, "PROCESSES", 0)
+
+
+def work(name, directory, sources, settings):
+  use_stand_ins(setattr, directory, sources, **settings)
+  workqueue.Worker(name).run()
+
+
+def start_run():
+  run = workqueue.start_run()
+  runs.append(run)
+  return run
+
+
+def start_workers(count, sources=SOURCES, **settings):
+  context = multiprocessing.get_context("spawn")
+  started = [
+      context.Process(target=work,
+                      args=(f"worker {len(processes) + i}", state_dir, sources,
+                            settings)) for i in range(count)
+  ]
+  for process in started:
+    process.start()
+  processes.extend(started)
+  return started
+
+
+def run_workers(count, sources=SOURCES, **settings):
+  for process in start_workers(count, sources, **settings):
+    process.join(timeout=120)
+    assert process.exitcode == 0
+
+
+def wait_for(condition, timeout=60):
+  deadline = time.time() + timeout
+  while not condition():
+    assert time.time() < deadline
+    time.sleep(0.1)
+
+
+def get_articles():
+  # the stand-in faucets' trials are all on their SOURCE host
+  hosts = "|".join(source.replace(".", "\\.") for source in FAUCETS)
+  return db.Article._get_collection().find(
+      {"url": {
+          "$regex": f"^https://({hosts})/"
+      }})
+
+
+def get_urls():
+  return {article["url"] for article in get_articles()}
+
+
+def clear():
+  """
+  Delete what these tests put in the shared test database, and nothing
+  else.
+  """
+  sources = list(FAUCETS)
+  workqueue.get_collection().delete_many({
+      "$or": [{
+          "source": {
+              "$in": sources
+          }
+      }, {
+          "run": {
+              "$in": runs
+          }
+      }]
+  })
+  db.Article._get_collection().delete_many(
+      {"_id": {
+          "$in": [article["_id"] for article in get_articles()]
+      }})
+  db.Watermark.objects(source__in=sources).delete()
+
+
+@pytest.fixture
+def queue(monkeypatch, tmp_path):
+  use_stand_ins(monkeypatch.setattr, str(tmp_path))
+  clear()
+  yield
+  for process in processes:
+    if process.is_alive():
+      process.kill()
+    process.join()
+  processes.clear()
+  clear()
+  runs.clear()
+
+
+def get_units():
+  return {
+      unit["key"]: unit
+      for unit in workqueue.get_collection().find(
+          {"source": {
+              "$in": list(FAUCETS)
+          }})
+  }
+
+
+def get_finish_unit(run):
+  return workqueue.get_collection().find_one({"key": f"finish:{run}"})
+
+
+def test_workers_share_a_run(queue):
+  run = start_run()
+  run_workers(3)
+
+  # done units were cleaned up, the broken source's are kept
+  units = get_units()
+  assert {key: unit["state"] for key, unit in units.items()} == {
+      "listing:broken.test:a": "dead",
+      "listing:broken.test:b": "dead",
+  }
+  assert units["listing:broken.test:a"]["attempts"] == 3
+  assert units["listing:broken.test:a"]["error"] == "down"
+  # finish ran once, after everything else
+  finish = get_finish_unit(run)
+  assert finish["state"] == "done"
+  assert finish["attempts"] == 1
+  assert len(read("finished")) == 1
+
+  # the flaky detail was retried
+  assert len(read("flaky")) == 2
+  urls = get_urls()
+  assert {f"https://split.test/{i}" for i in range(10)} <= urls
+  # listings running at the same time may both find a shared trial
+  assert {url for url in urls if "listed.test" in url} == set(read("found"))
+  assert len(set(read("found"))) == 9
+
+  watermarks = db.Watermark.objects(source__in=SOURCES)
+  assert {mark.source for mark in watermarks} == {Listed.SOURCE, Split.SOURCE}
+
+
+def test_listings_skip_trials_other_queries_found(queue):
+  start_run()
+  run_workers(1)
+  assert len(read("found")) == len(set(read("found"))) == 9
+
+
+def test_expired_lease_is_taken_over(queue):
+  run = start_run()
+  stale = workqueue.Worker("stale")
+  unit = stale.lease(source=Listed.SOURCE)
+  workqueue.get_collection().update_one(
+      {"_id": unit["_id"]},
+      {"$set": {
+          "lease_expires": workqueue.now() - timedelta(seconds=1)
+      }})
+
+  run_workers(2)
+
+  # the stale worker can't overwrite what the new owner did
+  assert not stale.update(unit, {"$set": {"state": "queued"}})
+  assert not workqueue.get_collection().find_one({"_id": unit["_id"]})
+  assert get_finish_unit(run)["state"] == "done"
+  assert len(read("finished")) == 1
+
+
+def test_killed_workers_unit_is_taken_over(queue, monkeypatch):
+  settings = {"LEASE": timedelta(seconds=2), "HEARTBEAT_INTERVAL": 0.2}
+  use_stand_ins(monkeypatch.setattr, state_dir, [Hanging.SOURCE], **settings)
+  run = start_run()
+  [hung] = start_workers(1, [Hanging.SOURCE], **settings)
+  wait_for(lambda: read("attempts"))
+  [query] = read("attempts")
+  leased = get_units()[f"listing:hanging.test:{query}"]
+
+  # the heartbeat keeps the lease while the worker is alive
+  time.sleep(3)
+  renewed = get_units()[f"listing:hanging.test:{query}"]
+  assert renewed["state"] == "leased"
+  assert renewed["owner"] == leased["owner"]
+  assert renewed["lease_expires"] > leased["lease_expires"]
+
+  hung.kill()
+  hung.join()
+  run_workers(1, [Hanging.SOURCE], **settings)
+
+  assert read("attempts").count(query) == 2
+  urls = get_urls()
+  assert {"https://hanging.test/a", "https://hanging.test/b"} <= urls
+  assert get_finish_unit(run)["attempts"] == 1
+  assert len(read("finished")) == 1
+
+
+def test_failed_unit_waits_before_retrying(queue, monkeypatch):
+  monkeypatch.setattr(workqueue, "RETRY_DELAY", timedelta(minutes=1))
+  start_run()
+  worker = workqueue.Worker("worker")
+  unit = worker.lease(source=Broken.SOURCE)
+  worker.process(unit)
+
+  failed = workqueue.get_collection().find_one({"_id": unit["_id"]})
+  assert failed["state"] == "queued"
+  delay = failed["available"] - workqueue.now()
+  assert timedelta(seconds=50) < delay <= timedelta(minutes=1)
+  # the other listing is still available
+  other = worker.lease(source=Broken.SOURCE)
+  assert other["_id"] != unit["_id"]
+  assert worker.lease(source=Broken.SOURCE) is None
+
+
+def test_geocoded_articles_get_a_new_content_hash(queue, monkeypatch):
+  location_id = db.Location(institution="Acme",
+                            latitude=1,
+                            longitude=2).save().id
+  monkeypatch.setattr(location, "get_location_ids",
+                      lambda institutions: {"Acme": location_id})
+  url = "https://listed.test/geocoded"
+  db.bulk_upsert(db.Article, [{"url": url, "institution": "Acme"}])
+  collection = db.Article._get_collection()
+  before = collection.find_one({"url": url})
+
+  workqueue.Worker("worker").geocode({
+      "payload": {
+          "institution": "Acme",
+          "countries": []
+      }
+  })
+
+  after = collection.find_one({"url": url})
+  assert after["location_data"] == location_id
+  # the search index sync picks up the change
+  assert after["content_hash"] != before["content_hash"]
+  db.Location.objects(id=location_id).delete()
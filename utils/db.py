@@ -13,13 +13,17 @@
 # limitations under the License.
 
 import os
+import json
+import hashlib
 import datetime
 
+from pymongo import UpdateOne
 from mongoengine import (
     connect,
     BooleanField,
     DateTimeField,
     DecimalField,
+    DictField,
     Document,
     EmailField,
     EmbeddedDocument,
@@ -35,6 +39,9 @@ from mongoengine_mate import ExtendedDocument
 
 from . import config
 
+# upserts sent to Mongo in one bulk write
+BULK_BATCH_SIZE = 1000
+
 # try each env var in order
 if config.MONGODB_URI:
   connect(host=config.MONGODB_URI)
@@ -44,9 +51,15 @@ else:
 
 class Location(ExtendedDocument):
   institution = StringField()
+  # institution with case, punctuation and whitespace folded (see
+  # gazetteer.normalize), or "country:" and the folded name of a country
+  key = StringField(unique=True, sparse=True)
   address = StringField()
+  # both None if geocoding found nothing
   latitude = DecimalField()
   longitude = DecimalField()
+  # when the institution was last geocoded
+  checked = DateTimeField()
 
 
 class Identity(EmbeddedDocument):
@@ -82,6 +95,9 @@ class Article(ExtendedDocument):
   abandoned = BooleanField()
   abandoned_reason = StringField()
 
+  # hash of all the fields above, set by bulk_upsert
+  content_hash = StringField()
+
   # default sort timestamp descending
   meta = {
       "ordering": ["-timestamp"],
@@ -130,6 +146,81 @@ class FilterOption(ExtendedDocument):
   }
 
 
+class SearchIndex(Document):
+  """
+  Which Meilisearch index currently serves `name`. Full rebuilds fill a new
+  index and then point this at it.
+  """
+  name = StringField(unique=True)
+  uid = StringField()
+
+
+class Watermark(Document):
+  """
+  When the last complete crawl of a source started. Incremental runs only
+  ask that source for trials registered since then.
+  """
+  source = StringField(unique=True)
+  timestamp = DateTimeField()
+
+
+class Checkpoint(Document):
+  """
+  Progress of a crawl job that has not finished yet, so a restarted fetch
+  resumes it instead of crawling it again. Only counts what is in Mongo.
+  """
+  source = StringField()
+  query = StringField()
+  full = BooleanField()
+  # when the run that started the job started, for the source's watermark
+  started = DateTimeField()
+  # last listing page finished, for faucets that report their pages
+  page = IntField()
+  urls = ListField(StringField())
+  done = BooleanField(default=False)
+
+  meta = {"indexes": [{"fields": ["source", "query"], "unique": True}]}
+
+
+class WorkUnit(Document):
+  """
+  A piece of crawl work in the queue that `fetch.py --worker` processes pull
+  from: a listing to crawl, a trial detail page, an institution to geocode,
+  or the steps that finish a run. See fetch.workqueue.
+  """
+  run = StringField()
+  kind = StringField()
+  # unique within the run, so queueing the same work twice does nothing
+  key = StringField()
+  source = StringField()
+  payload = DictField()
+  # queued, leased, done or dead (failed too many times)
+  state = StringField(default="queued")
+  attempts = IntField(default=0)
+  # not leased again before this, to back off between retries
+  available = DateTimeField()
+  owner = StringField()
+  lease_expires = DateTimeField()
+  # last listing page saved, for faucets that report their pages
+  page = IntField()
+  # urls a listing saved so far, and once done every url it listed
+  urls = ListField(StringField())
+  error = StringField()
+  finished = DateTimeField()
+
+  meta = {
+      "indexes": [
+          {
+              "fields": ["run", "key"],
+              "unique": True
+          },
+          ("state", "available"),
+          ("state", "lease_expires"),
+          ("run", "state"),
+      ]
+  }
+
+
 class Patient(Document):
   email = StringField()
   first_name = StringField()
@@ -148,3 +239,168 @@ def create(Model, objects):
   """
   docs = list(map(lambda o: Model(**o), objects))
   Model.smart_update(docs, upsert=True)
+
+
+def to_mongo_fields(Model, obj):
+  """
+  Input: Model and one object (dictionary).
+  Output: the object's declared fields converted to their Mongo types.
+
+  Mirrors what building a Model(**obj) and calling to_dict(include_none=False)
+  does: missing or None values take the field's default, and fields that are
+  still None are left out.
+  """
+  fields = {}
+  for name, field in Model._fields.items():
+    if name == "id":
+      continue
+    value = obj.get(name)
+    if value is None:
+      value = field.default() if callable(field.default) else field.default
+    if value is None:
+      continue
+    fields[field.db_field] = field.to_mongo(field.to_python(value))
+  return fields
+
+
+def get_content_hash(fields):
+  """
+  Input: dict of Mongo field values.
+  Output: a stable hash of the values, ignoring any existing content_hash.
+  """
+  content = {k: v for k, v in fields.items() if k != "content_hash"}
+  serialized = json.dumps(content, sort_keys=True, default=str)
+  return hashlib.sha1(serialized.encode()).hexdigest()
+
+
+def bulk_upsert(Model,
+                objects,
+                key="url",
+                batch_size=BULK_BATCH_SIZE,
+                tracked_fields=()):
+  """
+  Input: Model, list of objects (dictionaries) and the unique field to match
+  existing documents on.
+  Output: dict of the inserted, modified and unchanged objects' keys.
+
+  Upserts objects into Model's collection with unordered bulk writes of
+  batch_size, without building a Model document for each object.
+
+  Objects whose fields all match the stored document's are not written at
+  all. If Model has a content_hash field, every object is stored with the
+  hash of its fields and only the hashes are compared. The stored values of
+  tracked_fields of every modified document are also returned, under
+  "previous".
+  """
+  collection = Model._get_collection()
+  hashed = "content_hash" in Model._fields
+  keys = {"inserted": [], "modified": [], "unchanged": [], "previous": []}
+
+  for i in range(0, len(objects), batch_size):
+    batch = [to_mongo_fields(Model, obj) for obj in objects[i:i + batch_size]]
+
+    if hashed:
+      for fields in batch:
+        fields["content_hash"] = get_content_hash(fields)
+      read = {"content_hash"}
+    else:
+      read = {field for fields in batch for field in fields}
+    projection = {field: 1 for field in [key, *read, *tracked_fields]}
+    stored = collection.find(
+        {key: {
+            "$in": [fields[key] for fields in batch]
+        }},
+        projection,
+    )
+    stored = {doc[key]: doc for doc in stored}
+
+    operations = []
+    operation_keys = []
+    for fields in batch:
+      value = fields.pop(key)
+      compared = ["content_hash"] if hashed else fields
+      if value in stored and all(
+          stored[value].get(field) == fields[field] for field in compared):
+        keys["unchanged"].append(value)
+        continue
+      operations.append(
+          UpdateOne({key: value}, {"$set": fields}, upsert=True))
+      operation_keys.append(value)
+
+    if not operations:
+      continue
+    result = collection.bulk_write(operations, ordered=False)
+    inserted = set(result.upserted_ids)
+    for index, value in enumerate(operation_keys):
+      if index in inserted:
+        keys["inserted"].append(value)
+      else:
+        keys["modified"].append(value)
+        if value in stored:
+          keys["previous"].append(
+              {field: stored[value].get(field) for field in tracked_fields})
+
+  return keys
+
+
+def get_watermark(source):
+  """
+  Input: source name.
+  Output: datetime of the source's watermark, or None.
+  """
+  watermark = Watermark.objects(source=source).first()
+  return watermark.timestamp if watermark else None
+
+
+def set_watermark(source, timestamp):
+  """
+  Input: source name and datetime.
+  Output: None
+
+  Moves the source's watermark forward to timestamp, never backwards.
+  """
+  current = get_watermark(source)
+  if current and current >= timestamp:
+    return
+  Watermark.objects(source=source).update_one(upsert=True,
+                                              set__timestamp=timestamp)
+
+
+def save_checkpoint(source, query, full, started, urls=(), **fields):
+  """
+  Input: the crawl job's source and query, whether it is a full crawl, when
+  its run started, the urls it saved since the last call and any other
+  Checkpoint fields to set.
+  Output: None
+  """
+  Checkpoint._get_collection().update_one(
+      {
+          "source": source,
+          "query": query
+      },
+      {
+          "$set": {
+              "full": full,
+              **fields
+          },
+          "$setOnInsert": {
+              "started": started
+          },
+          "$addToSet": {
+              "urls": {
+                  "$each": list(urls)
+              }
+          },
+      },
+      upsert=True,
+  )
+
+
+def clear_checkpoints(source):
+  """
+  Input: source name.
+  Output: None
+
+  Forgets the progress of the source's jobs once a run has finished them.
+  """
+  Checkpoint.objects(source=source).delete()
@@ -0,0 +1,257 @@
+# Copyright 2020 The Feverbase Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Places looked up offline, so most trials get a location without asking the
+Maps API.
+
+gazetteer.tsv lists countries, regions and cities with their coordinates.
+`python -m utils.gazetteer` (or the first lookup after it changed) builds it
+into gazetteer.bin: a table of fixed size records sorted by a hash of each
+normalized name, followed by the place names. The table is memory-mapped
+and binary searched, so it costs next to nothing to load and the pages are
+shared by every process.
+"""
+
+import os
+import re
+import sys
+import mmap
+import struct
+import hashlib
+import logging
+import threading
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+SOURCE_PATH = os.path.join(DIRECTORY, "gazetteer.tsv")
+TABLE_PATH = os.path.join(DIRECTORY, "gazetteer.bin")
+
+MAGIC = b"GAZ1"
+# magic, number of records, offset of the names
+HEADER = struct.Struct("<4sII")
+# name hash, country code, kind, latitude, longitude, offset of the place's
+# name from the start of the names
+RECORD = struct.Struct("<Q2sBffI")
+# more specific kinds come later
+KINDS = ["country", "region", "city"]
+# longest place name, in words, looked for in an institution
+MAX_WORDS = 4
+
+Place = namedtuple("Place",
+                   ["name", "country", "kind", "latitude", "longitude"])
+
+table = None
+table_lock = threading.Lock()
+
+
+def normalize(name):
+  """Fold case, punctuation and whitespace out of a name
+
+    Spellings that only differ in those share a cache entry, so
+    "Mayo Clinic", "mayo clinic." and "MAYO  CLINIC" are geocoded once.
+    """
+  name = re.sub(r"[^\w\s]|_", " ", name.casefold())
+  return " ".join(name.split())
+
+
+def get_hash(key):
+  return int.from_bytes(
+      hashlib.blake2b(key.encode(), digest_size=8).digest(), "little")
+
+
+def build(source_path=SOURCE_PATH, table_path=TABLE_PATH):
+  """
+  Build the table at `table_path` from the places listed in `source_path`.
+  """
+  records = []
+  names = bytearray()
+  hashed = {}
+  with open(source_path, encoding="utf-8") as f:
+    for line in f:
+      if not line.strip() or line.startswith("#"):
+        continue
+      kind, country, latitude, longitude, spellings = line.rstrip(
+          "\n").split("\t")
+      spellings = spellings.split("|")
+      offset = len(names)
+      names += spellings[0].encode() + b"\0"
+      keys = {normalize(spelling) for spelling in spellings}
+      for key in keys:
+        key_hash = get_hash(key)
+        if hashed.setdefault(key_hash, key) != key:
+          raise ValueError(f"{key!r} and {hashed[key_hash]!r} hash the same")
+        records.append((key_hash, country.encode(), KINDS.index(kind),
+                        float(latitude), float(longitude), offset))
+
+  # sorting is stable, so places sharing a name stay in listed order
+  records.sort(key=lambda record: record[0])
+  names_offset = HEADER.size + RECORD.size * len(records)
+  # write then rename, so other processes never map a half written table
+  tmp_path = f"{table_path}.{os.getpid()}.tmp"
+  with open(tmp_path, "wb") as f:
+    f.write(HEADER.pack(MAGIC, len(records), names_offset))
+    for record in records:
+      f.write(RECORD.pack(*record))
+    f.write(names)
+  os.replace(tmp_path, table_path)
+  logger.info(f"Built {len(records)} place names into {table_path}")
+
+
+class Table:
+  """
+  Read-only view of a built gazetteer table.
+  """
+
+  def __init__(self, path=TABLE_PATH):
+    with open(path, "rb") as f:
+      self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, self.count, self.names_offset = HEADER.unpack_from(self.data)
+    if magic != MAGIC:
+      raise ValueError(f"{path} is not a gazetteer table")
+    self.country_names = None
+
+  def get_record(self, i):
+    return RECORD.unpack_from(self.data, HEADER.size + RECORD.size * i)
+
+  def get_hash(self, i):
+    return struct.unpack_from("<Q", self.data, HEADER.size + RECORD.size * i)[0]
+
+  def get_name(self, offset):
+    start = self.names_offset + offset
+    return self.data[start:self.data.find(b"\0", start)].decode()
+
+  def to_place(self, record):
+    _, country, kind, latitude, longitude, offset = record
+    return Place(self.get_name(offset), country.decode(), KINDS[kind],
+                 round(latitude, 4), round(longitude, 4))
+
+  def lookup(self, key):
+    """
+    Return the places named `key`, which must be normalized, in listed order.
+    """
+    key_hash = get_hash(key)
+    low, high = 0, self.count
+    while low < high:
+      middle = (low + high) // 2
+      if self.get_hash(middle) < key_hash:
+        low = middle + 1
+      else:
+        high = middle
+    places = []
+    while low < self.count and self.get_hash(low) == key_hash:
+      places.append(self.to_place(self.get_record(low)))
+      low += 1
+    return places
+
+  def get_country_name(self, code):
+    if self.country_names is None:
+      # the first country listed with a code names it
+      first = {}
+      for i in range(self.count):
+        _, country, kind, _, _, offset = self.get_record(i)
+        if KINDS[kind] == "country":
+          country = country.decode()
+          first[country] = min(first.get(country, offset), offset)
+      self.country_names = {
+          country: self.get_name(offset) for country, offset in first.items()
+      }
+    return self.country_names.get(code)
+
+
+def get_table():
+  """
+  Return the gazetteer table, building it first if it's missing or older
+  than gazetteer.tsv.
+  """
+  global table
+  with table_lock:
+    if table is None:
+      if is_stale(SOURCE_PATH, TABLE_PATH):
+        build(SOURCE_PATH, TABLE_PATH)
+      table = Table(TABLE_PATH)
+    return table
+
+
+def is_stale(source_path, table_path):
+  if not os.path.exists(table_path):
+    return True
+  if os.path.getmtime(source_path) > os.path.getmtime(table_path):
+    logger.warn(f"{source_path} changed, rebuilding {table_path}")
+    return True
+  return False
+
+
+def find_countries(text):
+  """
+  Return the countries named in a trial's `location`, a list of country
+  names separated by newlines, commas or semicolons. Names that have commas
+  of their own, like "Korea, Republic of", are recognized too.
+  """
+  parts = [normalize(part) for part in re.split(r"[\n;,]", text or "")]
+  parts = [part for part in parts if part]
+  countries = []
+  i = 0
+  while i < len(parts):
+    for size in [2, 1]:
+      if i + size > len(parts):
+        continue
+      key = " ".join(parts[i:i + size])
+      places = [p for p in get_table().lookup(key) if p.kind == "country"]
+      if places:
+        if places[0] not in countries:
+          countries.append(places[0])
+        i += size
+        break
+    else:
+      i += 1
+  return countries
+
+
+def find_place(text, countries=None):
+  """
+  Return the most specific place named in `text`, typically an institution
+  like "Hôpital Européen Georges Pompidou, Paris", or None.
+
+  Runs of up to MAX_WORDS words are looked up, longest first. Cities beat
+  regions, which beat countries. If `countries` (ISO codes) is given, only
+  places in them are returned.
+  """
+  words = normalize(text or "").split()
+  best = None
+  for size in range(min(MAX_WORDS, len(words)), 0, -1):
+    for i in range(len(words) - size + 1):
+      for place in get_table().lookup(" ".join(words[i:i + size])):
+        if countries and place.country not in countries:
+          continue
+        if best is None or KINDS.index(place.kind) > KINDS.index(best.kind):
+          best = place
+        break
+  return best
+
+
+def get_address(place):
+  """
+  Return a human readable address for `place`, like "Lyon, France".
+  """
+  country = get_table().get_country_name(place.country)
+  if place.kind == "country" or not country:
+    return place.name
+  return f"{place.name}, {country}"
+
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.INFO)
+  build(*sys.argv[1:])
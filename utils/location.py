@@ -15,11 +15,17 @@
 import os
 import sys
 import json
-import re
-import requests
 import logging
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from . import db
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from . import db, gazetteer
+from .gazetteer import normalize
+from crawler import client
 
 from dotenv import load_dotenv
 
@@ -27,105 +33,282 @@ load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+# Maps requests per second, and lookups running at once
+RATE_LIMIT = 25
+MAX_WORKERS = 8
+# institutions Maps found nothing for aren't looked up again until then
+NEGATIVE_TTL = timedelta(days=30)
+
 BASE_URL = None
 if os.environ.get("GOOGLE_MAPS_KEY"):
   key = os.environ.get("GOOGLE_MAPS_KEY")
   BASE_URL = f"https://maps.googleapis.com/maps/api/geocode/json?key={key}"
+  client.set_rate_limit(BASE_URL, RATE_LIMIT)
+
+# {normalized institution: entry}, see load_cache
+cache = None
+cache_lock = threading.Lock()
 
 
-def add_location_data(articles):
+def add_location_data(articles, use_maps=True):
   """Add location information to every article in a list
 
-    For every article in a list, extract the institution name.
-    Every institution name is looked-up in the Mongo database,
-    if there is already a name->location mapping for the institution,
-    skip it. If there isn't a mapping, make a Google Maps API call.
+    For every article in a list, extract the institution name and the
+    countries it lists. Every institution name is looked-up in the Mongo
+    database, then in the offline gazetteer, and only if both come up empty
+    (and `use_maps` is set) with the Google Maps API.
 
-    Once we have ensured every institution name has a corresponding
-    Mongo ID, iterate through articles, looking up each institution
-    name locaiton_mappings.
+    Articles whose institution couldn't be placed get the location of the
+    first country they list instead.
 
     Return the list of articles
     """
   logger.warn("Adding location data...")
-  institutions = [a.get("institution") for a in articles]
+  institutions = get_institutions(articles)
 
   # get locations for given institutions
-  location_ids = get_location_ids(institutions)
+  location_ids = get_location_ids(institutions, use_maps=use_maps)
+  countries = [
+      gazetteer.find_countries(article.get("location")) for article in articles
+  ]
+  country_ids = get_country_location_ids(
+      [found[0] for found in countries if found])
 
   # add an article's location data, based on its institution
-  for article in articles:
+  for article, found in zip(articles, countries):
     article["location_data"] = None
     institution = article.get("institution")
-    if institution:
-      location_id = location_ids.get(institution)
-      if location_id:
-        article["location_data"] = location_id
+    if institution and location_ids.get(institution):
+      article["location_data"] = location_ids[institution]
+    elif found:
+      article["location_data"] = country_ids.get(found[0].name)
 
   return articles
 
 
-def get_location_ids(queries):
-  """Return a dict of institution queries db location ID for the given queries.
+def get_institutions(articles):
+  """Return a dict of the articles' institutions to the ISO codes of the
+    countries their trials list
+    """
+  institutions = {}
+  for article in articles:
+    institution = article.get("institution")
+    if institution:
+      countries = institutions.setdefault(institution, [])
+      for place in gazetteer.find_countries(article.get("location")):
+        if place.country not in countries:
+          countries.append(place.country)
+  return institutions
+
+
+def is_fresh(entry):
+  # found locations never expire, failed lookups are retried after a while
+  if not entry:
+    return False
+  return entry["found"] or entry["checked"] > datetime.now() - NEGATIVE_TTL
 
-    Pull every location from MongoDB. Iterate through queries
-    (every institution in articles) and see which ones are already
-    present in MongoDB (Location collection). For those that are not,
-    make a call to Maps API and store result in an array. At the end,
-    insert all "new" location_data to Location collection. Then,
-    return a dictionary with location institutions mapping to document ID.
+
+def load_cache():
+  """Return the in-memory view of the geocode cache, loading it first
+
+    Maps each normalized institution name to its Location's ID, whether
+    geocoding it found anything and when it was last tried. Locations
+    stored before names were normalized get their key here.
     """
-  if not BASE_URL:
-    return {}
+  global cache
+  with cache_lock:
+    if cache is not None:
+      return cache
 
-  all_location_objects = db.Location.objects().only("institution")
-  stored_institutions = [i.institution for i in all_location_objects]
+    cache = {}
+    collection = db.Location._get_collection()
+    fields = {"key": 1, "institution": 1, "latitude": 1, "checked": 1}
+    for doc in collection.find({}, fields):
+      key = doc.get("key")
+      if not key and doc.get("institution"):
+        key = normalize(doc["institution"])
+        try:
+          collection.update_one({"_id": doc["_id"]}, {"$set": {"key": key}})
+        except DuplicateKeyError:
+          # another spelling of it is stored already
+          continue
+      if key:
+        cache[key] = to_entry(doc)
+    return cache
 
-  # for every 'new' instution (i.e. not present in stored_institution),
-  # geocode using Google Maps API
-  new_location_names = [
-      inst for inst in queries if inst not in stored_institutions
-  ]
-  # remove duplicates
-  new_location_names = list(set(new_location_names))
-  new_location_data = []
-
-  for i, inst in enumerate(new_location_names):
-    try:
-      this_location_data = geocode_query(inst)
-      if this_location_data:
-        new_location_data.append(this_location_data)
-        logger.info(
-            f"[{i + 1}/{len(new_location_names)}] Geocoded institution {inst}")
+
+def to_entry(doc):
+  return {
+      "id": doc["_id"],
+      "found": doc.get("latitude") is not None,
+      "checked": doc.get("checked") or datetime.min,
+  }
+
+
+def get_location_ids(queries, use_maps=True):
+  """Return a dict of institution queries to db location ID for the queries.
+
+    `queries` is a list of institution names, or a dict of them to the ISO
+    codes of the countries their trials list, see get_institutions.
+
+    Every query is looked up by its normalized name, first in the in-memory
+    view of the Location collection, then in Mongo itself (other fetch
+    workers may have added it since the view was loaded). Names still
+    missing are looked for in the gazetteer, keeping to the query's
+    countries. The rest are geocoded with the Maps API in one concurrent
+    batch, unless `use_maps` is off. Results are stored, failed Maps lookups
+    included so they aren't repeated before NEGATIVE_TTL.
+    """
+  countries = queries if isinstance(queries, dict) else {}
+  names = {query: normalize(query) for query in queries if query}
+  view = load_cache()
+
+  missing = {key for key in names.values() if not is_fresh(view.get(key))}
+  if missing:
+    docs = db.Location._get_collection().find(
+        {"key": {
+            "$in": list(missing)
+        }}, {
+            "key": 1,
+            "latitude": 1,
+            "checked": 1
+        })
+    with cache_lock:
+      for doc in docs:
+        view[doc["key"]] = to_entry(doc)
+    missing = {key for key in missing if not is_fresh(view.get(key))}
+
+  # look up one spelling of each name
+  spellings = {key: name for name, key in names.items() if key in missing}
+  if spellings:
+    placed = place_all(spellings, countries)
+    store(placed)
+    for key in placed:
+      del spellings[key]
+
+  if spellings and use_maps and BASE_URL:
+    store(geocode_all(spellings))
+
+  return {
+      name: view[key]["id"]
+      for name, key in names.items()
+      if key in view and view[key]["found"]
+  }
+
+
+def place_all(spellings, countries):
+  """Find institution names in the gazetteer
+
+    Takes {normalized name: institution name} and {institution name:
+    country codes}. Returns {normalized name: location details} for the
+    names a city was found in, leaving the rest to Maps. A name that only
+    matches a region or country is as likely a university or hospital
+    somewhere in it, and its trials still get the country if Maps fails.
+    """
+  results = {}
+  for key, name in spellings.items():
+    place = gazetteer.find_place(name, countries.get(name))
+    if place and place.kind == "city":
+      results[key] = {
+          "institution": name,
+          "address": gazetteer.get_address(place),
+          "latitude": place.latitude,
+          "longitude": place.longitude,
+      }
+  if results:
+    logger.info(
+        f"Placed {len(results)} of {len(spellings)} institutions offline")
+  return results
+
+
+def get_country_location_ids(countries):
+  """Return a dict of country names to db location ID for gazetteer
+    countries, storing the Locations of the ones that have none yet
+    """
+  keys = {}
+  missing = {}
+  view = load_cache()
+  for country in countries:
+    key = keys[country.name] = f"country:{normalize(country.name)}"
+    if key not in view:
+      missing[key] = {
+          "address": country.name,
+          "latitude": country.latitude,
+          "longitude": country.longitude,
+      }
+  store(missing)
+  return {name: view[key]["id"] for name, key in keys.items() if key in view}
+
+
+def geocode_all(spellings):
+  """Geocode institution names with up to MAX_WORKERS concurrent requests
+
+    Takes {normalized name: institution name}. Returns {normalized name:
+    location details}, with no coordinates if Maps found nothing. Names whose lookup
+    failed are logged and left out, so they are tried again next time.
+    Requests are held to RATE_LIMIT per second by the shared client.
+    """
+  results = {}
+  with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+    futures = {
+        executor.submit(geocode_query, name): key
+        for key, name in spellings.items()
+    }
+    for i, future in enumerate(as_completed(futures)):
+      key = futures[future]
+      name = spellings[key]
+      try:
+        details = future.result()
+      except Exception as e:
+        logger.error(
+            f"[{i + 1}/{len(futures)}] Unable to geocode institution `{name}`: {e}"
+        )
+        continue
+      if details:
+        logger.info(f"[{i + 1}/{len(futures)}] Geocoded institution {name}")
       else:
-        # geocoding didn't return any results, still add to database
-        # EDIT: for now, dont append
-        # new_location_data.append(
-        #     {
-        #         "institution": inst,
-        #         "address": None,
-        #         "latitude": None,
-        #         "longitude": None,
-        #     }
-        # )
         logger.error(
-            f"[{i + 1}/{len(new_location_names)}] Unable to geocode institution `{inst}` (no data returned)"
+            f"[{i + 1}/{len(futures)}] Unable to geocode institution `{name}` (no data returned)"
         )
-    except Exception as e:
-      logger.error(
-          f"[{i + 1}/{len(new_location_names)}] Unable to geocode institution `{inst}`: {e}"
-      )
+      results[key] = details or {
+          "institution": name,
+          "address": None,
+          "latitude": None,
+          "longitude": None,
+      }
+  return results
 
-  # add new locations
-  if len(new_location_data):
-    logger.info("Inserting new locations into database...")
-    db.create(db.Location, new_location_data)
 
-  # get all locations after inserting the new ones
-  locations = db.Location.objects(institution__in=queries).only(
-      "id", "institution")
+def store(results):
+  """Upsert geocoding results into the Location collection and the view
+    """
+  if not results:
+    return
+  checked = datetime.now()
+  operations = [
+      UpdateOne({"key": key}, {"$set": {
+          **details, "checked": checked
+      }},
+                upsert=True) for key, details in results.items()
+  ]
+  collection = db.Location._get_collection()
+  try:
+    collection.bulk_write(operations, ordered=False)
+  except BulkWriteError as e:
+    # another fetch worker stored some of them at the same time
+    if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+      raise
 
-  return {l.institution: l.id for l in locations}
+  docs = collection.find({"key": {
+      "$in": list(results)
+  }}, {
+      "key": 1,
+      "latitude": 1,
+      "checked": 1
+  })
+  with cache_lock:
+    for doc in docs:
+      cache[doc["key"]] = to_entry(doc)
 
 
 def geocode_query(query):
@@ -133,31 +316,25 @@ def geocode_query(query):
 
     Construct appropriate URL for GET request to Google Maps API. Parse
     the resulting JSON for only the latitude, longitude, and address
-    of the inputted institution name.
+    of the inputted institution name. Returns None if there is no such
+    place, and raises if the API refused the request (e.g. over quota).
     """
   if not BASE_URL:
     return
 
-  url = f"{BASE_URL}&address={query}"
-  data = requests.get(url).json().get("results")
-
-  if data:
-    # always just take the first item for now
-    if len(data) > 0:
-      result = data[0]
-      geometry = result.get("geometry", None)
-      if geometry:
-        location = geometry.get("location", None)
-        if location:
-          lat = location.get("lat")
-          lng = location.get("lng")
-      address = result.get("formatted_address", None)
-
-      location_details = {
-          "institution": query,
-          "address": address,
-          "latitude": lat,
-          "longitude": lng,
-      }
+  data = client.get(BASE_URL, params={"address": query}).json()
+  status = data.get("status")
+  if status == "ZERO_RESULTS":
+    return
+  if status != "OK":
+    raise Exception(f"{status}: {data.get('error_message')}")
 
-      return location_details
+  # always just take the first item for now
+  result = data["results"][0]
+  location = result.get("geometry", {}).get("location", {})
+  return {
+      "institution": query,
+      "address": result.get("formatted_address"),
+      "latitude": location.get("lat"),
+      "longitude": location.get("lng"),
+  }
@@ -13,14 +13,24 @@
 # limitations under the License.
 
 import os
+import time
 import meilisearch
 import logging
 
 from dotenv import load_dotenv
 load_dotenv()
 
+from . import db
+
+TRIALS_INDEX = "trials"
+# how long get_cached_trials_index keeps an index before checking for a newer
+# generation
+CACHED_INDEX_TTL = 30  # seconds
+
 logger = logging.getLogger(__name__)
 
+cached_index = {"uid": None, "index": None, "checked": 0}
+
 
 def get_ms_client():
   master_key = os.environ.get("MEILI_KEY", "")
@@ -32,17 +42,53 @@ def get_ms_client():
   return meilisearch.Client(url, master_key)
 
 
+def get_active_index_uid():
+  """
+  Return the uid of the index currently serving trials.
+  """
+  active = db.SearchIndex.objects(name=TRIALS_INDEX).first()
+  # before the first rebuild, the original index serves
+  return active.uid if active else TRIALS_INDEX
+
+
+def set_active_index_uid(uid):
+  """
+  Atomically switch searches over to the index `uid`.
+  """
+  db.SearchIndex.objects(name=TRIALS_INDEX).update_one(upsert=True,
+                                                       set__uid=uid)
+
+
 def get_ms_trials_index(client):
   client = get_ms_client()
+  uid = get_active_index_uid()
   indexes = client.get_indexes()
 
-  # no indexes, create one
-  if indexes == []:
-    logger.warn("[Meili] No index 'trials', creating...")
-    index = client.create_index("trials", {"primaryKey": "ms-id"})
+  # no index, create one
+  if uid not in [i.get("uid") for i in indexes]:
+    logger.warn(f"[Meili] No index '{uid}', creating...")
+    index = client.create_index(uid, {"primaryKey": "ms-id"})
   else:
     # if index exists already
-    logger.warn("[Meili] Index 'trials' already exists")
-    index = client.get_index("trials")
+    logger.warn(f"[Meili] Index '{uid}' already exists")
+    index = client.get_index(uid)
 
   return index
+
+
+def get_cached_trials_index(client):
+  """
+  get_ms_trials_index for the serve path: only looks up the active index
+  every CACHED_INDEX_TTL seconds, so a rebuild is picked up shortly after it
+  switches.
+  """
+  now = time.time()
+  if cached_index["index"] and now - cached_index["checked"] < CACHED_INDEX_TTL:
+    return cached_index["index"]
+
+  uid = get_active_index_uid()
+  if uid != cached_index["uid"]:
+    cached_index["index"] = get_ms_trials_index(client)
+    cached_index["uid"] = uid
+  cached_index["checked"] = now
+  return cached_index["index"]